@@ -0,0 +1,68 @@
+"""Cost of building a fitbit.Fitbit client per participant.
+
+Compares three ways of building the client the extractors create for every
+participant: the constructor as it used to be (resource methods curried onto
+every instance), the constructor with the resource methods defined on the
+class, and Fitbit.for_token, which copies the OAuth2 setup built once per app
+and only sets the token state. Reports constructions per second and memory
+per instance (measured with tracemalloc while the instances are kept alive).
+No network access is needed, nothing is requested.
+
+Usage: python Python/benchmarks/bench_client_construction.py [clients]
+"""
+import sys
+import time
+import tracemalloc
+
+import fitbit
+from fitbit.utils import curry
+
+
+class CurriedFitbit(fitbit.Fitbit):
+    """Fitbit with the per-instance setattr/curry loop __init__ used to run"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for resource in fitbit.Fitbit.RESOURCE_LIST:
+            underscore_resource = resource.replace('/', '_')
+            setattr(self, underscore_resource, curry(self._COLLECTION_RESOURCE, resource))
+            if resource not in ['body', 'glucose']:
+                setattr(self, 'delete_%s' % underscore_resource, curry(self._DELETE_COLLECTION_RESOURCE, resource))
+        for qualifier in fitbit.Fitbit.QUALIFIERS:
+            setattr(self, '%s_activities' % qualifier, curry(self.activity_stats, qualifier=qualifier))
+            setattr(self, '%s_foods' % qualifier, curry(self._food_stats, qualifier=qualifier))
+
+
+def build(factory, i):
+    return factory("client_id", "client_secret", access_token=f"access_{i}", refresh_token=f"refresh_{i}",
+                   expires_at=time.time() + 28800, refresh_cb=lambda token: None, rate_limit_key=f"P{i:05d}")
+
+
+def run(factory, clients):
+    build(factory, -1)
+    start = time.perf_counter()
+    for i in range(clients):
+        build(factory, i)
+    per_second = clients / (time.perf_counter() - start)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build(factory, i) for i in range(clients)]
+    per_instance = (tracemalloc.get_traced_memory()[0] - before) / len(kept)
+    tracemalloc.stop()
+    return per_second, per_instance
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    print(f"{clients} clients")
+    print(f"{'':<24}{'clients/s':>12}{'KB/client':>12}")
+    for name, factory in (("curried (old __init__)", CurriedFitbit),
+                          ("Fitbit(...)", fitbit.Fitbit),
+                          ("Fitbit.for_token(...)", fitbit.Fitbit.for_token)):
+        per_second, per_instance = run(factory, clients)
+        print(f"{name:<24}{per_second:>12.0f}{per_instance / 1024:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
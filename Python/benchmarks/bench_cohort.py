@@ -0,0 +1,179 @@
+"""Cohort-scale extraction benchmark against the mock Fitbit server.
+
+Runs FitbitAuthSimple study period extractions for synthetic cohorts (10, 100
+and 1,000 participants by default). Participants are kept in a local
+participant store (PARTICIPANT_STORE_PATH) and the Fitbit API is served by
+mock_fitbit.MockFitbitServer, so neither AWS nor any Fitbit rate limit is used.
+Every cohort size and resource runs in its own process, so peak RSS is per run.
+Reports rows, requests, requests per second, p50/p99 request latency as the
+client sees it, peak RSS and wall time of the extraction. No network or AWS
+access is needed.
+
+Usage: python Python/benchmarks/bench_cohort.py [--sizes 10 100 1000]
+       [--resources steps sleep activity] [--latency SECONDS] [--error-rate RATE]
+       [--rate-limit N] [--expired SHARE] [--workers N] [--json results.json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from mock_fitbit import MockFitbitServer
+
+
+def make_cohort(size, expired=0.0):
+    """Participants with a 12 week study period that ended a week ago, a share of them with expired tokens"""
+    end = date.today() - timedelta(days=7)
+    start = end - timedelta(weeks=12) + timedelta(days=1)
+    now = time.time()
+    participants = []
+    for i in range(size):
+        participant_id = f"P{i:05d}"
+        access_token, refresh_token = MockFitbitServer.tokens(participant_id)
+        participants.append({
+            "participant_id": participant_id,
+            "wave_number": str(1 + i % 3),
+            "study_start_date": start.isoformat(),
+            "study_end_date": end.isoformat(),
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "expires_at": now - 60 if i < size * expired else now + 28800,
+        })
+    return participants
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def run_one(size, resource_name, args):
+    """Run one extraction in this process and return its numbers"""
+    workdir = tempfile.mkdtemp(prefix="bench_cohort_")
+    os.chdir(workdir)
+    os.environ.update({
+        "OAUTHLIB_INSECURE_TRANSPORT": "1",
+        "PARTICIPANT_STORE_PATH": os.path.join(workdir, "participants.db"),
+        "DATA_STORE_PATH": os.path.join(workdir, "fitbit_data"),
+        "EXTRACTION_RUNS_PATH": os.path.join(workdir, "extraction_runs"),
+        "WATERMARK_PATH": os.path.join(workdir, "extraction_watermarks.json"),
+        "REQUEST_METRICS_PATH": "",
+        "FITBIT_CLIENT_ID": "client_id",
+        "FITBIT_CLIENT_SECRET": "client_secret",
+    })
+    if args.workers:
+        os.environ["EXTRACTION_WORKERS"] = str(args.workers)
+
+    import fitbit
+    from fitbit.api import FitbitOauth2Client, RequestMetrics
+    from project_pace_api_functions import FitbitAuthSimple
+
+    class SampledMetrics(RequestMetrics):
+        """RequestMetrics that also keeps every latency, for exact percentiles"""
+
+        def __init__(self):
+            super().__init__()
+            self.samples = []
+
+        def record(self, method, url, response, seconds, retries=0, refreshes=0):
+            self.samples.append(seconds)
+            super().record(method, url, response, seconds, retries, refreshes)
+
+    try:
+        with MockFitbitServer(latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit) as server:
+            fitbit.Fitbit.API_ENDPOINT = server.url
+            FitbitOauth2Client.refresh_token_url = f"{server.url}/oauth2/token"
+            metrics = FitbitOauth2Client.metrics = SampledMetrics()
+
+            auth = FitbitAuthSimple()
+            table = auth._get_table()
+            for participant in make_cohort(size, args.expired):
+                table.put_item(Item=participant)
+            server.reset()
+
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                rows = auth.extract(resource_name, export_csv=False, return_df=False)
+            wall = time.perf_counter() - start
+            requests = server.requests
+            refreshes = server.refreshes
+            auth.close()
+    finally:
+        os.chdir(os.path.dirname(workdir))
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    samples = sorted(metrics.samples)
+    percentile = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000 if samples else None
+    return {
+        "participants": size,
+        "resource": resource_name,
+        "rows": rows or 0,
+        "requests": requests,
+        "refreshes": refreshes,
+        "requests_per_second": requests / wall if wall else None,
+        "p50_ms": percentile(0.5),
+        "p99_ms": percentile(0.99),
+        "peak_rss_mb": peak_rss_mb(),
+        "wall_seconds": wall,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--resources", nargs="+", default=["steps", "sleep", "activity"], choices=["steps", "sleep", "activity"])
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the mock delays every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests the mock fails with a 503")
+    parser.add_argument("--rate-limit", type=int, default=150, help="requests per participant per hour")
+    parser.add_argument("--expired", type=float, default=0.0, help="share of participants whose token needs a refresh")
+    parser.add_argument("--workers", type=int, help="EXTRACTION_WORKERS")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--run", nargs=2, metavar=("SIZE", "RESOURCE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        # Child process: one extraction, the result as the last line of output
+        print(json.dumps(run_one(int(args.run[0]), args.run[1], args)))
+        return
+
+    options = sys.argv[1:]
+    results = []
+    print(f"{'participants':>12} {'resource':<9}{'rows':>9}{'requests':>10}{'req/s':>9}{'p50 (ms)':>10}"
+          f"{'p99 (ms)':>10}{'RSS (MB)':>10}{'wall (s)':>10}")
+    for size in args.sizes:
+        for resource_name in args.resources:
+            child = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", str(size), resource_name] + options,
+                                   capture_output=True, text=True)
+            if child.returncode != 0:
+                print(f"{size:>12} {resource_name:<9} failed:\n{child.stderr}")
+                continue
+            result = json.loads(child.stdout.strip().splitlines()[-1])
+            results.append(result)
+            rss = f"{result['peak_rss_mb']:>10.1f}" if result["peak_rss_mb"] is not None else f"{'n/a':>10}"
+            print(f"{size:>12} {resource_name:<9}{result['rows']:>9}{result['requests']:>10}"
+                  f"{result['requests_per_second']:>9.1f}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+                  f"{rss}{result['wall_seconds']:>10.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Per-call cost of the token write-back path with and without cached boto3 handles.
+
+Runs FitbitAuthSimple._save_tokens_to_dynamodb against a local stand-in for
+DynamoDB. "rebuilt" resets the cached session/resource/table before every
+call, which is what every method used to do; "cached" reuses them.
+
+Usage: python Python/benchmarks/bench_dynamodb_handle.py [calls]
+"""
+import json
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from stub_server import StubServer, StubHandler
+
+
+class _DynamoDBHandler(StubHandler):
+    """Answers every DynamoDB JSON API call with an empty success"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.requests += 1
+        body = json.dumps({}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-amz-json-1.0")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+TOKENS = {
+    "access_token": "access",
+    "refresh_token": "refresh",
+    "expires_in": 28800,
+    "expires_at": time.time() + 28800,
+    "scope": ["activity", "sleep"],
+    "token_type": "Bearer",
+    "user_id": "ABC123",
+}
+
+
+def run(auth, calls, rebuild):
+    start = time.perf_counter()
+    for _ in range(calls):
+        if rebuild:
+            auth.reset()
+        auth._save_tokens_to_dynamodb("P001", TOKENS)
+    return (time.perf_counter() - start) / calls
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    with StubServer(handler=_DynamoDBHandler) as server:
+        os.environ.update({
+            "AWS_ACCESS_KEY_ID": "local",
+            "AWS_SECRET_ACCESS_KEY": "local",
+            "AWS_TABLE_NAME": "PACE_Participants",
+            "AWS_DYNAMODB_ENDPOINT_URL": server.url,
+        })
+        import project_pace_api_functions as paf
+
+        auth = paf.FitbitAuthSimple()
+        # Warm up imports and botocore's model cache
+        run(auth, 1, rebuild=True)
+
+        rebuilt = run(auth, calls, rebuild=True)
+        cached = run(auth, calls, rebuild=False)
+
+    print(f"{calls} token write-backs")
+    print(f"{'rebuilt handles':<18}{rebuilt * 1000:>10.2f} ms/call")
+    print(f"{'cached handles':<18}{cached * 1000:>10.2f} ms/call")
+    print(f"{'saving':<18}{(rebuilt - cached) * 1000:>10.2f} ms/call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Post-processing cost of the extractors on a synthetic cohort, per-row vs vectorized.
+
+Builds activity rows for a synthetic cohort (about 5% of them outside the
+participant's study period) and times dropping the out-of-window rows with the
+old iterrows/drop loop against FitbitAuthSimple._in_study_window. It then times
+masking future days for steps rows the old way (strptime and now() per day)
+against FitbitAuthSimple._mask_future_days. No network or AWS access is needed.
+
+Usage: python Python/benchmarks/bench_postprocess.py [rows] [participants]
+"""
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pandas as pd
+
+from project_pace_api_functions import FitbitAuthSimple
+
+
+def make_cohort(rows, participants, seed=0):
+    rng = random.Random(seed)
+    today = datetime.now()
+    all_users_data = {}
+    for i in range(participants):
+        # Study periods of 12 weeks, some of them still running
+        start = today - timedelta(days=rng.randint(30, 400))
+        all_users_data[f"P{i:04d}"] = {
+            "study_start_date": start.strftime("%Y-%m-%d"),
+            "study_end_date": (start + timedelta(weeks=12)).strftime("%Y-%m-%d"),
+        }
+
+    participant_ids = list(all_users_data)
+    records = []
+    for _ in range(rows):
+        participant_id = rng.choice(participant_ids)
+        start = datetime.strptime(all_users_data[participant_id]["study_start_date"], "%Y-%m-%d")
+        offset = rng.randint(0, 83) if rng.random() > 0.05 else rng.choice([-3, -1, 84, 90])
+        records.append({
+            "user_id": participant_id,
+            "date": (start + timedelta(days=offset)).strftime("%Y-%m-%d"),
+            "steps": float(rng.randint(0, 20000)),
+        })
+    return pd.DataFrame(records), all_users_data
+
+
+def window_per_row(df, all_users_data):
+    """The loop extract_all_users_activity_study_period used to run"""
+    df = df.copy()
+    for index, row in df.iterrows():
+        user_data = all_users_data[row["user_id"]]
+        date = datetime.strptime(row["date"], "%Y-%m-%d")
+        if date < datetime.strptime(user_data["study_start_date"], "%Y-%m-%d") or date > datetime.strptime(user_data["study_end_date"], "%Y-%m-%d"):
+            df.drop(index, inplace=True)
+    return df
+
+
+def window_vectorized(df, all_users_data):
+    return df[FitbitAuthSimple._in_study_window(df, all_users_data)]
+
+
+def future_per_row(df):
+    """The per-day check the steps and sleep extractors used to run"""
+    steps = []
+    for date, value in zip(df["date"], df["steps"]):
+        steps.append(float("nan") if datetime.strptime(date, "%Y-%m-%d") > datetime.now() else value)
+    df = df.copy()
+    df["steps"] = steps
+    return df
+
+
+def future_vectorized(df):
+    df = df.copy()
+    FitbitAuthSimple._mask_future_days(df, ["steps"])
+    return df
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    participants = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    df, all_users_data = make_cohort(rows, participants)
+
+    kept_per_row, window_per_row_time = timed(window_per_row, df, all_users_data)
+    kept_vectorized, window_vectorized_time = timed(window_vectorized, df, all_users_data)
+    assert kept_per_row.equals(kept_vectorized)
+
+    masked_per_row, future_per_row_time = timed(future_per_row, df)
+    masked_vectorized, future_vectorized_time = timed(future_vectorized, df)
+    assert masked_per_row.equals(masked_vectorized)
+
+    print(f"{rows} rows, {participants} participants, {rows - len(kept_vectorized)} outside the study period")
+    print(f"{'':<22}{'per-row':>12}{'vectorized':>12}{'speedup':>10}")
+    for name, slow, fast in (("study window filter", window_per_row_time, window_vectorized_time),
+                             ("future day masking", future_per_row_time, future_vectorized_time)):
+        print(f"{name:<22}{slow * 1000:>10.1f}ms{fast * 1000:>10.1f}ms{slow / fast:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
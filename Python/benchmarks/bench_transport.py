@@ -0,0 +1,53 @@
+"""Compare per-client connection pools with the shared FitbitTransport.
+
+Builds one fitbit.Fitbit per synthetic participant (like the extract_* loops in
+project_pace_api_functions.py) against a local stub server and reports the
+number of TCP connections (handshakes) and the wall time for each mode.
+
+Usage: python Python/benchmarks/bench_transport.py [participants]
+"""
+import os
+import sys
+import time
+
+import fitbit
+from fitbit.api import FitbitOauth2Client
+
+from stub_server import StubServer
+
+# The stub speaks plain HTTP
+os.environ.setdefault("OAUTHLIB_INSECURE_TRANSPORT", "1")
+
+
+def run(server, participants):
+    class StubFitbit(fitbit.Fitbit):
+        API_ENDPOINT = server.url
+
+    server.reset()
+    start = time.perf_counter()
+    for i in range(participants):
+        client = StubFitbit("client_id", "client_secret",
+                            access_token=f"access_{i}", refresh_token=f"refresh_{i}")
+        client.time_series("activities/steps", base_date="2025-01-01", end_date="2025-01-01")
+    return server.connections, time.perf_counter() - start
+
+
+def main():
+    participants = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    with StubServer() as server:
+        shared = FitbitOauth2Client.transport
+
+        FitbitOauth2Client.transport = None
+        before = run(server, participants)
+
+        FitbitOauth2Client.transport = shared
+        after = run(server, participants)
+
+    print(f"{participants} participants")
+    print(f"{'mode':<22}{'handshakes':>12}{'wall (s)':>12}")
+    print(f"{'per-client pool':<22}{before[0]:>12}{before[1]:>12.3f}")
+    print(f"{'shared transport':<22}{after[0]:>12}{after[1]:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
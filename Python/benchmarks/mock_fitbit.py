@@ -0,0 +1,288 @@
+"""Local mock of the parts of the Fitbit Web API the extractors use, for benchmarks.
+
+Serves, with deterministic synthetic data per user and date:
+
+- ``/1/user/-/activities/steps/date/{start}/{end}.json`` (and other daily time series)
+- ``/1.2/user/-/sleep/date/{start}/{end}.json``
+- ``/1/user/-/activities/list.json`` with ``afterDate``/``offset``/``limit`` pagination
+- ``/1/user/-/activities/steps/date/{date}/1d/1min[/time/{start}/{end}].json`` (intraday)
+- ``POST /oauth2/token`` refresh token grants, with single-use refresh tokens
+
+Latency, error rate and the per-user rate limit are configurable. Every response
+carries ``Fitbit-Rate-Limit-*`` headers, and a user over the limit gets a 429
+with ``Retry-After``. Tokens look like ``access:{user}:{n}``, so the user is
+known from the bearer token; ``MockFitbitServer.tokens(user)`` gives the first pair.
+
+Usage: with MockFitbitServer(latency=0.02, error_rate=0.01) as server: ...
+"""
+import json
+import random
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from stub_server import StubHandler, StubServer
+
+
+def _seeded(*parts):
+    return random.Random(zlib.crc32(":".join(str(part) for part in parts).encode()))
+
+
+def _days(start, end):
+    day = date.fromisoformat(start)
+    last = date.fromisoformat(end)
+    while day <= last:
+        yield day.isoformat()
+        day += timedelta(days=1)
+
+
+def _user_of(token):
+    """access:{user}:{n} -> user, other tokens are their own user"""
+    return token.split(":", 1)[1].rsplit(":", 1)[0] if token.count(":") >= 2 else token
+
+
+def _period_end(start, period):
+    """End date of a time series period such as 7d, 1w or 3m"""
+    count, unit = int(period[:-1]), period[-1]
+    days = {"d": 1, "w": 7, "m": 30, "y": 365}[unit] * count
+    return (date.fromisoformat(start) + timedelta(days=days - 1)).isoformat()
+
+
+class MockFitbitHandler(StubHandler):
+
+    def do_GET(self):
+        self._count()
+        server = self.server
+        url = urlparse(self.path)
+        token = self._token()
+        if token is None:
+            return self._error(401, "invalid_token", "Access token invalid")
+        if token in server.expired:
+            return self._error(401, "expired_token", "Access token expired")
+        user = _user_of(token)
+
+        allowed, headers = server.spend(user)
+        if server.latency or server.latency_jitter:
+            time.sleep(server.latency + server.random.uniform(0, server.latency_jitter))
+        if not allowed:
+            return self._send(429, {"errors": [{"errorType": "system", "message": "Too Many Requests"}]},
+                              dict(headers, **{"Retry-After": headers["Fitbit-Rate-Limit-Reset"]}))
+        if server.error_rate and server.random.random() < server.error_rate:
+            return self._send(server.error_status, {"errors": [{"errorType": "system", "message": "Injected error"}]}, headers)
+
+        today = date.today().isoformat()
+        parts = [part.replace("today", today) for part in url.path.strip("/").split("/")]
+        try:
+            if parts[-1] == "list.json":
+                body = self._activity_list(user, parse_qs(url.query))
+            elif "sleep" in parts:
+                body = self._sleep(user, parts[-2], parts[-1][:-len(".json")])
+            elif "1d" in parts:
+                body = self._intraday(user, parts)
+            else:
+                date_index = parts.index("date")
+                resource = "-".join(parts[3:date_index])
+                body = self._time_series(user, resource, parts[date_index + 1], parts[date_index + 2][:-len(".json")])
+        except (ValueError, IndexError, KeyError) as e:
+            return self._error(400, "validation", str(e))
+        self._send(200, body, headers)
+
+    def do_POST(self):
+        self._count()
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        if urlparse(self.path).path != "/oauth2/token" or form.get("grant_type") != ["refresh_token"]:
+            return self._error(400, "invalid_request", "Only refresh token grants are supported")
+        token = self.server.refresh(form.get("refresh_token", [""])[0])
+        if token is None:
+            return self._error(400, "invalid_grant", "Refresh token invalid")
+        self._send(200, token)
+
+    def _count(self):
+        with self.server.lock:
+            self.server.requests += 1
+
+    def _token(self):
+        authorization = self.headers.get("Authorization", "")
+        if not authorization.startswith("Bearer "):
+            return None
+        return authorization[len("Bearer "):]
+
+    def _time_series(self, user, resource, start, end):
+        if "-" not in end:
+            end = _period_end(start, end)
+        values = []
+        for day in _days(start, end):
+            value = _seeded(user, resource, day).randint(0, 20000) if day <= date.today().isoformat() else 0
+            values.append({"dateTime": day, "value": str(value)})
+        return {resource: values}
+
+    def _sleep(self, user, start, end):
+        sleep = []
+        for day in _days(start, end):
+            rng = _seeded(user, "sleep", day)
+            if day > date.today().isoformat() or rng.random() < 0.1:
+                continue
+            minutes = rng.randint(300, 540)
+            start_time = datetime.fromisoformat(day) - timedelta(minutes=rng.randint(0, 180) + 60)
+            sleep.append({
+                "dateOfSleep": day,
+                "duration": minutes * 60000,
+                "efficiency": rng.randint(70, 99),
+                "isMainSleep": True,
+                "logId": zlib.crc32(f"{user}:{day}".encode()),
+                "logType": "auto_detected",
+                "minutesAsleep": minutes - 20,
+                "minutesAwake": 20,
+                "startTime": start_time.strftime("%Y-%m-%dT%H:%M:%S.000"),
+                "endTime": (start_time + timedelta(minutes=minutes)).strftime("%Y-%m-%dT%H:%M:%S.000"),
+                "timeInBed": minutes,
+                "type": "stages",
+            })
+        return {"sleep": sleep, "summary": {"totalSleepRecords": len(sleep)}}
+
+    def _activity_list(self, user, query):
+        after = query.get("afterDate", [None])[0]
+        if after is None:
+            raise ValueError("afterDate is required")
+        offset = int(query.get("offset", ["0"])[0])
+        limit = min(int(query.get("limit", ["20"])[0]), 100)
+        days = list(_days(after, date.today().isoformat()))
+        per_day = self.server.activities_per_day
+        total = len(days) * per_day
+        activities = []
+        for index in range(offset, min(offset + limit, total)):
+            day, number = days[index // per_day], index % per_day
+            rng = _seeded(user, "activity", day, number)
+            duration = rng.randint(10, 90) * 60000
+            activities.append({
+                "activityName": rng.choice(["Walk", "Run", "Bike", "Sport"]),
+                "activityTypeId": rng.choice([90013, 90009, 90001, 15000]),
+                "duration": duration,
+                "originalDuration": duration,
+                "logType": "auto_detected",
+                "manualValuesSpecified": {"steps": False, "calories": False, "distance": False},
+                "startTime": f"{day}T{8 + number * 4:02d}:00:00.000",
+                "lastModified": f"{day}T23:00:00.000Z",
+                "activityLevel": [{"name": name, "minutes": rng.randint(0, 30)}
+                                  for name in ("sedentary", "lightly", "fairly", "very")],
+            })
+        next_url = ""
+        if offset + limit < total:
+            next_url = f"{self.server.url}/1/user/-/activities/list.json?" + urlencode(
+                {"afterDate": after, "sort": "asc", "offset": offset + limit, "limit": limit})
+        return {"activities": activities,
+                "pagination": {"afterDate": after, "limit": limit, "next": next_url, "offset": offset,
+                               "previous": "", "sort": "asc"}}
+
+    def _intraday(self, user, parts):
+        date_index = parts.index("date")
+        resource = "-".join(parts[3:date_index])
+        day = parts[date_index + 1]
+        interval = 15 if parts[date_index + 3].startswith("15min") else 1
+        first, last = 0, 24 * 60 - 1
+        if "time" in parts:
+            time_index = parts.index("time")
+            start, end = parts[time_index + 1], parts[time_index + 2][:-len(".json")]
+            first = int(start[:2]) * 60 + int(start[3:5])
+            last = int(end[:2]) * 60 + int(end[3:5])
+        rng = _seeded(user, resource, day, "intraday")
+        dataset = [{"time": f"{minute // 60:02d}:{minute % 60:02d}:00", "value": rng.randint(0, 150)}
+                   for minute in range(first, last + 1, interval)]
+        key = resource
+        return {key: [{"dateTime": day, "value": str(sum(point["value"] for point in dataset))}],
+                f"{key}-intraday": {"dataset": dataset, "datasetInterval": interval, "datasetType": "minute"}}
+
+    def _error(self, status, error_type, message):
+        self._send(status, {"errors": [{"errorType": error_type, "message": message}], "success": False})
+
+    def _send(self, status, body, headers=None):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockFitbitServer(StubServer):
+    """Run the mock on a background thread: ``with MockFitbitServer(...) as server: ...``"""
+
+    def __init__(self, latency=0.0, latency_jitter=0.0, error_rate=0.0, error_status=503, rate_limit=150,
+                 rate_limit_window=3600, activities_per_day=1, token_lifetime=28800, seed=0, **kwargs):
+        """
+        Args:
+            latency (float, optional): Seconds every API response is delayed by. Defaults to 0.
+            latency_jitter (float, optional): Up to this many seconds of random extra delay. Defaults to 0.
+            error_rate (float, optional): Share of API requests answered with error_status. Defaults to 0.
+            error_status (int, optional): The status of injected errors. Defaults to 503.
+            rate_limit (int, optional): Requests per user per window, None for no limit. Defaults to 150, like Fitbit.
+            rate_limit_window (int, optional): Seconds until a user's budget resets. Defaults to 3600.
+            activities_per_day (int, optional): Activities logged per user per day. Defaults to 1.
+            token_lifetime (int, optional): expires_in of refreshed tokens. Defaults to 28800.
+            seed (int, optional): Seed for latency jitter and error injection. Defaults to 0.
+        """
+        super().__init__(handler=MockFitbitHandler, **kwargs)
+        httpd = self.httpd
+        httpd.url = self.url
+        httpd.latency = latency
+        httpd.latency_jitter = latency_jitter
+        httpd.error_rate = error_rate
+        httpd.error_status = error_status
+        httpd.activities_per_day = activities_per_day
+        httpd.random = random.Random(seed)
+        httpd.expired = set()
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.token_lifetime = token_lifetime
+        self.refreshes = 0
+        self._budgets = {}
+        self._refresh_tokens = {}
+        self._limit_lock = threading.Lock()
+        httpd.spend = self._spend
+        httpd.refresh = self._refresh
+
+    @staticmethod
+    def tokens(user, generation=0):
+        """The access and refresh token of a user's generation-th token pair"""
+        return f"access:{user}:{generation}", f"refresh:{user}:{generation}"
+
+    def expire(self, access_token):
+        """Make an access token come back as expired_token, as if it ran out before its expires_at"""
+        self.httpd.expired.add(access_token)
+
+    def _spend(self, user):
+        """Take one request from the user's budget, returning (allowed, rate limit headers)"""
+        now = time.time()
+        with self._limit_lock:
+            window_start, used = self._budgets.get(user, (now, 0))
+            if now - window_start >= self.rate_limit_window:
+                window_start, used = now, 0
+            allowed = self.rate_limit is None or used < self.rate_limit
+            if allowed:
+                used += 1
+            self._budgets[user] = (window_start, used)
+        limit = self.rate_limit if self.rate_limit is not None else 1000000
+        reset = max(1, int(window_start + self.rate_limit_window - now))
+        return allowed, {"Fitbit-Rate-Limit-Limit": limit, "Fitbit-Rate-Limit-Remaining": max(0, limit - used),
+                         "Fitbit-Rate-Limit-Reset": reset}
+
+    def _refresh(self, refresh_token):
+        """Rotate a user's tokens. A refresh token works once, and the old access token stops working."""
+        if not refresh_token.startswith("refresh:") or refresh_token.count(":") < 2:
+            return None
+        user, generation = refresh_token[len("refresh:"):].rsplit(":", 1)
+        with self._limit_lock:
+            latest = self._refresh_tokens.get(user, 0)
+            if int(generation) != latest:
+                return None
+            self._refresh_tokens[user] = latest + 1
+            self.refreshes += 1
+        access_token, new_refresh_token = self.tokens(user, latest + 1)
+        self.httpd.expired.add(self.tokens(user, latest)[0])
+        return {"access_token": access_token, "refresh_token": new_refresh_token, "expires_in": self.token_lifetime,
+                "scope": "activity sleep", "token_type": "Bearer", "user_id": user}
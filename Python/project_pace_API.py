@@ -1,13 +1,41 @@
 # %%
+import argparse
+import os
 import pandas as pd
 from datetime import datetime
 from urllib.parse import urlparse, parse_qs
 import project_pace_api_functions as paf
+from project_pace_shards import parse_shard, run_local_shards
 import time
 
 # %%
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Project Pace Text Database + Fitbit API")
+    parser.add_argument("--resume", metavar="RUN_ID", help="continue an interrupted extraction run (options 3, 6 and 7) instead of showing the menu")
+    parser.add_argument("--extract", choices=["steps", "sleep", "activity"], help="run a study period extraction instead of showing the menu")
+    parser.add_argument("--incremental", action="store_true", help="with --extract, only fetch the days since the last run")
+    parser.add_argument("--shard", metavar="I/N", help="only extract shard I of N of the participants, into extraction_shards/shard-I-of-N")
+    parser.add_argument("--shards", type=int, metavar="N", help="with --extract, run N shards as processes on this machine and merge them")
+    parser.add_argument("--merge-shards", type=int, metavar="N", help="with --extract, merge the outputs of N shards into the data store")
+    parser.add_argument("--replay", action="store_true", help="rebuild the data from the response archive (RESPONSE_ARCHIVE_PATH) without any Fitbit requests")
+    args = parser.parse_args()
+    if (args.shards or args.merge_shards) and not args.extract:
+        parser.error("--shards and --merge-shards need --extract")
+    if args.shard and (args.shards or args.merge_shards):
+        parser.error("--shard can't be combined with --shards or --merge-shards")
+    shard = None
+    if args.shard:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.replay:
+        # Read by FitbitAuthSimple, and inherited by the shard processes of --shards
+        os.environ['ARCHIVE_REPLAY'] = '1'
+
     auth = paf.FitbitAuthSimple()
+    if args.replay and not auth.archive_path:
+        parser.error("--replay needs RESPONSE_ARCHIVE_PATH in the .env file")
 
     print("Project Pace Text Database + Fitbit API")
     time.sleep(1)
@@ -50,6 +78,28 @@ if __name__ == "__main__":
         else:
             print("All required environment variables are set.")
 
+    if shard: # Only extract this machine's shard of the participants
+        auth.use_shard(*shard)
+
+    if args.resume: # Continue an interrupted extraction run
+        rows = auth.resume_run(args.resume)
+        if rows:
+            print(f"\nExtracted {rows} rows")
+        exit(0)
+
+    if args.merge_shards: # Combine the outputs of the shards, e.g. copied over from other machines
+        auth.merge_shards(args.extract, args.merge_shards)
+        exit(0)
+
+    if args.extract: # Run an extraction without the menu, e.g. from a scheduler or on a shard machine
+        if args.shards:
+            rows = run_local_shards(args.extract, args.shards, incremental=args.incremental)
+        else:
+            rows = auth.extract(args.extract, incremental=args.incremental, return_df=False)
+        if rows:
+            print(f"\nExtracted {rows} rows")
+        exit(0)
+
     """ Options for user interaction """
     time.sleep(2)
     print("What step would you like to do? \n1. Generate link for participant & save token \n2. Get single user steps for a certain range \n3. Extract all users step data according to the study period \n4. Edit a user's information \n5. Delete a user \n6. Get sleep data over the study period\n7. Get activity data over the study period\n8. Send test message\n9. Update environment variable\n10. Exit")
@@ -87,10 +137,11 @@ if __name__ == "__main__":
                 print("No data available")
         case "3": # Extract all users data according to the study period
             # Tested - works
-            result_df = auth.extract_all_users_steps_study_period()
-            if result_df is not None:
-                print("\nExtracted Data:")
-                print(result_df)
+            incremental = input("Only fetch the days since the last run? (y/n): ").strip().lower() == 'y'
+            # Rows are streamed to the data store and CSV file, not kept in memory
+            rows = auth.extract_all_users_steps_study_period(incremental=incremental, return_df=False)
+            if rows:
+                print(f"\nExtracted {rows} rows")
         case "4": # Edit a user's information
             # Tested - works
             auth.edit_user_study_info()
@@ -100,16 +151,18 @@ if __name__ == "__main__":
             auth.delete_user(user_id)
         case "6": # Get sleep data
             # Tested - works
-            result_df = auth.extract_all_users_sleepData_study_period()
-            if result_df is not None:
-                print("\nExtracted Data:")
-                print(result_df)
+            incremental = input("Only fetch the days since the last run? (y/n): ").strip().lower() == 'y'
+            # Rows are streamed to the data store and CSV file, not kept in memory
+            rows = auth.extract_all_users_sleepData_study_period(incremental=incremental, return_df=False)
+            if rows:
+                print(f"\nExtracted {rows} rows")
         case "7": # Get activity data
             # Tested - works
-            result_df = auth.extract_all_users_activity_study_period()
-            if result_df is not None:
-                print("\nExtracted Data:")
-                print(result_df)
+            incremental = input("Only fetch the days since the last run? (y/n): ").strip().lower() == 'y'
+            # Rows are streamed to the data store and CSV file, not kept in memory
+            rows = auth.extract_all_users_activity_study_period(incremental=incremental, return_df=False)
+            if rows:
+                print(f"\nExtracted {rows} rows")
         case "8": # Send test text messages to a user
             # Tested - works
             auth.send_test_message()
@@ -1,18 +1,54 @@
+import itertools
 import os
+import queue
+import threading
+import time
+import uuid
 import fitbit
 import pandas as pd
-from datetime import datetime
+from project_pace_checkpoints import RunJournal
+from project_pace_data_store import FitbitDataStore
+from project_pace_logging import Progress, SampledLogger, setup_logging
+from project_pace_participant_store import DynamoDBParticipantStore, LocalParticipantStore
+from project_pace_pipeline import ExtractionSink
+from project_pace_shards import shard_dir, shard_of
+from project_pace_watermarks import WatermarkStore
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import boto3
+from botocore.exceptions import ClientError
 import logging
 from decimal import Decimal
 
-# Initialize logging
-logging.basicConfig(filename='project_pace_api.log', format='%(asctime)s - %(levelname)s - %(message)s', level = logging.INFO)
+# Initialize logging, written to the file by a background thread. Set LOG_LEVEL=DEBUG for (sampled) per-record lines.
+setup_logging('project_pace_api.log', level=os.getenv('LOG_LEVEL', 'INFO').upper())
 
 
 # %%
 class FitbitAuthSimple:
+    # DynamoDB attributes each Fitbit pull needs, read with a ProjectionExpression (see iter_participants)
+    TOKEN_ATTRIBUTES = ('access_token', 'refresh_token', 'expires_at')
+    STEPS_ATTRIBUTES = ('participant_id', 'wave_number', 'study_start_date', 'study_end_date') + TOKEN_ATTRIBUTES
+    STEPS_DATE_RANGE_ATTRIBUTES = ('participant_id',) + TOKEN_ATTRIBUTES
+    SLEEP_ATTRIBUTES = STEPS_ATTRIBUTES
+    ACTIVITY_ATTRIBUTES = STEPS_ATTRIBUTES
+
+    # Output columns of each study period extraction, in order
+    STEPS_COLUMNS = ('user_id', 'wave_number', 'date', 'steps')
+    SLEEP_COLUMNS = ('user_id', 'wave_number', 'date', 'duration (ms)', 'efficiency', 'is_main_sleep', 'log_type', 'start_time', 'duration (mins)')
+    ACTIVITY_COLUMNS = ('user_id', 'wave_number', 'date', 'activityName', 'activityTypeId', 'duration (ms)', 'duration (mins)',
+                        'originalDuration (ms)', 'originalDuration (mins)', 'logType', 'manualValuesSpecified_steps', 'startTime',
+                        'lastModified', 'sedentary', 'lightly', 'fairly', 'very')
+
+    ## Endpoint (see fitbit.api.RequestMetrics.endpoint_template) each extraction requests, to find how far
+    ## the response archive goes when replaying
+    ARCHIVE_ENDPOINTS = {
+        'steps': '/1/user/{user_id}/activities/steps/date/{date}/{date}.json',
+        'sleep': '/1.2/user/{user_id}/sleep/date/{date}/{date}.json',
+        'activity': '/1/user/{user_id}/activities/list.json',
+    }
+
     def __init__(self):
         load_dotenv()
         
@@ -27,6 +63,64 @@ class FitbitAuthSimple:
         self.aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
         self.aws_table_name = os.getenv('AWS_TABLE_NAME')
         self.region_name = "us-east-1"
+        # Optional, e.g. a DynamoDB Local endpoint for offline runs
+        self.aws_endpoint_url = os.getenv('AWS_DYNAMODB_ENDPOINT_URL')
+        # Optional, a local SQLite participant store used instead of DynamoDB, see LocalParticipantStore
+        self.participant_store_path = os.getenv('PARTICIPANT_STORE_PATH')
+
+        ## Number of participants extracted at once
+        self.max_workers = int(os.getenv('EXTRACTION_WORKERS', 16))
+        ## Rows post-processed and written out at a time
+        self.batch_rows = int(os.getenv('EXTRACTION_BATCH_ROWS', 10000))
+        ## With LOG_LEVEL=DEBUG, log one in this many per-record lines
+        self.log_sample_every = int(os.getenv('LOG_SAMPLE_EVERY', 100))
+
+        ## Incremental extraction: where the watermarks are kept and how many days before them to fetch again
+        self.watermark_path = os.getenv('WATERMARK_PATH', 'extraction_watermarks.json')
+        self.resync_days = int(os.getenv('RESYNC_DAYS', 3))
+
+        ## Partitioned Parquet store the study period extractions are saved to
+        self.data_store = FitbitDataStore(os.getenv('DATA_STORE_PATH', 'fitbit_data'))
+        ## Checkpoint journals of extraction runs, see RunJournal
+        self.runs_path = os.getenv('EXTRACTION_RUNS_PATH', 'extraction_runs')
+        ## Where the CSV files are exported
+        self.output_dir = ''
+
+        ## Sharded extraction: the (index, count) shard of the participants to extract, see use_shard
+        self.shard = None
+        self.shards_path = os.getenv('EXTRACTION_SHARDS_PATH', 'extraction_shards')
+
+        ## Request metrics, summarized and written out after each extraction when a path is set
+        ## (a Prometheus textfile if it ends in .prom, JSON otherwise)
+        self.metrics_path = os.getenv('REQUEST_METRICS_PATH')
+        if self.metrics_path and fitbit.api.FitbitOauth2Client.metrics is None:
+            fitbit.api.FitbitOauth2Client.metrics = fitbit.api.RequestMetrics()
+
+        ## Raw response archive: every Fitbit response is appended to it when a path is set, and with
+        ## ARCHIVE_REPLAY=1 extractions are served from it without any Fitbit requests (see ResponseArchive)
+        self.archive_path = os.getenv('RESPONSE_ARCHIVE_PATH')
+        self.replay = os.getenv('ARCHIVE_REPLAY', '').lower() in ('1', 'true', 'yes')
+        if self.archive_path and fitbit.Fitbit.archive is None:
+            fitbit.Fitbit.archive = fitbit.api.ResponseArchive(self.archive_path, replay=self.replay)
+
+        ## Persistent response cache, when a path is set: days more than a week old are kept for 90 days, recent
+        ## ones for an hour, so reruns only ask Fitbit for the recent days (see ResponseCache)
+        self.cache_path = os.getenv('RESPONSE_CACHE_PATH')
+        if self.cache_path and fitbit.Fitbit.cache is None:
+            fitbit.Fitbit.cache = fitbit.api.ResponseCache(
+                self.cache_path, max_bytes=int(os.getenv('RESPONSE_CACHE_MAX_MB', 512)) * 1024 ** 2)
+
+        ## AWS handles are created on first use, see _get_table
+        self._aws_lock = threading.Lock()
+        self._aws_session = None
+        self._dynamodb = None
+        self._table = None
+
+        ## Identifies this process when it holds a participant's token refresh lease
+        self.lease_owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        self.refresh_lease_seconds = 60
+        ## The refresh token being replaced by the refresh running on each thread, see _save_tokens_to_dynamodb
+        self._refreshing = threading.local()
 
     def get_auth_link(self):
         """Generate authorization link for a participant
@@ -59,7 +153,7 @@ class FitbitAuthSimple:
         Returns:
             dict: The access token and refresh token for the user
         """
-        logging.info(f"save_token_from_code called for user {user_id} with auth code: {auth_code}")
+        logging.info(f"save_token_from_code called for user {user_id}")
         client = fitbit.Fitbit(
             self.client_id,
             self.client_secret,
@@ -67,7 +161,7 @@ class FitbitAuthSimple:
             oauth2=True
         )
         tokens = client.client.fetch_access_token(auth_code)
-        logging.info(f"Tokens received for user {user_id}: {tokens}")
+        logging.info(f"Tokens received for user {user_id}")
         #self._save_tokens(user_id, tokens) # Only using this when saving the tokens to a file
         
         # Unravel the tokens so the information can be saved to AWS dynamoDB
@@ -101,14 +195,7 @@ class FitbitAuthSimple:
         
         # Send information to AWS dynamoDB
         
-        Session = boto3.Session(
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.region_name
-        )
-
-        dynamodb = Session.resource("dynamodb")
-        table = dynamodb.Table(self.aws_table_name)
+        table = self._get_table()
 
         # Save user information to DynamoDB
         table.put_item(Item={
@@ -131,42 +218,311 @@ class FitbitAuthSimple:
         logging.info(f"User {user_id} authorized and information saved to DynamoDB.")
         return tokens
 
-    def _save_tokens_to_dynamodb(self, participant_id, tokens):
+    def _save_tokens_to_dynamodb(self, participant_id, tokens, old_refresh_token=None):
         """Save refreshed tokens to AWS DynamoDB
 
         Args:
             participant_id (str): The ID of the participant
             tokens (dict): The refreshed tokens
+            old_refresh_token (str, optional): The refresh token these tokens replace. Defaults to the one
+                _refresh_with_lease is refreshing on this thread, if any.
         """
-        logging.info(f"_save_tokens_to_dynamodb called for participant {participant_id} with tokens: {tokens}")
-        Session = boto3.Session(
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.region_name
-        )
+        logging.info(f"_save_tokens_to_dynamodb called for participant {participant_id}")
+        table = self._get_table()
+        if old_refresh_token is None:
+            old_refresh_token = getattr(self._refreshing, 'old_refresh_token', None)
+
+        # Update the item in DynamoDB and release the refresh lease in the same write. The write is conditional
+        # on the item still holding the refresh token that was spent, not on holding the lease: Fitbit has
+        # already rotated the token, so it must be saved even if the lease ran out and another process claimed it
+        values = {
+            ':access_token': tokens['access_token'],
+            ':refresh_token': tokens['refresh_token'],
+            ':expires_in': tokens['expires_in'],
+            ':expires_at': Decimal(str(tokens['expires_at'])),
+            ':scope': tokens['scope'],
+            ':token_type': tokens['token_type'],
+            ':user_id': tokens['user_id']
+        }
+        condition = {}
+        if old_refresh_token is not None:
+            condition['ConditionExpression'] = "refresh_token = :old_refresh_token"
+            values[':old_refresh_token'] = old_refresh_token
+        try:
+            table.update_item(
+                Key={'participant_id': participant_id},
+                UpdateExpression="SET access_token = :access_token, refresh_token = :refresh_token, expires_in = :expires_in, expires_at = :expires_at, #scope_attr = :scope, token_type = :token_type, user_id = :user_id REMOVE refresh_lock_owner, refresh_lock_expires",
+                ExpressionAttributeNames={
+                    '#scope_attr': 'scope'
+                },
+                ExpressionAttributeValues=values,
+                **condition
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            item = table.get_item(Key={'participant_id': participant_id}, ConsistentRead=True).get('Item', {})
+            if item.get('refresh_token') != tokens['refresh_token']:
+                # Not a refresh of the stored token (e.g. the participant was authorized again meanwhile),
+                # the newer stored token is kept
+                print(f"Tokens for participant {participant_id} were replaced during the refresh, the stored tokens are kept.")
+                logging.error(f"Tokens for participant {participant_id} were replaced in DynamoDB while refreshing {old_refresh_token[:8]}..., the stored tokens are kept.")
+                return
+        print(f"Tokens for participant {participant_id} updated in DynamoDB.")
+        logging.info(f"Tokens for participant {participant_id} updated in DynamoDB, expiring at {tokens['expires_at']}.")
+
+    def _build_client(self, participant_id, user_data):
+        """Build a Fitbit client for a participant from their DynamoDB record
+
+        Args:
+            participant_id (str): The ID of the participant
+            user_data (dict): The participant's DynamoDB item, with the token attributes
 
-        dynamodb = Session.resource("dynamodb")
-        table = dynamodb.Table(self.aws_table_name)
-
-        # Update the item in DynamoDB
-        table.update_item(
-            Key={'participant_id': participant_id},
-            UpdateExpression="SET access_token = :access_token, refresh_token = :refresh_token, expires_in = :expires_in, expires_at = :expires_at, #scope_attr = :scope, token_type = :token_type, user_id = :user_id",
-            ExpressionAttributeNames={
-                '#scope_attr': 'scope'
-            },
-            ExpressionAttributeValues={
-                ':access_token': tokens['access_token'],
-                ':refresh_token': tokens['refresh_token'],
-                ':expires_in': tokens['expires_in'],
-                ':expires_at': Decimal(str(tokens['expires_at'])),
-                ':scope': tokens['scope'],
-                ':token_type': tokens['token_type'],
-                ':user_id': tokens['user_id']
-            }
+        Returns:
+            fitbit.Fitbit: A client that refreshes ahead of expires_at and saves refreshed tokens to DynamoDB
+        """
+        expires_at = user_data.get('expires_at')
+        # Only the token state is built per participant, see Fitbit.for_token
+        return fitbit.Fitbit.for_token(
+            self.client_id,
+            self.client_secret,
+            access_token=user_data['access_token'],
+            refresh_token=user_data['refresh_token'],
+            expires_at=float(expires_at) if expires_at is not None else None,
+            refresh_cb=lambda token: self._save_tokens_to_dynamodb(participant_id, token),
+            refresh_lease=lambda old_token, fetch: self._refresh_with_lease(participant_id, old_token, fetch),
+            rate_limit_key=participant_id,
+            oauth2=True
         )
-        print(f"Tokens for participant {participant_id} updated in DynamoDB.")
-        logging.info(f"Tokens with following information {tokens} for participant {participant_id} updated in DynamoDB.")
+
+    def _refresh_with_lease(self, participant_id, old_token, fetch, timeout=30):
+        """Refresh a participant's token at most once across processes.
+        Fitbit refresh tokens are single use, so a process first claims a lease on the participant's
+        DynamoDB item, conditional on the item still holding the old refresh token. Processes that
+        lose the claim wait for the winner's token instead of spending the old refresh token again.
+
+        Args:
+            participant_id (str): The ID of the participant
+            old_token (dict): The token that needs refreshing
+            fetch (callable): Refreshes the token with Fitbit and saves it through refresh_cb
+            timeout (int, optional): Seconds to wait for another process's refresh. Defaults to 30.
+
+        Returns:
+            dict: The new token
+        """
+        table = self._get_table()
+        old_refresh_token = old_token.get('refresh_token')
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            try:
+                table.update_item(
+                    Key={'participant_id': participant_id},
+                    UpdateExpression="SET refresh_lock_owner = :owner, refresh_lock_expires = :expires",
+                    ConditionExpression="refresh_token = :old_refresh_token AND (attribute_not_exists(refresh_lock_expires) OR refresh_lock_expires < :now)",
+                    ExpressionAttributeValues={
+                        ':owner': self.lease_owner,
+                        ':expires': Decimal(str(now + self.refresh_lease_seconds)),
+                        ':old_refresh_token': old_refresh_token,
+                        ':now': Decimal(str(now))
+                    }
+                )
+                logging.info(f"Claimed token refresh lease for participant {participant_id}")
+                # fetch saves the new token through refresh_cb, which writes it over old_refresh_token
+                self._refreshing.old_refresh_token = old_refresh_token
+                try:
+                    return fetch()
+                finally:
+                    self._refreshing.old_refresh_token = None
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+
+            # Another process holds the lease or has already rotated the token
+            item = table.get_item(Key={'participant_id': participant_id}, ConsistentRead=True).get('Item', {})
+            if item.get('refresh_token') and item['refresh_token'] != old_refresh_token:
+                logging.info(f"Reusing token refreshed by another process for participant {participant_id}")
+                token = dict(old_token)
+                token.update({
+                    'access_token': item['access_token'],
+                    'refresh_token': item['refresh_token'],
+                    'expires_at': float(item['expires_at']) if item.get('expires_at') is not None else None
+                })
+                return token
+            if now > deadline:
+                raise TimeoutError(f"Timed out waiting for the token refresh of participant {participant_id}")
+            time.sleep(0.5)
+
+    def _get_session(self):
+        """Get the boto3 session, creating it on first use
+
+        Returns:
+            boto3.Session: The session shared by every AWS call of this instance
+        """
+        if self._aws_session is None:
+            with self._aws_lock:
+                if self._aws_session is None:
+                    self._aws_session = boto3.Session(
+                        aws_access_key_id=self.aws_access_key_id,
+                        aws_secret_access_key=self.aws_secret_access_key,
+                        region_name=self.region_name
+                    )
+        return self._aws_session
+
+    def _get_table(self):
+        """Get the participant store, creating the session, resource and table handle on first use.
+        Creation is locked so worker threads share one handle; the calls made through it go to the
+        thread-safe low-level client. With PARTICIPANT_STORE_PATH set, participants are kept in that
+        local SQLite database instead and no AWS credentials are needed.
+
+        Returns:
+            ParticipantStore: The DynamoDB table AWS_TABLE_NAME, or the local store
+        """
+        if self._table is None:
+            if self.participant_store_path:
+                with self._aws_lock:
+                    if self._table is None:
+                        self._table = LocalParticipantStore(self.participant_store_path)
+                return self._table
+            session = self._get_session()
+            with self._aws_lock:
+                if self._table is None:
+                    self._dynamodb = session.resource("dynamodb", endpoint_url=self.aws_endpoint_url)
+                    self._table = DynamoDBParticipantStore(self._dynamodb.Table(self.aws_table_name))
+        return self._table
+
+    def close(self):
+        """Close the DynamoDB connections and drop the cached session, resource and table handle.
+        The next AWS call creates fresh ones, e.g. after the credentials in the .env file change.
+        """
+        with self._aws_lock:
+            if self._dynamodb is not None:
+                self._dynamodb.meta.client.close()
+            if self._table is not None:
+                self._table.close()
+            self._aws_session = None
+            self._dynamodb = None
+            self._table = None
+
+    reset = close
+
+    @staticmethod
+    def _projection(attributes):
+        """Build the ProjectionExpression arguments for a DynamoDB read
+
+        Args:
+            attributes (tuple): Attribute names to read, or None for whole items
+
+        Returns:
+            dict: Keyword arguments for scan/get_item. Names go through ExpressionAttributeNames
+                so reserved words (e.g. scope) can be projected.
+        """
+        if not attributes:
+            return {}
+        names = {f"#a{i}": attribute for i, attribute in enumerate(attributes)}
+        return {
+            'ProjectionExpression': ", ".join(names),
+            'ExpressionAttributeNames': names
+        }
+
+    def iter_participants(self, attributes=None, total_segments=4):
+        """Stream every participant item in the DynamoDB table.
+        The table is scanned as total_segments parallel segments (Segment/TotalSegments), each on its own
+        thread and each following LastEvaluatedKey until its segment is exhausted, so no participant is
+        dropped once the table passes DynamoDB's 1 MB page size. Items are yielded as soon as any segment
+        returns them, so callers can start on early participants before the scan finishes.
+
+        Args:
+            attributes (tuple, optional): Only read these attributes (ProjectionExpression), which cuts the
+                consumed read capacity and payload. Defaults to None, which reads whole items.
+            total_segments (int, optional): Number of parallel scan segments. Defaults to 4.
+
+        Yields:
+            dict: One participant item at a time, in no particular order
+        """
+        table = self._get_table()
+        items = queue.Queue()
+        segment_done = object()
+
+        def scan_segment(segment):
+            scan_kwargs = {'Segment': segment, 'TotalSegments': total_segments, **self._projection(attributes)}
+            try:
+                while True:
+                    response = table.scan(**scan_kwargs)
+                    for item in response.get('Items', []):
+                        items.put(item)
+                    if 'LastEvaluatedKey' not in response:
+                        break
+                    scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            except Exception as e:
+                items.put(e)
+            finally:
+                items.put(segment_done)
+
+        executor = ThreadPoolExecutor(max_workers=total_segments)
+        for segment in range(total_segments):
+            executor.submit(scan_segment, segment)
+        executor.shutdown(wait=False)
+
+        remaining = total_segments
+        while remaining:
+            item = items.get()
+            if item is segment_done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                logging.error(f"Error scanning DynamoDB table {self.aws_table_name}: {item}")
+                raise item
+            else:
+                yield item
+
+    def refresh_expiring_tokens(self, all_users_data, margin_seconds=300, max_workers=8):
+        """Refresh, in parallel, every participant token that expires within margin_seconds.
+        Run before an extraction so that no request during it fails with an expired token.
+
+        Args:
+            all_users_data (dict): Participant ID to DynamoDB item, as returned by the scan. Refreshed tokens are written back into it.
+            margin_seconds (int, optional): Refresh tokens expiring within this many seconds. Defaults to 300.
+            max_workers (int, optional): Number of refreshes to run at once. Defaults to 8.
+
+        Returns:
+            int: The number of tokens refreshed, which is also the number of failed (401) requests saved
+        """
+        if self.replay:
+            # Replayed extractions don't make requests, so no token has to be valid
+            return 0
+        now = time.time()
+        expiring = [
+            participant_id for participant_id, user_data in all_users_data.items()
+            if user_data.get('access_token') and user_data.get('refresh_token')
+            and user_data.get('expires_at') is not None
+            and float(user_data['expires_at']) <= now + margin_seconds
+        ]
+        if not expiring:
+            logging.info("No participant tokens expire before the extraction, nothing to refresh")
+            return 0
+
+        def refresh(participant_id):
+            user_data = all_users_data[participant_id]
+            token = self._build_client(participant_id, user_data).client.refresh_token()
+            user_data['access_token'] = token['access_token']
+            user_data['refresh_token'] = token['refresh_token']
+            user_data['expires_at'] = Decimal(str(token['expires_at']))
+
+        refreshed = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(refresh, participant_id): participant_id for participant_id in expiring}
+            for future in as_completed(futures):
+                participant_id = futures[future]
+                try:
+                    future.result()
+                    refreshed += 1
+                except Exception as e:
+                    print(f"Error refreshing token for participant {participant_id}: {e}")
+                    logging.error(f"Error refreshing token for participant {participant_id}: {e}")
+
+        print(f"Refreshed {refreshed} of {len(expiring)} expiring tokens before extraction, saving {refreshed} failed requests.")
+        logging.info(f"Refreshed {refreshed} of {len(expiring)} expiring tokens before extraction, saving {refreshed} failed requests.")
+        return refreshed
 
     def delete_user(self, participant_id):
         """Delete user from both JSON files
@@ -177,13 +533,7 @@ class FitbitAuthSimple:
         logging.info(f"delete_user called for participant {participant_id}")
 
         # Delete user from AWS DynamoDB
-        Session = boto3.Session(
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.region_name
-        )
-        dynamodb = Session.resource("dynamodb")
-        table = dynamodb.Table(self.aws_table_name)
+        table = self._get_table()
 
         try:
             table.delete_item(Key={'participant_id': participant_id})
@@ -209,35 +559,21 @@ class FitbitAuthSimple:
         """
         logging.info(f"get_user_steps called for participant {participant_id} from {start_date} to {end_date}")
         # Get tokens for the user through DynamoDB
-        Session = boto3.Session(
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.region_name
-        )
+        table = self._get_table()
 
-        dynamodb = Session.resource("dynamodb")
-        table = dynamodb.Table(self.aws_table_name)
-
-        response = table.get_item(Key={'participant_id': participant_id})
+        response = table.get_item(Key={'participant_id': participant_id}, **self._projection(self.STEPS_DATE_RANGE_ATTRIBUTES))
         tokens = response.get('Item')
-        logging.info(f"Retrieved tokens for participant {participant_id}: {tokens}")
+        logging.info(f"Retrieved tokens for participant {participant_id}")
 
         if not tokens:
             logging.error(f"No tokens found for participant {participant_id}")
             raise ValueError(f"No tokens found for participant {participant_id}")
 
-        client = fitbit.Fitbit(
-            self.client_id,
-            self.client_secret,
-            access_token=tokens['access_token'],
-            refresh_token=tokens['refresh_token'],
-            refresh_cb=lambda token: self._save_tokens_to_dynamodb(participant_id, token),
-            oauth2=True
-        )
+        client = self._build_client(participant_id, tokens)
 
         try:
             if end_date:
-                return client.time_series('activities/steps',
+                return client.time_series_range('activities/steps',
                                         base_date=start_date,
                                         end_date=end_date)
             else:
@@ -262,18 +598,8 @@ class FitbitAuthSimple:
         """
         logging.info(f"extract_all_users_steps_over_date_range called from {start_date} to {end_date}")
         # Read DynamoDB table
-        Session = boto3.Session(
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.region_name
-        )
-
-        dynamodb = Session.resource("dynamodb")
-        table = dynamodb.Table(self.aws_table_name)
-
-        response = table.scan()
-        all_users_data = {item['participant_id']: item for item in response.get('Items', [])}
-        logging.info(f"Retrieved all users data from DynamoDB: {all_users_data}")
+        all_users_data = {item['participant_id']: item for item in self.iter_participants(attributes=self.STEPS_DATE_RANGE_ATTRIBUTES)}
+        logging.info(f"Retrieved {len(all_users_data)} participants from DynamoDB: {sorted(all_users_data)}")
 
         # Lists to store data
         all_data = []
@@ -286,31 +612,29 @@ class FitbitAuthSimple:
         print(f"Extracting data from {start_date} to {end_date}")
         logging.info(f"Extracting data from {start_date} to {end_date}")
 
+        self.refresh_expiring_tokens(all_users_data)
+
+        record_log = SampledLogger(self.log_sample_every)
+        progress = Progress(len(all_users_data))
+
         # Loop through each user
-        for participant_id in all_users_data.items():
-            print(f"Processing participant: {participant_id}")
-            logging.info(f"Processing participant: {participant_id}")
+        for participant_id, user_data in all_users_data.items():
+            logging.debug("Processing participant: %s", participant_id)
             # Get access and refresh tokens through the scan
-            participant_access_token = all_users_data[participant_id].get('access_token')
-            participant_refresh_token = all_users_data[participant_id].get('refresh_token')
-            logging.info(f"Retrieved tokens for participant {participant_id}: {participant_access_token}, {participant_refresh_token}")
+            participant_access_token = user_data.get('access_token')
+            participant_refresh_token = user_data.get('refresh_token')
 
             if not participant_access_token or not participant_refresh_token:
                 print(f"No tokens found for participant {participant_id}")
                 logging.warning(f"No tokens found for participant {participant_id}")
+                progress.update(failed=True)
                 continue
 
-            client = fitbit.Fitbit(
-                self.client_id,
-                self.client_secret,
-                access_token=participant_access_token,
-                refresh_token=participant_refresh_token,
-                refresh_cb=lambda token: self._save_tokens_to_dynamodb(participant_id, token),
-                oauth2=True
-            )
+            client = self._build_client(participant_id, user_data)
 
             try:
-                steps_data = client.time_series('activities/steps', base_date=start_date, end_date=end_date)
+                rows = len(all_data)
+                steps_data = client.time_series_range('activities/steps', base_date=start_date, end_date=end_date)
                 for day in steps_data['activities-steps']:
                     date = datetime.strptime(day['dateTime'], '%Y-%m-%d')
                     if start <= date <= end:
@@ -319,12 +643,12 @@ class FitbitAuthSimple:
                             'date': day['dateTime'],
                             'steps': int(day['value'])
                         })
-                    # Debug print
-                    print(f"User: {participant_id}, Date: {day['dateTime']}, Steps: {day['value']}")
-                    logging.info(f"User: {participant_id}, Date: {day['dateTime']}, Steps: {day['value']}")
+                    record_log.debug("User: %s, Date: %s, Steps: %s", participant_id, day['dateTime'], day['value'])
+                progress.update(rows=len(all_data) - rows)
             except Exception as e:
                 print(f"Error retrieving data for user {participant_id}: {e}")
                 logging.error(f"Error retrieving data for user {participant_id}: {e}")
+                progress.update(failed=True)
 
         # Get current date and time for the filename
         current_time = datetime.now().strftime("%Y%m%d_%H%M")
@@ -342,286 +666,646 @@ class FitbitAuthSimple:
             logging.warning("No data found for the specified date range")
             return None
 
-    def extract_all_users_steps_study_period(self):
+    def extract_all_users_steps_study_period(self, max_workers=None, incremental=False, export_csv=True, return_df=True, resume=None):
 
         """Extract steps data for all users according to the study period defined in the dynamoDB table
 
+        Args:
+            max_workers (int, optional): Number of participants to fetch at once. Defaults to EXTRACTION_WORKERS (16).
+            incremental (bool, optional): Only fetch the days after each participant's watermark (minus RESYNC_DAYS)
+                and merge them into the data store. Defaults to False.
+            export_csv (bool, optional): Also export the data as a CSV file. Defaults to True.
+            return_df (bool, optional): Build and return a DataFrame of the data. Turn off to keep memory flat for
+                large cohorts, the number of rows extracted is returned instead. Defaults to True.
+            resume (str, optional): The run ID of an interrupted run to resume. Its options are used instead of the ones
+                given, and the participants it finished are skipped. Defaults to None (a new run).
+
         Returns:
-            pd.DataFrame: A DataFrame containing steps data for all users according to the study period
+            pd.DataFrame: A DataFrame containing steps data for all users according to the study period (or an int, see return_df)
         """
 
         logging.info("extract_all_users_steps_study_period called to extract steps data for all users according to the study period")
-        # Get information from dynamoDB
-        Session = boto3.Session(
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.region_name
-        )
 
-        dynamodb = Session.resource("dynamodb")
-        table = dynamodb.Table(self.aws_table_name)
+        def fetch_rows(client, participant_id, user_data, start_date, end_date, record_log):
+            rows = []
+            steps_data = client.time_series_range('activities/steps', base_date=start_date, end_date=end_date)
+            for day in steps_data['activities-steps']:
+                rows.append({
+                    'user_id': participant_id,
+                    'wave_number': user_data['wave_number'],
+                    'date': day['dateTime'],
+                    'steps': day['value']
+                })
+                record_log.debug("User: %s, Date: %s, Steps: %s", participant_id, day['dateTime'], day['value'])
+            # The window ends today, the rest of the study period is filled with NaN without asking Fitbit
+            for date in self._days_after(end_date, user_data['study_end_date']):
+                rows.append({
+                    'user_id': participant_id,
+                    'wave_number': user_data['wave_number'],
+                    'date': date,
+                    'steps': float('nan')
+                })
+            return rows
 
-        response = table.scan()
-        all_users_data = {item['participant_id']: item for item in response.get('Items', [])}
-        logging.info(f"Retrieved all users data from DynamoDB: {all_users_data}")
+        def postprocess(df, all_users_data):
+            df['steps'] = df['steps'].astype(float)
+            self._mask_future_days(df, ['steps'])
+            return df
 
-        # Lists to store data
-        all_data = []
+        return self._extract_study_period('steps', self.STEPS_ATTRIBUTES, self.STEPS_COLUMNS, fetch_rows, postprocess,
+                                          max_workers=max_workers, incremental=incremental, export_csv=export_csv,
+                                          return_df=return_df, resume=resume)
 
-        # Loop through each user
-        for participant_id, user_data in all_users_data.items():
-            print(f"Processing user: {participant_id}")
-            user_access_token = user_data.get('access_token')
-            user_refresh_token = user_data.get('refresh_token')
-            logging.info(f"Retrieved tokens for user {participant_id}: {user_access_token}, {user_refresh_token}")
-
-            if not user_access_token or not user_refresh_token:
-                print(f"No tokens found for user {participant_id}")
-                logging.error(f"No tokens found for user {participant_id}")
-                continue
+    def extract_all_users_sleepData_study_period(self, max_workers=None, incremental=False, export_csv=True, return_df=True, resume=None):
+        """Extract sleep data for all users according to the study period defined in the info file
 
-            client = fitbit.Fitbit(
-                self.client_id,
-                self.client_secret,
-                access_token=user_access_token,
-                refresh_token=user_refresh_token,
-                refresh_cb=lambda token: self._save_tokens_to_dynamodb(participant_id, token),
-                oauth2=True
-            )
+        Args:
+            max_workers (int, optional): Number of participants to fetch at once. Defaults to EXTRACTION_WORKERS (16).
+            incremental (bool, optional): Only fetch the days after each participant's watermark (minus RESYNC_DAYS)
+                and merge them into the data store. Defaults to False.
+            export_csv (bool, optional): Also export the data as a CSV file. Defaults to True.
+            return_df (bool, optional): Build and return a DataFrame of the data. Turn off to keep memory flat for
+                large cohorts, the number of rows extracted is returned instead. Defaults to True.
+            resume (str, optional): The run ID of an interrupted run to resume. Its options are used instead of the ones
+                given, and the participants it finished are skipped. Defaults to None (a new run).
 
-            try:
-                steps_data = client.time_series('activities/steps', base_date=all_users_data[participant_id]['study_start_date'], end_date=all_users_data[participant_id]['study_end_date'])
-                for day in steps_data['activities-steps']:
-                    date = datetime.strptime(day['dateTime'], '%Y-%m-%d')
-                    if date > datetime.now():
-                        steps = float('nan')
-                    else:
-                        steps = int(day['value'])
-                    all_data.append({
-                        'user_id': participant_id,
-                        'wave_number': user_data['wave_number'],
-                        'date': day['dateTime'],
-                        'steps': steps
-                    })
-                    # Debug print
-                    print(f"User: {participant_id}, Date: {day['dateTime']}, Steps: {day['value']}")
-                    logging.info(f"User: {participant_id}, Date: {day['dateTime']}, Steps: {day['value']}")
-            except Exception as e:
-                print(f"Error retrieving data for user {participant_id}: {e}")
-                logging.error(f"Error retrieving data for user {participant_id}: {e}")
+        Returns:
+            pd.DataFrame: A DataFrame containing sleep data for all users according to the study period (or an int, see return_df)
+        """
+        logging.info("extract_all_users_sleepData_study_period called to extract sleep data for all users according to the study period")
 
-        # Get current date and time for the filename
-        current_time = datetime.now().strftime("%Y%m%d_%H%M")
+        def fetch_rows(client, participant_id, user_data, start_date, end_date, record_log):
+            rows = []
+            sleep_data = client.time_series_range('sleep', base_date=start_date, end_date=end_date)
+            # Save all sleep data as a JSON file
+            #with open(f'sleep_data_{user_id}.json', 'w') as f:
+                #json.dump(sleep_data, f)
+            for day in sleep_data['sleep']:
+                duration = day['duration']
+                efficiency = day['efficiency']
+                is_main_sleep = day.get('isMainSleep', None)
+                logType = day.get('logType', None)
+                startTime = day.get('startTime', None)
+                rows.append({
+                    'user_id': participant_id,
+                    'wave_number': user_data['wave_number'],
+                    'date': day['dateOfSleep'],
+                    'duration (ms)': duration,
+                    'efficiency': efficiency,
+                    'is_main_sleep': is_main_sleep,
+                    'log_type': logType,
+                    'start_time': startTime
+                })
+                record_log.debug("User: %s, Date: %s, Duration: %s, Efficiency: %s, isMainSleep: %s, logType: %s, startTime: %s",
+                                 participant_id, day['dateOfSleep'], duration, efficiency, is_main_sleep, logType, startTime)
+            return rows
 
-        # Create DataFrame
-        if all_data:
-            df = pd.DataFrame(all_data)
-            df['steps'] = df['steps'].astype(float)
-            output_file = f'steps_data_study_period_{current_time}.csv'
-            df.to_csv(output_file, index=False)
-            print(f"Data exported to {output_file}")
-            logging.info(f"Data exported to {output_file}")
+        def postprocess(df, all_users_data):
+            df['duration (ms)'] = df['duration (ms)'].astype(float)
+            df['efficiency'] = df['efficiency'].astype(float)
+            self._mask_future_days(df, ['duration (ms)', 'efficiency', 'is_main_sleep', 'log_type', 'start_time'])
+            # Convert duration from ms to mins
+            df['duration (mins)'] = df['duration (ms)'] / 60000
             return df
-        else:
-            print("No data found for the specified date range")
-            logging.warning("No data found for the specified date range")
-            return None
 
-    def extract_all_users_sleepData_study_period(self):
-        """Extract sleep data for all users according to the study period defined in the info file
-        
+        return self._extract_study_period('sleep', self.SLEEP_ATTRIBUTES, self.SLEEP_COLUMNS, fetch_rows, postprocess,
+                                          max_workers=max_workers, incremental=incremental, export_csv=export_csv,
+                                          return_df=return_df, resume=resume, csv_timestamp="%Y%m%d_%H%M%S")
+
+    def extract_all_users_activity_study_period(self, max_workers=None, incremental=False, export_csv=True, return_df=True, resume=None):
+        """Extract activity data for all users according to the study period defined in the info file
+
+        Args:
+            max_workers (int, optional): Number of participants to fetch at once. Defaults to EXTRACTION_WORKERS (16).
+            incremental (bool, optional): Only fetch the days after each participant's watermark (minus RESYNC_DAYS)
+                and merge them into the data store. Defaults to False.
+            export_csv (bool, optional): Also export the data as a CSV file. Defaults to True.
+            return_df (bool, optional): Build and return a DataFrame of the data. Turn off to keep memory flat for
+                large cohorts, the number of rows extracted is returned instead. Defaults to True.
+            resume (str, optional): The run ID of an interrupted run to resume. Its options are used instead of the ones
+                given, and the participants it finished are skipped. Defaults to None (a new run).
+
         Returns:
-            pd.DataFrame: A DataFrame containing sleep data for all users according to the study period
+            pd.DataFrame: A DataFrame containing activity data for all users according to the study period (or an int, see return_df)
         """
-        logging.info("extract_all_users_sleepData_study_period called to extract sleep data for all users according to the study period")
-        # Read dynamoDB table
-        Session = boto3.Session(
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.region_name
-        )
+        logging.info("extract_all_users_activity_study_period called to extract activity data for all users according to the study period")
 
-        dynamodb = Session.resource("dynamodb")
-        table = dynamodb.Table(self.aws_table_name)
+        def fetch_rows(client, participant_id, user_data, start_date, end_date, record_log):
+            """Get activity list for a user between dates"""
+            # Stream the activity log page by page, stopping after the study end date (or today)
+            before_date = (datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+            activity_log = client.iter_activity_PACE_loglist(afterDate=start_date, beforeDate=before_date)
+
+            # Organize data
+            rows = []
+            for activities in activity_log:
+                row = {
+                    'user_id': participant_id,
+                    'wave_number': user_data['wave_number'],
+                    'date': activities['startTime'].split('T')[0],
+                    'activityName': activities['activityName'],
+                    'activityTypeId': activities['activityTypeId'],
+                    'duration (ms)': activities['duration'],
+                    'duration (mins)': activities['duration'] / 60000,
+                    'originalDuration (ms)': activities['originalDuration'],
+                    'originalDuration (mins)': activities['originalDuration'] / 60000,
+                    'logType': activities['logType'],
+                    'manualValuesSpecified_steps': activities['manualValuesSpecified']['steps'],
+                    'startTime': activities['startTime'],
+                    'lastModified': activities['lastModified']
+                }
+                # Add activity levels as separate columns
+                for level in activities['activityLevel']:
+                    row[level['name']] = level['minutes']
+                rows.append(row)
+            return rows
+
+        def postprocess(df, all_users_data):
+            # Drop the activities outside each participant's study period
+            return df[self._in_study_window(df, all_users_data)]
+
+        return self._extract_study_period('activity', self.ACTIVITY_ATTRIBUTES, self.ACTIVITY_COLUMNS, fetch_rows, postprocess,
+                                          max_workers=max_workers, incremental=incremental, export_csv=export_csv,
+                                          return_df=return_df, resume=resume)
+
+    def _extract_study_period(self, resource, attributes, columns, fetch_rows, postprocess, max_workers=None, incremental=False,
+                              export_csv=True, return_df=True, resume=None, csv_timestamp="%Y%m%d_%H%M"):
+        """Run a study period extraction: scan the cohort, plan each participant's window, fetch the participants in
+        parallel and stream their rows to the data store and CSV file, with a checkpoint journal and watermarks
 
-        response = table.scan()
-        all_users_data = {item['participant_id']: item for item in response.get('Items', [])}
-        logging.info(f"Retrieved all users data from DynamoDB: {all_users_data}")
+        Args:
+            resource (str): 'steps', 'sleep' or 'activity', also the prefix of the CSV file name
+            attributes (tuple): The participant attributes to scan
+            columns (tuple): The output columns, in order
+            fetch_rows (callable): Fetches one participant's window and returns its rows, called as
+                fetch_rows(client, participant_id, user_data, start_date, end_date, record_log)
+            postprocess (callable): Called as postprocess(df, all_users_data) on every batch of rows, returns the batch
+            csv_timestamp (str, optional): strftime format of the timestamp in the CSV file name. Defaults to "%Y%m%d_%H%M".
+            Others: see extract_all_users_steps_study_period
 
-        # Lists to store data
-        all_data = []
+        Returns:
+            pd.DataFrame: The extracted data (or the number of rows extracted if return_df is False)
+        """
+        # Get information from dynamoDB
+        all_users_data = self._scan_cohort(attributes)
+        logging.info(f"Retrieved {len(all_users_data)} participants from DynamoDB: {sorted(all_users_data)}")
 
-        # Loop through each user
-        for participant_id, user_data in all_users_data.items():
-            print(f"Processing user: {participant_id}")
-            logging.info(f"Processing user: {participant_id}")
-            if not user_data:
-                print(f"No tokens found for user {participant_id}")
-                logging.error(f"No tokens found for user {participant_id}")
-                continue
+        self.refresh_expiring_tokens(all_users_data)
 
-            try:
-                client = fitbit.Fitbit(
-                    self.client_id,
-                    self.client_secret,
-                    access_token=user_data['access_token'],
-                    refresh_token=user_data['refresh_token'],
-                refresh_cb=lambda token: self._save_tokens_to_dynamodb(participant_id, token),
-                oauth2=True
-            )
-            except Exception as e:
-                print(f"Error creating Fitbit client for user {participant_id}: {e}")
-                logging.error(f"Error creating Fitbit client for user {participant_id}: {e}")
-                continue
+        # Get current date and time for the filename
+        current_time = datetime.now().strftime(csv_timestamp)
+        journal = self._start_run(resource, resume, incremental=incremental, export_csv=export_csv,
+                                  csv_path=os.path.join(self.output_dir, f'{resource}_data_study_period_{current_time}.csv') if export_csv and not incremental else None)
+        incremental, export_csv = journal.options['incremental'], journal.options['export_csv']
+
+        watermarks = WatermarkStore(self.watermark_path) if incremental else None
+        fetch_starts = {}
+        # A resumed run keeps the windows it planned when it started
+        windows = journal.plan(self._plan_windows(resource, all_users_data, watermarks))
+        windows = {participant_id: window for participant_id, window in windows.items() if participant_id in all_users_data}
+        pending = self._pending_participants(resource, all_users_data, windows, journal, watermarks)
+
+        record_log = SampledLogger(self.log_sample_every)
+
+        def extract_participant(participant_id, user_data):
+            logging.debug("Processing user: %s", participant_id)
+            if not user_data.get('access_token') or not user_data.get('refresh_token'):
+                # A failure rather than no rows, so the data store keeps what it has for the participant
+                raise ValueError(f"No tokens found for user {participant_id}")
+
+            client = self._build_client(participant_id, user_data)
+            start_date, end_date = windows[participant_id]
+            rows = fetch_rows(client, participant_id, user_data, start_date, end_date, record_log)
+            if incremental:
+                fetch_starts[participant_id] = start_date
+                watermarks.set(resource, participant_id, end_date)
+            return rows
+
+        sink = ExtractionSink(resource, self.data_store, columns, csv_path=journal.options['csv_path'],
+                              keep_frame=return_df and not incremental, fetched_from=fetch_starts if incremental else None,
+                              journal=journal, windows=windows)
+        self._stream_extraction(pending.items(), extract_participant, lambda df: postprocess(df, all_users_data), sink, max_workers)
+        sink.finish()
+        journal.finish()
+
+        if incremental:
+            return self._finish_incremental(sink, watermarks, export_csv, return_df)
+        return self._finish_extraction(sink, return_df, skipped=[participant_id for participant_id in windows if participant_id not in pending])
+
+    @staticmethod
+    def _in_study_window(df, all_users_data):
+        """Check which rows fall inside their participant's study period, for the whole frame at once
 
-            try:
-                sleep_data = client.time_series('sleep', base_date=user_data['study_start_date'], end_date=user_data['study_end_date'])
-                # Save all sleep data as a JSON file
-                #with open(f'sleep_data_{user_id}.json', 'w') as f:
-                    #json.dump(sleep_data, f)
-                for day in sleep_data['sleep']:
-                    date = datetime.strptime(day['dateOfSleep'], '%Y-%m-%d')
-                    if date > datetime.now():
-                        duration = float('nan')
-                        efficiency = float('nan')
-                        is_main_sleep = None
-                        logType = None
-                        startTime = None
-                    else:
-                        duration = day['duration']
-                        efficiency = day['efficiency']
-                        is_main_sleep = day.get('isMainSleep', None)
-                        logType = day.get('logType', None)
-                        startTime = day.get('startTime', None)
-                    all_data.append({
-                        'user_id': participant_id,
-                        'wave_number': user_data['wave_number'],
-                        'date': day['dateOfSleep'],
-                        'duration (ms)': duration,
-                        'efficiency': efficiency,
-                        'is_main_sleep': is_main_sleep,
-                        'log_type': logType,
-                        'start_time': startTime
-                    })
-                    # Debug print
-                    print(f"User: {participant_id}, Date: {day['dateOfSleep']}, Duration: {duration}, Efficiency: {efficiency}, isMainSleep: {is_main_sleep}, logType: {logType}, startTime: {startTime}")
-                    logging.info(f"User: {participant_id}, Date: {day['dateOfSleep']}, Duration: {duration}, Efficiency: {efficiency}, isMainSleep: {is_main_sleep}, logType: {logType}, startTime: {startTime}")
-            except Exception as e:
-                print(f"Error retrieving data for user {participant_id}: {e}")
-                logging.error(f"Error retrieving data for user {participant_id}: {e}")
+        Args:
+            df (pd.DataFrame): Rows with user_id and date ('YYYY-MM-DD') columns
+            all_users_data (dict): Participant data with study_start_date and study_end_date, keyed by participant ID
 
-        # Create DataFrame
-        if all_data:
-            df = pd.DataFrame(all_data)
-            df['duration (ms)'] = df['duration (ms)'].astype(float)
-            # Convert duration from ms to mins
-            df['duration (mins)'] = df['duration (ms)'] / 60000
-            df['efficiency'] = df['efficiency'].astype(float)
-            current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-            output_file = f'sleep_data_study_period_{current_time}.csv'
-            df.to_csv(output_file, index=False)
+        Returns:
+            np.ndarray: A boolean mask, True for the rows inside the study period
+        """
+        windows = pd.DataFrame(
+            [(participant_id, user_data['study_start_date'], user_data['study_end_date'])
+             for participant_id, user_data in all_users_data.items()],
+            columns=['user_id', 'study_start_date', 'study_end_date'])
+        windows['study_start_date'] = pd.to_datetime(windows['study_start_date'], format='%Y-%m-%d')
+        windows['study_end_date'] = pd.to_datetime(windows['study_end_date'], format='%Y-%m-%d')
+
+        # A left merge keeps the rows of df in order, so the mask lines up with it
+        merged = df[['user_id']].merge(windows, on='user_id', how='left')
+        dates = pd.to_datetime(df['date'], format='%Y-%m-%d').to_numpy()
+        return ((dates >= merged['study_start_date'].to_numpy()) & (dates <= merged['study_end_date'].to_numpy()))
+
+    @staticmethod
+    def _mask_future_days(df, columns):
+        """Blank out the values of days that haven't happened yet, in place
+
+        Args:
+            df (pd.DataFrame): Rows with a date ('YYYY-MM-DD') column
+            columns (list): The columns to blank out, numeric ones become NaN and the others None
+        """
+        future = (pd.to_datetime(df['date'], format='%Y-%m-%d') > datetime.now()).to_numpy()
+        if not future.any():
+            return
+        for column in columns:
+            if pd.api.types.is_float_dtype(df[column]):
+                df.loc[future, column] = float('nan')
+            else:
+                df[column] = df[column].astype(object)
+                df.loc[future, column] = None
+
+    def extract(self, resource, **kwargs):
+        """Run the study period extraction of a resource
+
+        Args:
+            resource (str): 'steps', 'sleep' or 'activity'
+            **kwargs: Passed on to the extraction, e.g. incremental=True
+
+        Returns:
+            pd.DataFrame: The extracted data (or the number of rows extracted if return_df is False)
+        """
+        extract = {
+            'steps': self.extract_all_users_steps_study_period,
+            'sleep': self.extract_all_users_sleepData_study_period,
+            'activity': self.extract_all_users_activity_study_period,
+        }[resource]
+        return extract(**kwargs)
+
+    def resume_run(self, run_id, return_df=False):
+        """Resume an interrupted extraction run, only fetching the participants it didn't finish
+
+        Args:
+            run_id (str): The run ID printed when the run started
+            return_df (bool, optional): Build and return a DataFrame of the data. Defaults to False.
+
+        Returns:
+            pd.DataFrame: The extracted data (or the number of rows extracted if return_df is False)
+        """
+        resource = RunJournal.open(run_id, self.runs_path).resource
+        return self.extract(resource, resume=run_id, return_df=return_df)
+
+    def use_shard(self, index, count):
+        """Only extract one shard of the participants, so an extraction can be split over processes or machines.
+        Participants are assigned to shards by a stable hash of their ID (see shard_of). The shard writes
+        its own data store, CSV files, watermarks and run journals in EXTRACTION_SHARDS_PATH/shard-I-of-N,
+        and merge_shards combines the shards afterwards. A shard starts without watermarks, so its first
+        incremental run fetches its participants' whole study period.
+
+        Args:
+            index (int): The shard, from 1 to count
+            count (int): The number of shards
+        """
+        self.shard = (index, count)
+        self.output_dir = shard_dir(self.shards_path, index, count)
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.data_store = FitbitDataStore(os.path.join(self.output_dir, os.path.basename(self.data_store.root)))
+        self.watermark_path = os.path.join(self.output_dir, os.path.basename(self.watermark_path))
+        self.runs_path = os.path.join(self.output_dir, os.path.basename(self.runs_path))
+        if self.metrics_path:
+            self.metrics_path = os.path.join(self.output_dir, os.path.basename(self.metrics_path))
+        logging.info(f"Extracting shard {index}/{count} into {self.output_dir}")
+
+    def merge_shards(self, resource, count, export_csv=True):
+        """Merge the outputs of the shards of an extraction into the data store (and watermarks)
+
+        Args:
+            resource (str): 'steps', 'sleep' or 'activity'
+            count (int): The number of shards, their outputs are read from EXTRACTION_SHARDS_PATH
+            export_csv (bool, optional): Also export the merged participants to a CSV file. Defaults to True.
+
+        Returns:
+            int: The number of participants whose partitions changed in the data store
+        """
+        watermarks = WatermarkStore(self.watermark_path)
+        merged = []
+        changed = 0
+        for index in range(1, count + 1):
+            directory = shard_dir(self.shards_path, index, count)
+            if not os.path.isdir(directory):
+                print(f"No outputs found for shard {index}/{count} in {directory}")
+                logging.warning(f"No outputs found for shard {index}/{count} in {directory}")
+                continue
+            shard_store = FitbitDataStore(os.path.join(directory, os.path.basename(self.data_store.root)))
+            merged += shard_store.participants(resource)
+            changed += self.data_store.merge(resource, shard_store)
+            shard_watermarks = os.path.join(directory, os.path.basename(self.watermark_path))
+            if os.path.exists(shard_watermarks):
+                watermarks.update(WatermarkStore(shard_watermarks))
+        watermarks.save()
+        print(f"Merged {len(merged)} participants from {count} shards, {changed} changed in the data store in {self.data_store.root}")
+        logging.info(f"Merged {len(merged)} participants from {count} shards, {changed} changed in the data store in {self.data_store.root}")
+
+        if export_csv and merged:
+            output_file = os.path.join(self.output_dir, f"{resource}_data_study_period_{datetime.now().strftime('%Y%m%d_%H%M')}.csv")
+            self.data_store.to_csv(resource, output_file, user_id=merged)
             print(f"Data exported to {output_file}")
             logging.info(f"Data exported to {output_file}")
-            return df
+        return changed
 
-    def extract_all_users_activity_study_period(self):
-        """Extract activity data for all users according to the study period defined in the info file
+    def _scan_cohort(self, attributes):
+        """Scan the participants to extract, only the ones in this process's shard if use_shard was called
+
+        Args:
+            attributes (tuple): The attributes to read, see iter_participants
 
         Returns:
-            pd.DataFrame: A DataFrame containing activity data for all users according to the study period
+            dict: Participant items keyed by participant ID
         """
-        logging.info("extract_all_users_activity_study_period called to extract activity data for all users according to the study period")
-        # Access AWS DynamoDB to get all users data
-        Session = boto3.Session(
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.region_name
-        )
-        dynamodb = Session.resource("dynamodb")
-        table = dynamodb.Table(self.aws_table_name)
-        response = table.scan()
-        all_users_data = {item['participant_id']: item for item in response['Items']}
-        logging.info(f"Retrieved all users data from DynamoDB: {all_users_data}")
+        if self.shard is None:
+            return {item['participant_id']: item for item in self.iter_participants(attributes=attributes)}
+        index, count = self.shard
+        return {item['participant_id']: item for item in self.iter_participants(attributes=attributes)
+                if shard_of(item['participant_id'], count) == index}
 
-        # Lists to store data
-        all_data = []
+    def _start_run(self, resource, resume=None, **options):
+        """Start the checkpoint journal of a new extraction run, or reopen the journal of an interrupted one
 
-        # Loop through each user
+        Args:
+            resource (str): The resource the run extracts, e.g. 'steps'
+            resume (str, optional): The run ID to resume. Defaults to None (a new run).
+            **options: The options of a new run, kept in its journal
+
+        Returns:
+            RunJournal: The journal of the run
+        """
+        if resume:
+            journal = RunJournal.open(resume, self.runs_path)
+            if journal.resource != resource:
+                raise ValueError(f"Run {resume} extracted {journal.resource} data, not {resource}")
+            print(f"Resuming run {resume}, {len(journal.done)} participants were already done")
+            logging.info(f"Resuming run {resume}, {len(journal.done)} participants were already done")
+        else:
+            journal = RunJournal.start(resource, self.runs_path, **options)
+            print(f"Run ID: {journal.run_id} (if the run is interrupted, continue it with --resume {journal.run_id})")
+            logging.info(f"Started {resource} extraction run {journal.run_id}")
+        return journal
+
+    def _plan_windows(self, resource, all_users_data, watermarks=None):
+        """Work out the dates to fetch for each participant. A window starts at the study start (or after
+        the watermark) and ends at the study end or today, whichever is earlier, so days that haven't
+        happened yet are never requested. When replaying from the archive, today is the last day archived
+        for the participant instead, so a replay on a later day asks for exactly the days it has. Participants with nothing to fetch are left out: the ones whose
+        study hasn't started, and in incremental runs the ones whose study ended more than RESYNC_DAYS
+        ago and whose watermark is past the study end.
+
+        Args:
+            resource (str): The resource, e.g. 'steps'
+            all_users_data (dict): Participant data with study_start_date and study_end_date, keyed by participant ID
+            watermarks (WatermarkStore, optional): Start after the watermarks instead of at the study start. Defaults to None.
+
+        Returns:
+            dict: (start_date, end_date) in 'YYYY-MM-DD' format, keyed by participant ID
+        """
+        today = datetime.now().strftime('%Y-%m-%d')
+        resync_cutoff = (datetime.now() - timedelta(days=self.resync_days)).strftime('%Y-%m-%d')
+        windows = {}
+        not_started = []
+        finished = []
+        not_archived = []
         for participant_id, user_data in all_users_data.items():
-            print(f"Processing user: {participant_id}")
-            # Get tokens for the user through the scan
-            access_token = user_data.get('access_token')
-            refresh_token = user_data.get('refresh_token')
-            logging.info(f"Retrieved tokens for user {participant_id}: {access_token}, {refresh_token}")
-            
-            if not access_token or not refresh_token:
-                print(f"No tokens found for user {participant_id}")
-                logging.error(f"No tokens found for user {participant_id}")
+            start_date = user_data.get('study_start_date')
+            end_date = user_data.get('study_end_date')
+            if not start_date or not end_date:
+                print(f"No study period found for user {participant_id}")
+                logging.error(f"No study period found for user {participant_id}")
+                continue
+            end_date = min(end_date, today)
+            if self.replay:
+                last_archived = fitbit.Fitbit.archive.last_day(participant_id, self.ARCHIVE_ENDPOINTS[resource])
+                if last_archived is None:
+                    not_archived.append(participant_id)
+                    continue
+                end_date = min(end_date, last_archived)
+            if start_date > end_date:
+                not_started.append(participant_id)
                 continue
+            if watermarks is not None:
+                watermark = watermarks.get(resource, participant_id)
+                if watermark is not None and watermark >= end_date and end_date < resync_cutoff:
+                    finished.append(participant_id)
+                    continue
+                start_date = watermarks.fetch_start(resource, participant_id, start_date, self.resync_days)
+            windows[participant_id] = (start_date, end_date)
+
+        if not_started:
+            logging.info(f"Skipping {len(not_started)} participants whose study hasn't started: {sorted(not_started)}")
+        if finished:
+            logging.info(f"Skipping {len(finished)} participants whose study period is fully extracted: {sorted(finished)}")
+        if not_archived:
+            print(f"Skipping {len(not_archived)} participants with no archived {resource} responses")
+            logging.warning(f"Skipping {len(not_archived)} participants with no archived {resource} responses: {sorted(not_archived)}")
+        return windows
+
+    @staticmethod
+    def _days_after(end_date, study_end_date):
+        """List the days after a fetch window up to the study end, the days that haven't happened yet
 
-            try:
-                client = fitbit.Fitbit(
-                    self.client_id,
-                    self.client_secret,
-                    access_token=access_token,
-                    refresh_token=refresh_token,
-                    refresh_cb=lambda token: self._save_tokens_to_dynamodb(participant_id, token),
-                    oauth2=True
-                )
+        Args:
+            end_date (str): The last fetched date in 'YYYY-MM-DD' format
+            study_end_date (str): The study end date in 'YYYY-MM-DD' format
 
-                """Get activity list for a user between dates"""
-                #Get activity data:
-                activity_data = client.activity_PACE_loglist(afterDate=user_data['study_start_date'])
-                
-                # Organize data
-                rows = []
-                for activities in activity_data["activities"]:
-                    row = {
-                        'user_id': participant_id,
-                        'wave_number': user_data['wave_number'],
-                        'date': activities['startTime'].split('T')[0],
-                        'activityName': activities['activityName'],
-                        'activityTypeId': activities['activityTypeId'],
-                        'duration (ms)': activities['duration'],
-                        'duration (mins)': activities['duration'] / 60000,
-                        'originalDuration (ms)': activities['originalDuration'],
-                        'originalDuration (mins)': activities['originalDuration'] / 60000,
-                        'logType': activities['logType'],
-                        'manualValuesSpecified_steps': activities['manualValuesSpecified']['steps'],
-                        'startTime': activities['startTime'],
-                        'lastModified': activities['lastModified']
-                    }
-                    # Add activity levels as separate columns
-                    for level in activities['activityLevel']:
-                        row[level['name']] = level['minutes']
-                    rows.append(row)
-                all_data.extend(rows)
-            except Exception as e:
-                print(f"Error retrieving data for user {participant_id}: {e}")
-                logging.error(f"Error retrieving data for user {participant_id}: {e}")
-            
-        # Create DataFrame
-        if all_data:
-            df = pd.DataFrame(all_data)
-            # Go through each row and see if the date is outside the study period for that user. If it is, delete the row.
-            for index, row in df.iterrows():
-                user_id = row['user_id']
-                user_data = all_users_data[user_id]
-                date = datetime.strptime(row['date'], '%Y-%m-%d')
-                if date < datetime.strptime(user_data['study_start_date'], '%Y-%m-%d') or date > datetime.strptime(user_data['study_end_date'], '%Y-%m-%d'):
-                    df.drop(index, inplace=True)
-
-            current_time = datetime.now().strftime("%Y%m%d_%H%M")
-            output_file = f'activity_data_study_period_{current_time}.csv'
-            df.to_csv(output_file, index=False)
-            print(f"Data exported to {output_file}")
-            logging.info(f"Data exported to {output_file}")
-            return df
-        else:
+        Returns:
+            list: The dates in 'YYYY-MM-DD' format, empty if the window reaches the study end
+        """
+        if end_date >= study_end_date:
+            return []
+        first_day = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
+        return list(pd.date_range(first_day, study_end_date, freq='D').strftime('%Y-%m-%d'))
+
+    def _pending_participants(self, resource, all_users_data, windows, journal, watermarks=None):
+        """Leave out the participants whose window a resumed run already finished
+
+        Args:
+            resource (str): The resource, e.g. 'steps'
+            all_users_data (dict): Participant data keyed by participant ID
+            windows (dict): The planned (start_date, end_date) of each participant, see _plan_windows
+            journal (RunJournal): The journal of the run
+            watermarks (WatermarkStore, optional): Advanced for the participants left out. Defaults to None.
+
+        Returns:
+            dict: The participant data of the participants still to fetch
+        """
+        pending = {}
+        for participant_id, (start_date, end_date) in windows.items():
+            if journal.is_done(participant_id, start_date, end_date):
+                if watermarks is not None:
+                    watermarks.set(resource, participant_id, end_date)
+                continue
+            pending[participant_id] = all_users_data[participant_id]
+        return pending
+
+    def _finish_extraction(self, sink, return_df=True, skipped=None):
+        """Report on a full extraction once every batch has been written
+
+        Args:
+            sink (ExtractionSink): The sink the extraction was streamed into
+            return_df (bool, optional): Return the DataFrame kept by the sink. Defaults to True.
+            skipped (list, optional): Participants finished earlier by the resumed run, their data is
+                loaded back from the data store for the DataFrame. Defaults to None.
+
+        Returns:
+            pd.DataFrame: The extracted data (or the number of rows if return_df is False), None if there was none
+        """
+        df = sink.frame() if return_df else None
+        if return_df and skipped:
+            earlier = self.data_store.load(sink.resource, user_id=skipped)
+            if earlier is not None:
+                df = pd.concat([earlier, df], ignore_index=True).sort_values('user_id', kind='stable').reset_index(drop=True)
+
+        if not sink.rows and df is None:
             print("No data found for the specified date range")
             logging.warning("No data found for the specified date range")
             return None
+        print(f"Data saved to the data store in {self.data_store.root}")
+        logging.info(f"Data saved to the data store in {self.data_store.root}")
+        if sink.csv_path:
+            print(f"Data exported to {sink.csv_path}")
+            logging.info(f"Data exported to {sink.csv_path}")
+        return df if return_df else sink.rows
+
+    def _finish_incremental(self, sink, watermarks, export_csv=True, return_df=True):
+        """Save the watermarks of an incremental run once every batch has been merged into the data store.
+        Each fetched participant's stored rows from their fetch start onwards were replaced by the new ones,
+        everyone else's rows are kept as they are.
+
+        Args:
+            sink (ExtractionSink): The sink the extraction was streamed into
+            watermarks (WatermarkStore): The watermarks advanced by this run
+            export_csv (bool, optional): Also export the merged data to {resource}_data_study_period.csv. Defaults to True.
+            return_df (bool, optional): Load and return the merged data. Defaults to True.
 
+        Returns:
+            pd.DataFrame: The merged data (or the number of rows fetched if return_df is False), None if there was none
+        """
+        watermarks.save()
+        print(f"Fetched {len(sink.fetched_from)} participants incrementally, {sink.changed} changed in the data store in {self.data_store.root}")
+        logging.info(f"Fetched {len(sink.fetched_from)} participants incrementally, {sink.changed} changed in the data store in {self.data_store.root}")
+
+        if export_csv:
+            output_file = os.path.join(self.output_dir, f'{sink.resource}_data_study_period.csv')
+            if self.data_store.to_csv(sink.resource, output_file):
+                print(f"Data exported to {output_file}")
+                logging.info(f"Data exported to {output_file}")
+
+        if not return_df:
+            return sink.rows
+        df = self.data_store.load(sink.resource)
+        if df is None:
+            print("No data found for the specified date range")
+            logging.warning("No data found for the specified date range")
+        return df
+
+    def _iter_extraction(self, participants, extract_participant, max_workers=None):
+        """Run a per-participant extraction over the cohort on a pool of worker threads, yielding each
+        participant's rows as soon as they are done. Participants with rate limit budget left go first,
+        and a failure only loses that participant's rows. At most twice as many participants as workers
+        are in flight, so finished rows don't pile up while the caller is writing them out.
+
+        Args:
+            participants (iterable): (participant_id, user_data) pairs, e.g. all_users_data.items()
+            extract_participant (callable): Takes (participant_id, user_data) and returns a list of row dicts
+            max_workers (int, optional): Number of participants to fetch at once. Defaults to self.max_workers.
+
+        Yields:
+            tuple: (participant_id, rows) for every participant that succeeded, in the order they finish
+        """
+        participants = dict(participants)
+        order = list(participants)
+        rate_limiter = fitbit.api.FitbitOauth2Client.rate_limiter
+        if rate_limiter is not None:
+            order = rate_limiter.order_by_budget(order)
+        order = iter(order)
+        max_workers = max_workers or self.max_workers
+
+        pending = {}
+        failed = []
+        progress = Progress(len(participants))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            def submit(count):
+                for participant_id in itertools.islice(order, count):
+                    pending[executor.submit(extract_participant, participant_id, participants[participant_id])] = participant_id
+
+            submit(2 * max_workers)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                submit(len(done))
+                for future in done:
+                    participant_id = pending.pop(future)
+                    try:
+                        rows = future.result()
+                    except Exception as e:
+                        failed.append(participant_id)
+                        print(f"Error retrieving data for user {participant_id}: {e}")
+                        logging.error(f"Error retrieving data for user {participant_id}: {e}")
+                        progress.update(failed=True)
+                        continue
+                    progress.update(rows=len(rows))
+                    yield participant_id, rows
+
+        if failed:
+            print(f"Could not retrieve data for {len(failed)} participants: {', '.join(sorted(failed))}")
+            logging.warning(f"Could not retrieve data for {len(failed)} participants: {sorted(failed)}")
+
+    def _stream_extraction(self, participants, extract_participant, postprocess, sink, max_workers=None):
+        """Stream a per-participant extraction into a sink. Rows are collected per participant into
+        batches of about self.batch_rows rows, and each batch is post-processed and written out before
+        the next one is started, so memory stays flat whatever the size of the cohort.
+
+        Args:
+            participants (iterable): (participant_id, user_data) pairs, e.g. all_users_data.items()
+            extract_participant (callable): Takes (participant_id, user_data) and returns a list of row dicts
+            postprocess (callable): Takes the DataFrame of a batch and returns it post-processed
+            sink (ExtractionSink): Where the batches are written
+            max_workers (int, optional): Number of participants to fetch at once. Defaults to self.max_workers.
+        """
+        def flush(batch, batch_ids):
+            df = pd.DataFrame(batch)
+            if batch:
+                df = postprocess(df)
+            sink.write(df, batch_ids)
+
+        batch, batch_ids = [], []
+        for participant_id, rows in self._iter_extraction(participants, extract_participant, max_workers):
+            batch.extend(rows)
+            batch_ids.append(participant_id)
+            if len(batch) >= self.batch_rows:
+                flush(batch, batch_ids)
+                batch, batch_ids = [], []
+        if batch_ids:
+            flush(batch, batch_ids)
+        self._report_metrics()
+
+    def _report_metrics(self):
+        """Print the request metrics collected so far and write them to self.metrics_path, if metrics are on"""
+        metrics = fitbit.api.FitbitOauth2Client.metrics
+        if metrics is None:
+            return
+        summary = metrics.summary()
+        print(summary)
+        logging.info(f"Request metrics:\n{summary}")
+        if self.metrics_path:
+            metrics.dump(self.metrics_path)
+            print(f"Request metrics written to {self.metrics_path}")
+            logging.info(f"Request metrics written to {self.metrics_path}")
 
     def check_env_file_exists(self) -> bool:
         """Check if the .env file exists in the current directory
@@ -666,6 +1350,9 @@ class FitbitAuthSimple:
             'AWS_REGION',
             'AWS_TABLE_NAME'
         ]
+        if env_vars.get('PARTICIPANT_STORE_PATH'):
+            # Participants are kept in a local database, AWS isn't used
+            required_vars = [var for var in required_vars if not var.startswith('AWS_')]
         
         missing_vars = []
         for var in required_vars:
@@ -748,7 +1435,7 @@ class FitbitAuthSimple:
                         logging.info(f"Updated {env_var_name} in .env file")
                     else:
                         f.write(line)
-                        logging.info(f"Kept existing line in .env file: {line.strip()}")
+                        logging.info(f"Kept existing line in .env file: {line.split('=', 1)[0].strip()}")
         except Exception as e:
             print(f"Error updating .env file: {e}")
             logging.error(f"Error updating .env file: {e}")
@@ -768,14 +1455,7 @@ class FitbitAuthSimple:
         logging.info(f"Sending {message} to user {user_id}")
 
         # Initialize dynamoDB client
-        Session = boto3.Session(
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.region_name
-        )
-        
-        dynamodb = Session.resource("dynamodb")
-        table = dynamodb.Table(os.getenv('AWS_TABLE_NAME'))
+        table = self._get_table()
         
         # Get the user's phone number from the DynamoDB table
         response = table.get_item(Key={'participant_id': user_id})
@@ -788,7 +1468,7 @@ class FitbitAuthSimple:
             logging.warning(f"No user found with ID {user_id}")
             return
         
-        sns = Session.client('sns')
+        sns = self._get_session().client('sns')
 
         # Send the test message
         try:
@@ -813,19 +1493,12 @@ class FitbitAuthSimple:
         logging.info(f"Editing study information for user {participant_id}")
         
         # Print current study information for the user
-        Session = boto3.Session(
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.region_name
-        )
-        logging.info(f"access_key = ""{self.aws_access_key_id}, secret_key = {self.aws_secret_access_key}, region_name = {self.region_name}")
-        dynamodb = Session.resource("dynamodb")
-        table = dynamodb.Table(os.getenv('AWS_TABLE_NAME'))
+        table = self._get_table()
         
         # Get the user's study information from the DynamoDB table
         response = table.get_item(Key={'participant_id': participant_id})
         all_info = response.get('Item', {})
-        logging.info(f"Retrieved study information for user {participant_id}: {all_info}")
+        logging.info(f"Retrieved study information for user {participant_id}: {sorted(all_info)}")
 
         if all_info is not None:
             print(f"Current study information for user {participant_id}:")
@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+import uuid
+from datetime import datetime
+
+
+class RunJournal:
+    """Checkpoint journal of an extraction run, so an interrupted run can be resumed.
+
+    Every run gets a run ID and an append-only JSON lines file in the runs directory. The first line
+    holds the run's resource and options, the next one the planned (first date, last date) window of
+    every participant, and every written batch appends the units it finished: windows of the resource,
+    with where their rows went. Resuming a run reuses the planned windows, even on a later day, and
+    skips the units the journal says are finished.
+    """
+
+    def __init__(self, run_id, path, resource, options, done=None, outputs=None, finished=False, windows=None):
+        self.run_id = run_id
+        self.path = path
+        self.resource = resource
+        self.options = options
+        self.done = done or {}
+        self.outputs = outputs or {}
+        self.finished = finished
+        self.windows = windows
+        self._lock = threading.Lock()
+
+    @classmethod
+    def start(cls, resource, directory='extraction_runs', **options):
+        """Start the journal of a new run
+
+        Args:
+            resource (str): The resource the run extracts, e.g. 'steps'
+            directory (str, optional): Where journals are kept. Defaults to 'extraction_runs'.
+            **options: The run's options, e.g. incremental=True, stored for the resume
+
+        Returns:
+            RunJournal: The journal, with a new run ID
+        """
+        os.makedirs(directory, exist_ok=True)
+        run_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        journal = cls(run_id, os.path.join(directory, f'{run_id}.jsonl'), resource, options)
+        journal._append({'run_id': run_id, 'resource': resource, 'started': datetime.now().isoformat(), 'options': options})
+        return journal
+
+    @classmethod
+    def open(cls, run_id, directory='extraction_runs'):
+        """Open the journal of an earlier run to resume it
+
+        Args:
+            run_id (str): The ID of the run
+            directory (str, optional): Where journals are kept. Defaults to 'extraction_runs'.
+
+        Returns:
+            RunJournal: The journal with the finished units of the run
+
+        Raises:
+            FileNotFoundError: If there is no journal for run_id
+        """
+        path = os.path.join(directory, f'{run_id}.jsonl')
+        with open(path, 'r') as f:
+            header = json.loads(f.readline())
+            done = {}
+            outputs = {}
+            finished = False
+            windows = None
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line can be cut off if the run died while writing it
+                    break
+                if entry.get('finished'):
+                    finished = True
+                    continue
+                if 'windows' in entry:
+                    windows = {participant_id: tuple(window) for participant_id, window in entry['windows'].items()}
+                    continue
+                for participant_id, start_date, end_date in entry['units']:
+                    done[participant_id] = (start_date, end_date)
+                outputs.update(entry['outputs'])
+        return cls(run_id, path, header['resource'], header['options'], done, outputs, finished, windows)
+
+    def plan(self, windows):
+        """Fix the windows of the run: a new run records them, a resumed run gets the ones it planned back
+
+        Windows end at the day the run started (see FitbitAuthSimple._plan_windows), so a resume on a later
+        day would plan different windows than the ones its finished units were recorded for.
+
+        Args:
+            windows (dict): The (start_date, end_date) of each participant planned now
+
+        Returns:
+            dict: The windows to extract, keyed by participant ID
+        """
+        with self._lock:
+            if self.windows is None:
+                if self.done:
+                    # Journal of an older version without planned windows: keep the finished units as they were
+                    windows = dict(windows, **self.done)
+                self.windows = dict(windows)
+                self._append({'windows': {participant_id: list(window) for participant_id, window in windows.items()}})
+            return dict(self.windows)
+
+    def is_done(self, participant_id, start_date, end_date):
+        """Check whether a participant's window was finished by this run
+
+        Args:
+            participant_id (str): The ID of the participant
+            start_date (str): The first date of the window in 'YYYY-MM-DD' format
+            end_date (str): The last date of the window in 'YYYY-MM-DD' format
+
+        Returns:
+            bool: True if the window's rows were written out
+        """
+        with self._lock:
+            return self.done.get(participant_id) == (start_date, end_date)
+
+    def record(self, units, **outputs):
+        """Record finished units once their rows are written out
+
+        Args:
+            units (list): (participant_id, start_date, end_date) windows
+            **outputs: Where the rows went, e.g. csv='steps.csv', csv_bytes=1024
+        """
+        with self._lock:
+            for participant_id, start_date, end_date in units:
+                self.done[participant_id] = (start_date, end_date)
+            self.outputs.update(outputs)
+            self._append({'units': [list(unit) for unit in units], 'outputs': outputs})
+
+    def finish(self):
+        """Mark the run as finished"""
+        with self._lock:
+            self.finished = True
+            self._append({'finished': True, 'at': datetime.now().isoformat()})
+
+    def _append(self, entry):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
@@ -0,0 +1,247 @@
+import glob
+import os
+import shutil
+import uuid
+from urllib.parse import quote, unquote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+class FitbitDataStore:
+    """Local Parquet store for extracted Fitbit data.
+
+    Data is partitioned by resource, wave and participant (hive style, so other tools can read it too):
+
+        <root>/resource=steps/wave_number=3/user_id=P001/part-0.parquet
+
+    Writes replace whole participant partitions, and only the ones whose rows changed. Reads only open
+    the partitions and columns they need, e.g. load('steps', wave='3') never touches the other waves.
+    """
+
+    # Partition columns, stored in the directory names rather than the files
+    PARTITIONING = ds.partitioning(pa.schema([('wave_number', pa.string()), ('user_id', pa.string())]), flavor='hive')
+    PARTITION_COLUMNS = ['user_id', 'wave_number']
+
+    def __init__(self, root='fitbit_data'):
+        self.root = root
+
+    def _resource_dir(self, resource):
+        return os.path.join(self.root, f'resource={resource}')
+
+    def _participant_dirs(self, resource, user_id):
+        return glob.glob(os.path.join(self._resource_dir(resource), 'wave_number=*', f'user_id={quote(str(user_id), safe="")}'))
+
+    def _dataset(self, resource, expression=None):
+        """Build a dataset over the partitions matching expression, with a schema that fits all of them"""
+        base_dir = self._resource_dir(resource)
+        if not os.path.isdir(base_dir):
+            return None
+        # Partition pruning only looks at the directory names, no file is opened here
+        fragments = list(ds.dataset(base_dir, format='parquet', partitioning=self.PARTITIONING).get_fragments(filter=expression))
+        if not fragments:
+            return None
+        # In participant order, so scans come out grouped and sorted by participant
+        fragments.sort(key=lambda fragment: unquote(os.path.basename(os.path.dirname(fragment.path))))
+        # A column can be all null in one participant's file and typed in another's
+        schema = pa.unify_schemas([fragment.physical_schema for fragment in fragments], promote_options='permissive')
+        for field in self.PARTITIONING.schema:
+            schema = schema.append(field)
+        return ds.dataset([fragment.path for fragment in fragments], schema=schema, format='parquet',
+                          partitioning=self.PARTITIONING, partition_base_dir=base_dir)
+
+    def _expression(self, wave=None, user_id=None, filters=None):
+        expression = None
+        if filters is not None:
+            expression = filters if isinstance(filters, ds.Expression) else pq.filters_to_expression(filters)
+        if wave is not None:
+            expression = (ds.field('wave_number') == str(wave)) & expression if expression is not None else ds.field('wave_number') == str(wave)
+        if user_id is not None:
+            if isinstance(user_id, (list, tuple, set)):
+                condition = ds.field('user_id').isin([str(participant_id) for participant_id in user_id])
+            else:
+                condition = ds.field('user_id') == str(user_id)
+            expression = condition & expression if expression is not None else condition
+        return expression
+
+    def iter_frames(self, resource, wave=None, user_id=None, columns=None, filters=None):
+        """Read data from the store batch by batch, without holding all of it in memory
+
+        Args:
+            resource (str): The resource, e.g. 'steps', 'sleep' or 'activity'
+            wave (str, optional): Only read this wave. Defaults to None (all waves).
+            user_id (str or list, optional): Only read this participant or these participants. Defaults to None (all participants).
+            columns (list, optional): Only read these columns. Defaults to None (all columns).
+            filters (list or pyarrow.compute.Expression, optional): Row filters in pyarrow's format,
+                e.g. [('date', '>=', '2025-03-01')]. Defaults to None.
+
+        Yields:
+            pd.DataFrame: The matching rows, in participant order and sorted by date within a participant
+        """
+        expression = self._expression(wave, user_id, filters)
+        dataset = self._dataset(resource, expression)
+        if dataset is None:
+            return
+        if columns is not None:
+            columns = list(dict.fromkeys(self.PARTITION_COLUMNS + list(columns)))
+        for batch in dataset.to_batches(columns=columns, filter=expression):
+            if batch.num_rows:
+                df = batch.to_pandas()
+                yield df[self.PARTITION_COLUMNS + [column for column in df.columns if column not in self.PARTITION_COLUMNS]]
+
+    def load(self, resource, wave=None, user_id=None, columns=None, filters=None):
+        """Load data from the store
+
+        Args:
+            resource (str): The resource, e.g. 'steps', 'sleep' or 'activity'
+            wave (str, optional): Only load this wave. Defaults to None (all waves).
+            user_id (str or list, optional): Only load this participant or these participants. Defaults to None (all participants).
+            columns (list, optional): Only read these columns. Defaults to None (all columns).
+            filters (list or pyarrow.compute.Expression, optional): Row filters in pyarrow's format,
+                e.g. [('date', '>=', '2025-03-01')]. Defaults to None.
+
+        Returns:
+            pd.DataFrame: The matching rows sorted by participant and date, or None if there are none
+        """
+        expression = self._expression(wave, user_id, filters)
+        dataset = self._dataset(resource, expression)
+        if dataset is None:
+            return None
+        if columns is not None:
+            columns = list(dict.fromkeys(self.PARTITION_COLUMNS + list(columns)))
+        df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+        if df.empty:
+            return None
+
+        df = df[self.PARTITION_COLUMNS + [column for column in df.columns if column not in self.PARTITION_COLUMNS]]
+        sort_by = ['user_id', 'date'] if 'date' in df.columns else ['user_id']
+        return df.sort_values(sort_by, kind='stable').reset_index(drop=True)
+
+    def upsert(self, resource, df, fetched_from=None, participant_ids=None):
+        """Write extracted rows into the store, replacing the participants' partitions
+
+        Args:
+            resource (str): The resource, e.g. 'steps', 'sleep' or 'activity'
+            df (pd.DataFrame): Rows with user_id, wave_number and date columns
+            fetched_from (dict, optional): The first date fetched for each participant, for incremental runs.
+                Stored rows before that date are kept and the rest are replaced, including for participants
+                without new rows. Defaults to None (each participant in df is replaced entirely).
+            participant_ids (iterable, optional): The participants that were fetched, also the ones without
+                rows in df. The stored data of those without rows is removed. Defaults to None (the participants in df).
+
+        Returns:
+            int: The number of participants whose partitions changed
+        """
+        fetched_from = fetched_from or {}
+        groups = {user_id: rows for user_id, rows in df.groupby('user_id', sort=False)} if not df.empty else {}
+
+        changed = 0
+        for user_id in sorted(set(groups) | set(fetched_from) | set(participant_ids or ())):
+            stored = self._load_participant(resource, user_id)
+            rows = groups.get(user_id)
+            if user_id in fetched_from:
+                if rows is not None:
+                    rows = rows[rows['date'] >= fetched_from[user_id]]
+                if stored is not None:
+                    rows = pd.concat([stored[stored['date'] < fetched_from[user_id]], rows], ignore_index=True)
+            if rows is not None:
+                rows = rows.sort_values('date', kind='stable').reset_index(drop=True)
+                rows = rows[self.PARTITION_COLUMNS + [column for column in rows.columns if column not in self.PARTITION_COLUMNS]]
+
+            if self._same_rows(stored, rows):
+                continue
+            for participant_dir in self._participant_dirs(resource, user_id):
+                shutil.rmtree(participant_dir)
+            if rows is not None and not rows.empty:
+                for wave, wave_rows in rows.groupby('wave_number', sort=False):
+                    self._write_partition(resource, wave, user_id, wave_rows)
+            changed += 1
+        return changed
+
+    def participants(self, resource):
+        """List the participants with data for a resource, from the partition directories
+
+        Args:
+            resource (str): The resource, e.g. 'steps', 'sleep' or 'activity'
+
+        Returns:
+            list: The participant IDs, sorted
+        """
+        pattern = os.path.join(self._resource_dir(resource), 'wave_number=*', 'user_id=*')
+        return sorted({unquote(os.path.basename(path).split('=', 1)[1]) for path in glob.glob(pattern)})
+
+    def merge(self, resource, source, batch_participants=100):
+        """Replace participants' partitions with their data from another store, e.g. a shard's
+
+        Args:
+            resource (str): The resource, e.g. 'steps', 'sleep' or 'activity'
+            source (FitbitDataStore): The store to merge in
+            batch_participants (int, optional): Participants read from source at a time. Defaults to 100.
+
+        Returns:
+            int: The number of participants whose partitions changed
+        """
+        participant_ids = source.participants(resource)
+        changed = 0
+        for i in range(0, len(participant_ids), batch_participants):
+            df = source.load(resource, user_id=participant_ids[i:i + batch_participants])
+            if df is not None:
+                changed += self.upsert(resource, df)
+        return changed
+
+    def _load_participant(self, resource, user_id):
+        """Read one participant's partitions directly, without listing the rest of the store"""
+        frames = []
+        for participant_dir in self._participant_dirs(resource, user_id):
+            wave = unquote(os.path.basename(os.path.dirname(participant_dir)).split('=', 1)[1])
+            for path in sorted(glob.glob(os.path.join(participant_dir, '*.parquet'))):
+                df = pq.ParquetFile(path).read().to_pandas()
+                df.insert(0, 'wave_number', wave)
+                df.insert(0, 'user_id', str(user_id))
+                frames.append(df)
+        if not frames:
+            return None
+        return pd.concat(frames, ignore_index=True).sort_values('date', kind='stable').reset_index(drop=True)
+
+    @staticmethod
+    def _same_rows(stored, rows):
+        if stored is None or rows is None:
+            return stored is None and (rows is None or rows.empty)
+        if set(stored.columns) != set(rows.columns):
+            return False
+        try:
+            return stored[rows.columns].astype(str).equals(rows.astype(str))
+        except (TypeError, ValueError):
+            return False
+
+    def _write_partition(self, resource, wave, user_id, rows):
+        partition_dir = os.path.join(self._resource_dir(resource), f'wave_number={quote(str(wave), safe="")}',
+                                     f'user_id={quote(str(user_id), safe="")}')
+        os.makedirs(partition_dir, exist_ok=True)
+        table = pa.Table.from_pandas(rows.drop(columns=self.PARTITION_COLUMNS), preserve_index=False)
+        # Write to a temporary file first so readers never see half a partition
+        tmp_path = os.path.join(partition_dir, f'.part-0.{uuid.uuid4().hex}.tmp')
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, os.path.join(partition_dir, 'part-0.parquet'))
+
+    def to_csv(self, resource, path, **kwargs):
+        """Export (part of) the store as a CSV file, batch by batch
+
+        Args:
+            resource (str): The resource, e.g. 'steps', 'sleep' or 'activity'
+            path (str): The CSV file to write
+            **kwargs: Passed on to iter_frames, e.g. wave='3'
+
+        Returns:
+            int: The number of rows exported, the file is only written if there are any
+        """
+        rows = 0
+        columns = None
+        for df in self.iter_frames(resource, **kwargs):
+            if columns is None:
+                columns = list(df.columns)
+            df.reindex(columns=columns).to_csv(path, mode='a' if rows else 'w', header=not rows, index=False)
+            rows += len(df)
+        return rows
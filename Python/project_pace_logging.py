@@ -0,0 +1,107 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+_listener = None
+
+
+def setup_logging(filename='project_pace_api.log', level=logging.INFO,
+                  format='%(asctime)s - %(levelname)s - %(message)s'):
+    """Send log records to a file through a background thread.
+
+    A logging call still builds the message in the calling thread (QueueHandler.prepare merges the
+    arguments into it) and puts the record on a queue. A QueueListener thread then applies the line
+    format and writes it to the file, so the extraction threads never wait on file I/O. Records are
+    flushed when the program exits. Calling this again does nothing.
+
+    Args:
+        filename (str, optional): The log file. Defaults to 'project_pace_api.log'.
+        level (int or str, optional): The root logger level, e.g. 'DEBUG'. Defaults to logging.INFO.
+        format (str, optional): The log line format.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(format))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+class SampledLogger:
+    """Logs every nth per-record line at DEBUG, for loops that see thousands of records.
+
+    Arguments are formatted lazily by logging, and nothing is done at all when DEBUG is off.
+    """
+
+    def __init__(self, every=100, logger=None):
+        self.every = every
+        self.logger = logger or logging.getLogger()
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def debug(self, msg, *args):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        with self._lock:
+            self._count += 1
+            sampled = self._count % self.every == 1 or self.every == 1
+        if sampled:
+            self.logger.debug(msg, *args)
+
+
+class Progress:
+    """One line progress display for extractions, redrawn at most a few times a second.
+
+    Replaces printing a line per participant and per day.
+    """
+
+    def __init__(self, total, label='Participants', stream=None, interval=0.5):
+        self.total = total
+        self.label = label
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.rows = 0
+        # Redirected output only gets the final line
+        self._redraw = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self._start = time.monotonic()
+        self._last_draw = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, rows=0, failed=False):
+        """Count one finished participant
+
+        Args:
+            rows (int, optional): The participant's rows. Defaults to 0.
+            failed (bool, optional): The participant failed. Defaults to False.
+        """
+        with self._lock:
+            self.done += 1
+            self.failed += failed
+            self.rows += rows
+            now = time.monotonic()
+            if self.done == self.total or (self._redraw and now - self._last_draw >= self.interval):
+                self._last_draw = now
+                self._draw(now)
+
+    def _draw(self, now):
+        elapsed = now - self._start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        line = f"\r{self.label}: {self.done}/{self.total} done, {self.failed} failed, {self.rows} rows, {rate:.1f}/s"
+        if self.done == self.total:
+            line += "\n"
+        self.stream.write(line)
+        self.stream.flush()
@@ -0,0 +1,361 @@
+import json
+import re
+import sqlite3
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+
+class ParticipantStore(ABC):
+    """Where the participant items (study dates, phone numbers and tokens) are kept.
+
+    The operations are the DynamoDB Table operations FitbitAuthSimple uses, with the same keyword arguments
+    and response shapes: put_item, get_item, update_item, delete_item and scan. A failed
+    ConditionExpression raises a ClientError with the code ConditionalCheckFailedException, like DynamoDB.
+    A backend has to implement all of them, or it can't be created.
+    """
+
+    @abstractmethod
+    def put_item(self, **kwargs):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_item(self, **kwargs):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_item(self, **kwargs):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_item(self, **kwargs):
+        raise NotImplementedError
+
+    @abstractmethod
+    def scan(self, **kwargs):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class DynamoDBParticipantStore(ParticipantStore):
+    """The participants table in AWS DynamoDB (or DynamoDB Local)"""
+
+    def __init__(self, table):
+        """
+        Args:
+            table: The boto3 DynamoDB Table resource
+        """
+        self.table = table
+
+    def put_item(self, **kwargs):
+        return self.table.put_item(**kwargs)
+
+    def get_item(self, **kwargs):
+        return self.table.get_item(**kwargs)
+
+    def update_item(self, **kwargs):
+        return self.table.update_item(**kwargs)
+
+    def delete_item(self, **kwargs):
+        return self.table.delete_item(**kwargs)
+
+    def scan(self, **kwargs):
+        return self.table.scan(**kwargs)
+
+
+class LocalParticipantStore(ParticipantStore):
+    """Participants kept in a local SQLite database, for offline runs, benchmarks and as a read replica.
+
+    Follows DynamoDB's semantics for the expressions FitbitAuthSimple uses: SET/REMOVE update expressions,
+    condition expressions with comparisons, AND/OR/NOT and attribute_exists/attribute_not_exists,
+    projection expressions, #name and :value placeholders, updates that create missing items, numbers
+    returned as Decimal, and scans split into segments and pages with LastEvaluatedKey. Conditional writes
+    are atomic across threads and processes sharing the database file.
+    """
+
+    KEY = 'participant_id'
+
+    def __init__(self, path=':memory:', page_size=1000):
+        """
+        Args:
+            path (str, optional): The SQLite database file. Defaults to ':memory:'.
+            page_size (int, optional): Items per scan page, like DynamoDB's 1 MB pages. Defaults to 1000.
+        """
+        self.path = path
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS participants (participant_id TEXT PRIMARY KEY, segment_hash INTEGER, item TEXT)")
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        key = Item[self.KEY]
+        with self._write() as db:
+            self._check(db, key, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues, 'PutItem')
+            self._save(db, key, _to_dynamodb(Item))
+        return {}
+
+    def get_item(self, Key, ConsistentRead=False, ProjectionExpression=None, ExpressionAttributeNames=None):
+        with self._lock:
+            item = self._load(self._db, Key[self.KEY])
+        if item is None:
+            return {}
+        return {'Item': _project(item, ProjectionExpression, ExpressionAttributeNames)}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE'):
+        key = Key[self.KEY]
+        names = ExpressionAttributeNames or {}
+        values = _to_dynamodb(ExpressionAttributeValues or {})
+        with self._write() as db:
+            item = self._check(db, key, ConditionExpression, names, values, 'UpdateItem')
+            item = dict(item) if item is not None else {self.KEY: key}
+            for action, attribute, value in _parse_update(UpdateExpression, names, values):
+                if action == 'SET':
+                    item[attribute] = value
+                else:
+                    item.pop(attribute, None)
+            self._save(db, key, item)
+        return {'Attributes': item} if ReturnValues == 'ALL_NEW' else {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        key = Key[self.KEY]
+        with self._write() as db:
+            self._check(db, key, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues, 'DeleteItem')
+            db.execute("DELETE FROM participants WHERE participant_id = ?", (key,))
+        return {}
+
+    def scan(self, Segment=0, TotalSegments=1, ExclusiveStartKey=None, Limit=None, ProjectionExpression=None,
+             ExpressionAttributeNames=None):
+        limit = min(Limit or self.page_size, self.page_size)
+        start = ExclusiveStartKey[self.KEY] if ExclusiveStartKey else ''
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT item FROM participants WHERE segment_hash % ? = ? AND participant_id > ? ORDER BY participant_id LIMIT ?",
+                (TotalSegments, Segment, start, limit + 1)).fetchall()
+        items = [_loads(row[0]) for row in rows[:limit]]
+        response = {'Items': [_project(item, ProjectionExpression, ExpressionAttributeNames) for item in items],
+                    'Count': len(items), 'ScannedCount': len(items)}
+        if len(rows) > limit:
+            response['LastEvaluatedKey'] = {self.KEY: items[-1][self.KEY]}
+        return response
+
+    def replicate_from(self, source, attributes=None, total_segments=4):
+        """Copy every item of another store into this one, e.g. to read DynamoDB locally
+
+        Args:
+            source (ParticipantStore): The store to copy
+            attributes (tuple, optional): Only copy these attributes. Defaults to None (whole items).
+            total_segments (int, optional): Scan segments to read source in. Defaults to 4.
+
+        Returns:
+            int: The number of items copied
+        """
+        projection = {}
+        if attributes:
+            names = {f"#a{i}": attribute for i, attribute in enumerate((self.KEY,) + tuple(attributes))}
+            projection = {'ProjectionExpression': ", ".join(names), 'ExpressionAttributeNames': names}
+        copied = 0
+        for segment in range(total_segments):
+            scan_kwargs = {'Segment': segment, 'TotalSegments': total_segments, **projection}
+            while True:
+                response = source.scan(**scan_kwargs)
+                with self._write() as db:
+                    for item in response.get('Items', []):
+                        self._save(db, item[self.KEY], _to_dynamodb(item))
+                copied += len(response.get('Items', []))
+                if 'LastEvaluatedKey' not in response:
+                    break
+                scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return copied
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _write(self):
+        return _Transaction(self._db, self._lock)
+
+    def _load(self, db, key):
+        row = db.execute("SELECT item FROM participants WHERE participant_id = ?", (key,)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def _save(self, db, key, item):
+        db.execute("INSERT OR REPLACE INTO participants (participant_id, segment_hash, item) VALUES (?, ?, ?)",
+                   (key, zlib.crc32(key.encode('utf-8')), _dumps(item)))
+
+    def _check(self, db, key, condition, names, values, operation):
+        item = self._load(db, key)
+        if condition and not _Condition(condition, names or {}, _to_dynamodb(values or {})).evaluate(item or {}):
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+                                         'Message': 'The conditional request failed'}}, operation)
+        return item
+
+
+class _Transaction:
+    """An immediate SQLite transaction, so a conditional write's read and write can't interleave with another's"""
+
+    def __init__(self, db, lock):
+        self.db = db
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.db.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self.lock.release()
+            raise
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.lock.release()
+
+
+def _to_dynamodb(value):
+    """Convert numbers to Decimal, the type DynamoDB stores and returns them as"""
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {key: _to_dynamodb(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_dynamodb(item) for item in value]
+    return value
+
+
+def _encode(value):
+    if isinstance(value, Decimal):
+        return {'$N': str(value)}
+    raise TypeError(f"Can't store {type(value).__name__} in the participant store")
+
+
+def _decode(obj):
+    return Decimal(obj['$N']) if len(obj) == 1 and '$N' in obj else obj
+
+
+def _dumps(item):
+    return json.dumps(item, default=_encode)
+
+
+def _loads(text):
+    return json.loads(text, object_hook=_decode)
+
+
+def _resolve(name, names):
+    return names[name] if name.startswith('#') else name
+
+
+def _project(item, projection, names):
+    if not projection:
+        return item
+    attributes = [_resolve(name.strip(), names or {}) for name in projection.split(',')]
+    return {attribute: item[attribute] for attribute in attributes if attribute in item}
+
+
+def _parse_update(expression, names, values):
+    """Parse a SET/REMOVE update expression into (action, attribute, value) steps"""
+    steps = []
+    for action, body in re.findall(r'\b(SET|REMOVE)\b\s+(.*?)(?=\s+\b(?:SET|REMOVE)\b|$)', expression.strip(), re.IGNORECASE | re.DOTALL):
+        for clause in body.split(','):
+            if action.upper() == 'SET':
+                attribute, value = (part.strip() for part in clause.split('=', 1))
+                steps.append(('SET', _resolve(attribute, names), values[value]))
+            else:
+                steps.append(('REMOVE', _resolve(clause.strip(), names), None))
+    return steps
+
+
+class _Condition:
+    """Evaluates a DynamoDB condition expression against an item"""
+
+    TOKENS = re.compile(r'\s*(<>|<=|>=|[=<>(),]|[#:]?[A-Za-z_][A-Za-z0-9_]*)')
+    COMPARISONS = {
+        '=': lambda a, b: a == b,
+        '<>': lambda a, b: a != b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+    }
+
+    def __init__(self, expression, names, values):
+        self.tokens = self.TOKENS.findall(expression)
+        if ''.join(self.tokens) != re.sub(r'\s+', '', expression):
+            raise ValueError(f"Unsupported condition expression: {expression}")
+        self.names = names
+        self.values = values
+
+    def evaluate(self, item):
+        self.item = item
+        self.position = 0
+        result = self._or()
+        if self.position != len(self.tokens):
+            raise ValueError(f"Unsupported condition expression near {self.tokens[self.position]!r}")
+        return result
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _take(self):
+        token = self._peek()
+        self.position += 1
+        return token
+
+    def _or(self):
+        result = self._and()
+        while (self._peek() or '').upper() == 'OR':
+            self._take()
+            right = self._and()
+            result = result or right
+        return result
+
+    def _and(self):
+        result = self._not()
+        while (self._peek() or '').upper() == 'AND':
+            self._take()
+            right = self._not()
+            result = result and right
+        return result
+
+    def _not(self):
+        if (self._peek() or '').upper() == 'NOT':
+            self._take()
+            return not self._not()
+        return self._comparison()
+
+    def _comparison(self):
+        token = self._take()
+        if token == '(':
+            result = self._or()
+            self._take()
+            return result
+        if token in ('attribute_exists', 'attribute_not_exists'):
+            self._take()
+            attribute = _resolve(self._take(), self.names)
+            self._take()
+            return (attribute in self.item) == (token == 'attribute_exists')
+        left = self._operand(token)
+        operator = self._take()
+        right = self._operand(self._take())
+        if left is None or right is None:
+            # Comparisons with a missing attribute are false in DynamoDB
+            return False
+        try:
+            return self.COMPARISONS[operator](left, right)
+        except TypeError:
+            return False
+
+    def _operand(self, token):
+        if token.startswith(':'):
+            return self.values[token]
+        return self.item.get(_resolve(token, self.names))
@@ -0,0 +1,155 @@
+import csv
+import os
+from collections import defaultdict
+
+import pandas as pd
+
+
+class CsvBatchWriter:
+    """Appends batches of rows to a CSV file, writing the header with the first batch.
+
+    Every batch is written with the same columns in the same order, missing ones left empty. A resumed
+    run continues the file of the interrupted one from the end of its last recorded batch. Batches arrive
+    in the order participants finish, sort() puts the finished file in participant order.
+    """
+
+    def __init__(self, path, columns, resume_at=None):
+        self.path = path
+        self.columns = list(columns)
+        self.rows = 0
+        self.size = 0
+        if resume_at and os.path.exists(path):
+            # Drop whatever the interrupted run wrote after its last recorded batch
+            with open(path, 'r+') as f:
+                f.truncate(resume_at)
+            self.size = resume_at
+
+    def write(self, df):
+        with open(self.path, 'a' if self.size else 'w', newline='') as f:
+            df.reindex(columns=self.columns).to_csv(f, header=not self.size, index=False)
+            self.size = f.tell()
+        self.rows += len(df)
+
+    def sort(self, column='user_id'):
+        """Rewrite the file with its rows in order of a column, keeping the order of rows with the same value
+
+        The rows of a participant are together within a batch, so only where each run of rows starts and ends
+        is kept in memory, not the rows.
+
+        Args:
+            column (str, optional): The column to order by. Defaults to 'user_id'.
+        """
+        if not self.size:
+            return
+        runs = defaultdict(list)
+        with open(self.path, 'rb') as f:
+            header = f.readline()
+            index = next(csv.reader([header.decode('utf-8')])).index(column)
+            end = [f.tell()]
+
+            def lines():
+                # csv.reader asks for one line at a time, so end is where the last row it returned ends
+                for line in iter(f.readline, b''):
+                    end[0] += len(line)
+                    yield line.decode('utf-8')
+
+            start = end[0]
+            for row in csv.reader(lines()):
+                value = row[index]
+                if runs[value] and runs[value][-1][1] == start:
+                    runs[value][-1][1] = end[0]
+                else:
+                    runs[value].append([start, end[0]])
+                start = end[0]
+
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'wb') as out:
+                out.write(header)
+                for value in sorted(runs):
+                    for run_start, run_end in runs[value]:
+                        f.seek(run_start)
+                        out.write(f.read(run_end - run_start))
+        os.replace(tmp_path, self.path)
+
+
+class ExtractionSink:
+    """Receives the batches of a streaming extraction and writes them out as they arrive.
+
+    Every batch goes to the data store, and optionally to a CSV file and to an in-memory DataFrame.
+    A batch always holds all the rows of the participants in it, so the data store can replace their
+    partitions one batch at a time.
+    """
+
+    def __init__(self, resource, data_store, columns, csv_path=None, keep_frame=False, fetched_from=None,
+                 journal=None, windows=None):
+        """
+        Args:
+            resource (str): The resource, e.g. 'steps'
+            data_store (FitbitDataStore): The store the batches are upserted into
+            columns (list): The columns of the resource, in output order
+            csv_path (str, optional): Also write the batches to this CSV file. Defaults to None.
+            keep_frame (bool, optional): Keep the batches in memory for frame(). Defaults to False.
+            fetched_from (dict, optional): The first date fetched for each participant in an incremental
+                run, see FitbitDataStore.upsert. Defaults to None (full extraction).
+            journal (RunJournal, optional): Record each written batch in this run journal. Defaults to None.
+            windows (dict, optional): The (start_date, end_date) fetched for each participant, recorded in
+                the journal. Required with journal.
+        """
+        self.resource = resource
+        self.data_store = data_store
+        self.columns = list(columns)
+        self.journal = journal
+        self.windows = windows
+        resume_at = journal.outputs.get('csv_bytes') if journal is not None else None
+        self.csv_writer = CsvBatchWriter(csv_path, columns, resume_at=resume_at) if csv_path else None
+        self.fetched_from = fetched_from
+        self.frames = [] if keep_frame else None
+        self.rows = 0
+        self.changed = 0
+
+    @property
+    def csv_path(self):
+        return self.csv_writer.path if self.csv_writer else None
+
+    def write(self, df, participant_ids):
+        """Write one batch
+
+        Args:
+            df (pd.DataFrame): The post-processed rows of the batch, may be empty
+            participant_ids (list): The participants the batch holds, including those without rows
+        """
+        fetched_from = None
+        if self.fetched_from is not None:
+            fetched_from = {participant_id: self.fetched_from[participant_id]
+                            for participant_id in participant_ids if participant_id in self.fetched_from}
+        # Participants that now have no rows lose what an earlier run stored for them
+        self.changed += self.data_store.upsert(self.resource, df, fetched_from=fetched_from, participant_ids=participant_ids)
+        if not df.empty:
+            if self.csv_writer is not None:
+                self.csv_writer.write(df)
+            if self.frames is not None:
+                self.frames.append(df)
+            self.rows += len(df)
+
+        if self.journal is not None:
+            outputs = {'data_store': self.data_store.root}
+            if self.csv_writer is not None:
+                outputs.update(csv=self.csv_writer.path, csv_bytes=self.csv_writer.size)
+            self.journal.record([(participant_id,) + tuple(self.windows[participant_id]) for participant_id in participant_ids], **outputs)
+
+    def finish(self):
+        """Put the CSV file in participant order once every batch is written"""
+        if self.csv_writer is not None:
+            self.csv_writer.sort()
+
+    def frame(self):
+        """Build a DataFrame of everything written, in participant order
+
+        Returns:
+            pd.DataFrame: The rows, or None if nothing was written or keep_frame was off
+        """
+        if not self.frames:
+            return None
+        df = pd.concat(self.frames, ignore_index=True)
+        df = df[[column for column in self.columns if column in df.columns] + [column for column in df.columns if column not in self.columns]]
+        return df.sort_values('user_id', kind='stable').reset_index(drop=True)
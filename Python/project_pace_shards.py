@@ -0,0 +1,90 @@
+import logging
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+
+def parse_shard(text):
+    """Parse a shard given as 'I/N', e.g. '2/4' for the second of four shards
+
+    Args:
+        text (str): The shard, I from 1 to N
+
+    Returns:
+        tuple: (index, count)
+
+    Raises:
+        ValueError: If text isn't a valid shard
+    """
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError(f"Shard should look like I/N, e.g. 2/4, not {text!r}")
+    if not 1 <= index <= count:
+        raise ValueError(f"Shard {text} is out of range, I should be between 1 and N")
+    return index, count
+
+
+def shard_of(participant_id, count):
+    """Get the shard a participant belongs to.
+
+    Uses CRC32 of the participant ID rather than hash(), which is salted per process, so a participant
+    always lands in the same shard on every node and every run (and keeps its watermarks and outputs).
+
+    Args:
+        participant_id (str): The ID of the participant
+        count (int): The number of shards
+
+    Returns:
+        int: The shard, from 1 to count
+    """
+    return zlib.crc32(str(participant_id).encode('utf-8')) % count + 1
+
+
+def shard_dir(root, index, count):
+    """The directory a shard writes its outputs to, e.g. extraction_shards/shard-2-of-4"""
+    return os.path.join(root, f'shard-{index}-of-{count}')
+
+
+def _run_shard(resource, index, count, options):
+    # Runs in a child process, which builds its own client, table handle and connections
+    import project_pace_api_functions as paf
+
+    auth = paf.FitbitAuthSimple()
+    auth.use_shard(index, count)
+    try:
+        return auth.extract(resource, return_df=False, **options)
+    finally:
+        auth.close()
+
+
+def run_local_shards(resource, count, max_workers=None, **options):
+    """Run an extraction as count shard processes on this machine, then merge their outputs
+
+    Args:
+        resource (str): The resource to extract, 'steps', 'sleep' or 'activity'
+        count (int): The number of shards (processes)
+        max_workers (int, optional): Participants fetched at once by each shard. Defaults to EXTRACTION_WORKERS.
+        **options: Passed on to the extraction, e.g. incremental=True
+
+    Returns:
+        int: The number of rows the shards extracted
+    """
+    import project_pace_api_functions as paf
+
+    options['max_workers'] = max_workers
+    # spawn, so no child inherits the parent's threads (the log writer) or open connections
+    with ProcessPoolExecutor(max_workers=count, mp_context=get_context('spawn')) as executor:
+        futures = {index: executor.submit(_run_shard, resource, index, count, options) for index in range(1, count + 1)}
+        rows = 0
+        for index, future in futures.items():
+            try:
+                rows += future.result() or 0
+            except Exception as e:
+                print(f"Shard {index}/{count} failed: {e}")
+                logging.error(f"Shard {index}/{count} failed: {e}")
+
+    auth = paf.FitbitAuthSimple()
+    auth.merge_shards(resource, count, export_csv=options.get('export_csv', True))
+    return rows
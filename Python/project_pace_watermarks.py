@@ -0,0 +1,85 @@
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+
+class WatermarkStore:
+    """Per-participant, per-resource high-water marks for incremental extraction.
+
+    A watermark is the last day whose data has been extracted for a participant. Incremental runs only
+    fetch from the watermark minus a re-sync window (for devices that sync late) onwards. The marks are
+    kept in a local JSON file: {resource: {participant_id: 'YYYY-MM-DD'}}.
+    """
+
+    def __init__(self, path='extraction_watermarks.json'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._marks = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self._marks = json.load(f)
+
+    def get(self, resource, participant_id):
+        """Get a participant's watermark
+
+        Args:
+            resource (str): The resource, e.g. 'steps'
+            participant_id (str): The ID of the participant
+
+        Returns:
+            str: The last extracted day in 'YYYY-MM-DD' format, or None if nothing was extracted yet
+        """
+        with self._lock:
+            return self._marks.get(resource, {}).get(participant_id)
+
+    def set(self, resource, participant_id, date):
+        """Advance a participant's watermark. Watermarks never move backwards.
+
+        Args:
+            resource (str): The resource, e.g. 'steps'
+            participant_id (str): The ID of the participant
+            date (str): The last extracted day in 'YYYY-MM-DD' format
+        """
+        with self._lock:
+            marks = self._marks.setdefault(resource, {})
+            if date > marks.get(participant_id, ''):
+                marks[participant_id] = date
+
+    def update(self, other):
+        """Advance these watermarks to another store's, e.g. a shard's
+
+        Args:
+            other (WatermarkStore): The watermarks to merge in
+        """
+        with other._lock:
+            marks = {resource: dict(participants) for resource, participants in other._marks.items()}
+        for resource, participants in marks.items():
+            for participant_id, date in participants.items():
+                self.set(resource, participant_id, date)
+
+    def fetch_start(self, resource, participant_id, study_start_date, resync_days):
+        """Get the first day an incremental run needs to fetch for a participant
+
+        Args:
+            resource (str): The resource, e.g. 'steps'
+            participant_id (str): The ID of the participant
+            study_start_date (str): The participant's study start date in 'YYYY-MM-DD' format
+            resync_days (int): Days before the watermark to fetch again, for late device syncs
+
+        Returns:
+            str: The start date in 'YYYY-MM-DD' format
+        """
+        watermark = self.get(resource, participant_id)
+        if watermark is None:
+            return study_start_date
+        resync_start = (datetime.strptime(watermark, '%Y-%m-%d') - timedelta(days=resync_days)).strftime('%Y-%m-%d')
+        return max(study_start_date, resync_start)
+
+    def save(self):
+        """Write the watermarks to disk, replacing the file atomically"""
+        with self._lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self._marks, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,29 @@
+"""FitbitDataStore upserts.
+
+Usage: python -m pytest Python/tests
+"""
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from project_pace_data_store import FitbitDataStore
+
+
+def sleep_rows(user_id, dates):
+    return pd.DataFrame({"user_id": user_id, "wave_number": "1", "date": dates, "efficiency": 90.0})
+
+
+def test_full_upsert_removes_participants_fetched_without_rows(tmp_path):
+    store = FitbitDataStore(str(tmp_path / "fitbit_data"))
+    store.upsert("sleep", pd.concat([sleep_rows("P1", ["2025-03-01", "2025-03-02"]),
+                                     sleep_rows("P2", ["2025-03-01"])], ignore_index=True))
+
+    # P1 is fetched again and has no rows anymore, P3 wasn't fetched
+    store.upsert("sleep", sleep_rows("P3", ["2025-03-01"]).iloc[:0], participant_ids=["P1"])
+    assert store.participants("sleep") == ["P2"]
+
+    store.upsert("sleep", sleep_rows("P2", ["2025-03-02"]), participant_ids=["P2"])
+    assert list(store.load("sleep")["date"]) == ["2025-03-02"]
@@ -0,0 +1,130 @@
+"""Replaying requests and extractions from the response archive.
+
+Needs the modified api.py installed (Step 4 of the README) and runs against the
+local mock in Python/benchmarks, so no Fitbit requests are made.
+
+Usage: python -m pytest Python/tests
+"""
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+os.environ.setdefault("OAUTHLIB_INSECURE_TRANSPORT", "1")
+
+import fitbit
+from fitbit.api import ArchiveMiss, FitbitOauth2Client, ResponseArchive, ResponseCache
+
+import project_pace_api_functions
+from bench_cohort import make_cohort
+from mock_fitbit import MockFitbitServer
+from project_pace_api_functions import FitbitAuthSimple
+
+USER = "P00000"
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with MockFitbitServer() as server:
+        monkeypatch.setattr(fitbit.Fitbit, "API_ENDPOINT", server.url)
+        monkeypatch.setattr(fitbit.Fitbit, "archive", None)
+        monkeypatch.setattr(fitbit.Fitbit, "cache", None)
+        yield server
+
+
+def client():
+    access_token, refresh_token = MockFitbitServer.tokens(USER)
+    return fitbit.Fitbit("client_id", "client_secret", access_token=access_token, refresh_token=refresh_token,
+                         expires_at=time.time() + 28800, rate_limit_key=USER)
+
+
+def steps(start, end):
+    return client().time_series_range("activities/steps", base_date=start.isoformat(),
+                                      end_date=end.isoformat())
+
+
+def test_replay_returns_ranges_partly_answered_by_the_cache(server, tmp_path):
+    start, end = date.today() - timedelta(days=60), date.today()
+    cache = ResponseCache(str(tmp_path / "cache.db"))
+    fitbit.Fitbit.cache = cache
+    steps(start, end)
+
+    # Two days later the open end of the range has expired, so only that part
+    # is requested again and the rest comes from the cache
+    cache._clock = lambda: time.time() + 2 * 86400
+    fitbit.Fitbit.archive = ResponseArchive(str(tmp_path / "archive"))
+    server.reset()
+    live = steps(start, end)
+    assert 0 < server.requests
+    assert len(live["activities-steps"]) == 61
+
+    # Served from the cache only
+    server.reset()
+    middle = steps(start + timedelta(days=10), start + timedelta(days=20))
+    assert server.requests == 0
+
+    fitbit.Fitbit.archive = ResponseArchive(str(tmp_path / "archive"), replay=True)
+    fitbit.Fitbit.cache = None
+    server.reset()
+    assert steps(start, end) == live
+    assert steps(start + timedelta(days=10), start + timedelta(days=20)) == middle
+    assert server.requests == 0
+    cache.close()
+
+
+def test_replay_raises_for_days_never_returned(server, tmp_path):
+    start, end = date.today() - timedelta(days=30), date.today() - timedelta(days=20)
+    fitbit.Fitbit.cache = ResponseCache(str(tmp_path / "cache.db"))
+    steps(start, end)
+    fitbit.Fitbit.archive = ResponseArchive(str(tmp_path / "archive"))
+    steps(start, end - timedelta(days=5))
+
+    fitbit.Fitbit.archive = ResponseArchive(str(tmp_path / "archive"), replay=True)
+    fitbit.Fitbit.cache.close()
+    fitbit.Fitbit.cache = None
+    assert len(steps(start, end - timedelta(days=5))["activities-steps"]) == 6
+    with pytest.raises(ArchiveMiss):
+        steps(start, end)
+
+
+class DaysLater(datetime):
+    """datetime whose now() is a few days ahead"""
+    days = 3
+
+    @classmethod
+    def now(cls, tz=None):
+        return datetime.now(tz) + timedelta(days=cls.days)
+
+
+def test_replay_on_a_later_day_rebuilds_ongoing_studies(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(FitbitOauth2Client, "refresh_token_url", f"{server.url}/oauth2/token")
+    for name, value in {"FITBIT_CLIENT_ID": "client_id", "FITBIT_CLIENT_SECRET": "client_secret",
+                        "PARTICIPANT_STORE_PATH": "participants.db", "RESPONSE_ARCHIVE_PATH": "archive",
+                        "RESPONSE_CACHE_PATH": "", "REQUEST_METRICS_PATH": "", "ARCHIVE_REPLAY": ""}.items():
+        monkeypatch.setenv(name, value)
+    auth = FitbitAuthSimple()
+    cohort = make_cohort(4)
+    # Half of the studies are still going on
+    for participant in cohort[::2]:
+        participant["study_end_date"] = (date.today() + timedelta(days=20)).isoformat()
+    table = auth._get_table()
+    for participant in cohort:
+        table.put_item(Item=participant)
+    live = {resource: auth.extract(resource, export_csv=False) for resource in ("steps", "sleep", "activity")}
+
+    monkeypatch.setattr(project_pace_api_functions, "datetime", DaysLater)
+    monkeypatch.setenv("ARCHIVE_REPLAY", "1")
+    monkeypatch.setenv("DATA_STORE_PATH", "fitbit_data_replay")
+    fitbit.Fitbit.archive = None
+    server.reset()
+    replay = FitbitAuthSimple()
+    for resource, df in live.items():
+        replayed = replay.extract(resource, export_csv=False)
+        assert sorted(replayed["user_id"].unique()) == [participant["participant_id"] for participant in cohort]
+        assert replayed.reset_index(drop=True).equals(df.reset_index(drop=True)), resource
+    assert server.requests == 0
@@ -1,20 +1,930 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import bisect
+import collections
+import contextlib
+import copy
 import datetime
+import functools
+import gzip
+import inspect
 import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
 
 try:
-    from urllib.parse import urlencode
+    from urllib.parse import parse_qsl, quote, urlencode
 except ImportError:
     # Python 2.x
-    from urllib import urlencode
+    from urllib import quote, urlencode
+    from urlparse import parse_qsl
 
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from requests_oauthlib import OAuth2Session
+from urllib3.connection import HTTPConnection
 
 from . import exceptions
 from .compliance import fitbit_compliance_fix
-from .utils import curry
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that turns on TCP keep-alive for the sockets it pools so idle
+    connections to api.fitbit.com survive between participants.
+    """
+    def __init__(self, socket_options=None, **kwargs):
+        self.socket_options = socket_options
+        super(_KeepAliveAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options is not None:
+            kwargs['socket_options'] = self.socket_options
+        super(_KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+class FitbitTransport(object):
+    """
+    Process-wide HTTP transport shared by every FitbitOauth2Client.
+
+    Each client still owns its OAuth2Session (and therefore its own token
+    state), but the session is mounted onto one shared, thread-safe connection
+    adapter. The adapter keeps one connection pool per host, so building a
+    client per participant no longer costs a new TCP/TLS handshake.
+
+        - pool_connections: number of per-host pools to keep
+        - pool_maxsize: sockets kept alive per host (size this to the number
+          of worker threads that talk to Fitbit at once)
+        - keep_alive: reuse sockets and enable TCP keep-alive on them. Set to
+          False to close the connection after every request
+    """
+    def __init__(self, pool_connections=4, pool_maxsize=32, keep_alive=True,
+            pool_block=False):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self.pool_block = pool_block
+        self._adapter = None
+        self._lock = threading.Lock()
+
+    @property
+    def adapter(self):
+        if self._adapter is None:
+            with self._lock:
+                if self._adapter is None:
+                    socket_options = None
+                    if self.keep_alive:
+                        socket_options = HTTPConnection.default_socket_options + [
+                            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+                        ]
+                    self._adapter = _KeepAliveAdapter(
+                        socket_options=socket_options,
+                        pool_connections=self.pool_connections,
+                        pool_maxsize=self.pool_maxsize,
+                        pool_block=self.pool_block,
+                    )
+        return self._adapter
+
+    def mount(self, session):
+        """Point ``session`` at the shared connection pools"""
+        adapter = self.adapter
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def close(self):
+        """Drop every pooled connection. New requests will reconnect."""
+        with self._lock:
+            if self._adapter is not None:
+                self._adapter.close()
+                self._adapter = None
+
+
+class RateLimiter(object):
+    """
+    Per-user request budget for the Fitbit Web API (150 requests per user per
+    hour, resetting at the top of the hour).
+
+    Every user key gets a bucket of ``limit`` tokens. A token is taken before
+    each request; when the bucket is empty ``acquire`` waits until the bucket's
+    reset time instead of letting the request come back as a 429. Buckets are
+    re-synced from the ``Fitbit-Rate-Limit-*`` headers on every response, so
+    the local count never drifts from what Fitbit reports.
+    """
+    LIMIT_HEADER = 'Fitbit-Rate-Limit-Limit'
+    REMAINING_HEADER = 'Fitbit-Rate-Limit-Remaining'
+    RESET_HEADER = 'Fitbit-Rate-Limit-Reset'
+
+    def __init__(self, limit=150, period=3600, reserve=0, clock=time.time,
+            sleep=time.sleep):
+        self.limit = limit
+        self.period = period
+        # Tokens held back per user, e.g. for a token refresh or a retry
+        self.reserve = reserve
+        self._clock = clock
+        self._sleep = sleep
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = {
+                'limit': self.limit,
+                'remaining': self.limit,
+                'reset_at': now + self.period,
+            }
+        elif now >= bucket['reset_at']:
+            bucket['remaining'] = bucket['limit']
+            bucket['reset_at'] = now + self.period
+        return bucket
+
+    def try_acquire(self, key):
+        """
+        Take a token for ``key`` without blocking. Returns 0 on success,
+        otherwise the number of seconds until the bucket refills.
+        """
+        with self._lock:
+            now = self._clock()
+            bucket = self._bucket(key, now)
+            if bucket['remaining'] > self.reserve:
+                bucket['remaining'] -= 1
+                return 0
+            return max(bucket['reset_at'] - now, 0.001)
+
+    def acquire(self, key):
+        """Take a token for ``key``, waiting for the reset if none are left"""
+        waited = 0
+        while True:
+            wait = self.try_acquire(key)
+            if not wait:
+                return waited
+            self._sleep(wait)
+            waited += wait
+
+    def update(self, key, headers):
+        """Sync the bucket for ``key`` with the rate limit headers of a response"""
+        try:
+            remaining = int(headers[self.REMAINING_HEADER])
+            reset = int(headers[self.RESET_HEADER])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._lock:
+            now = self._clock()
+            bucket = self._bucket(key, now)
+            if self.LIMIT_HEADER in headers:
+                bucket['limit'] = int(headers[self.LIMIT_HEADER])
+            bucket['remaining'] = remaining
+            bucket['reset_at'] = now + reset
+
+    def penalize(self, key, retry_after=None):
+        """Empty the bucket for ``key`` after a 429"""
+        with self._lock:
+            now = self._clock()
+            bucket = self._bucket(key, now)
+            bucket['remaining'] = 0
+            if retry_after is not None:
+                bucket['reset_at'] = now + retry_after
+
+    def remaining(self, key):
+        """Requests ``key`` can still make before the next reset"""
+        with self._lock:
+            return self._bucket(key, self._clock())['remaining']
+
+    def reset_in(self, key):
+        """Seconds until the bucket for ``key`` refills"""
+        with self._lock:
+            now = self._clock()
+            return max(self._bucket(key, now)['reset_at'] - now, 0)
+
+    def budget(self):
+        """Snapshot of every known bucket: {key: (remaining, seconds_to_reset)}"""
+        with self._lock:
+            now = self._clock()
+            return dict(
+                (key, (bucket['remaining'], max(bucket['reset_at'] - now, 0)))
+                for key, bucket in self._buckets.items()
+            )
+
+    def order_by_budget(self, keys):
+        """
+        Order ``keys`` so users that can make a request right now come first
+        and users waiting on a reset are pushed to the back.
+        """
+        with self._lock:
+            now = self._clock()
+
+            def sort_key(key):
+                bucket = self._buckets.get(key)
+                if bucket is None or now >= bucket['reset_at']:
+                    return (0, 0)
+                if bucket['remaining'] > self.reserve:
+                    return (0, -bucket['remaining'])
+                return (1, bucket['reset_at'])
+            return sorted(keys, key=sort_key)
+
+
+class TokenRefreshCoordinator(object):
+    """
+    Makes token refreshes single-flight. Fitbit refresh tokens are single use,
+    so two clients refreshing the same token at once leave one of them (and
+    possibly the stored token) invalid, and the user has to re-authorize.
+
+    Within the process, refreshes are serialized per refresh token: the first
+    caller refreshes, and everyone that was waiting on the same refresh token
+    reuses the new token instead of spending the old one again. A client's
+    ``refresh_lease`` (see FitbitOauth2Client) extends this across processes.
+    """
+    def __init__(self, max_results=1024):
+        self.max_results = max_results
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._results = collections.OrderedDict()
+
+    def refresh(self, client):
+        stale = dict(client.session.token)
+        old = stale.get('refresh_token')
+        with self._lock:
+            flight = self._flights.setdefault(old, threading.Lock())
+        with flight:
+            with self._lock:
+                token = self._results.get(old)
+            if token is None:
+                if client.refresh_lease is not None:
+                    token = client.refresh_lease(stale, client._fetch_refreshed_token)
+                else:
+                    token = client._fetch_refreshed_token()
+                with self._lock:
+                    self._results[old] = token
+                    while len(self._results) > self.max_results:
+                        evicted, _ = self._results.popitem(last=False)
+                        self._flights.pop(evicted, None)
+        if client.session.token.get('access_token') != token.get('access_token'):
+            # Refreshed by another client or process, adopt its token
+            client.session.token = token
+        return token
+
+
+class _Histogram(object):
+    """Cumulative-bucket histogram, as in Prometheus"""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating within its bucket"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def to_dict(self):
+        return {
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'],
+                                self.counts)),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class RequestMetrics(object):
+    """
+    In-memory request metrics for FitbitOauth2Client, to tell where a slow run
+    spends its time.
+
+    Every request is recorded under its endpoint template (dates, user IDs
+    and other IDs replaced by placeholders, see ``endpoint_template``) with
+    its status code, latency, response size, 429 retries, token refreshes
+    and the rate limit headers Fitbit sent back. Time is also broken down by
+    phase: ``fitbit`` (waiting on the API), ``rate_limit_wait``, ``refresh``
+    (including the token saving callback) and ``parse``; callers can time
+    their own phases with ``phase``.
+
+    Disabled unless set on the client class, e.g.
+    ``FitbitOauth2Client.metrics = RequestMetrics()``; a disabled hook costs
+    one attribute lookup per request.
+    """
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                       0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+    _TEMPLATE_PATTERNS = (
+        (re.compile(r'/user/[^/]+'), '/user/{user_id}'),
+        (re.compile(r'/\d{4}-\d{2}-\d{2}(?=[/.]|$)'), '/{date}'),
+        (re.compile(r'/today(?=[/.]|$)'), '/{date}'),
+        (re.compile(r'/\d{2}:\d{2}(?=[/.]|$)'), '/{time}'),
+        # Not the API version at the start
+        (re.compile(r'(?!^)/\d+(?=[/.]|$)'), '/{id}'),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.latency = {}
+        self.size = {}
+        self.phases = {}
+        self.retries = 0
+        self.refreshes = 0
+        self.rate_limit = {}
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def endpoint_template(url):
+        """
+        ``https://api.fitbit.com/1/user/ABC/sleep/date/2025-01-01/2025-02-01.json?x=1``
+        becomes ``/1/user/{user_id}/sleep/date/{date}/{date}.json``.
+        """
+        path = url.split('?', 1)[0]
+        if '://' in path:
+            path = '/' + path.split('://', 1)[1].partition('/')[2]
+        for pattern, placeholder in RequestMetrics._TEMPLATE_PATTERNS:
+            path = pattern.sub(placeholder, path)
+        return path
+
+    def record(self, method, url, response, seconds, retries=0, refreshes=0):
+        """Record one request, including its retries and refreshes"""
+        endpoint = self.endpoint_template(url)
+        size = len(response.content) if response.content else 0
+        headers = response.headers
+        remaining = headers.get(RateLimiter.REMAINING_HEADER)
+        with self._lock:
+            self.requests[(method, endpoint, response.status_code)] += 1
+            histogram = self.latency.get(endpoint)
+            if histogram is None:
+                histogram = self.latency[endpoint] = _Histogram(self.LATENCY_BUCKETS)
+                self.size[endpoint] = _Histogram(self.SIZE_BUCKETS)
+            histogram.observe(seconds)
+            self.size[endpoint].observe(size)
+            self.retries += retries
+            self.refreshes += refreshes
+            if remaining is not None:
+                remaining = int(remaining)
+                self.rate_limit['last_remaining'] = remaining
+                self.rate_limit['min_remaining'] = min(
+                    remaining, self.rate_limit.get('min_remaining', remaining))
+                limit = headers.get(RateLimiter.LIMIT_HEADER)
+                if limit is not None:
+                    self.rate_limit['limit'] = int(limit)
+                reset = headers.get(RateLimiter.RESET_HEADER)
+                if reset is not None:
+                    self.rate_limit['last_reset_seconds'] = int(reset)
+
+    def observe_phase(self, phase, seconds):
+        with self._lock:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = _Histogram(self.LATENCY_BUCKETS)
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a block as a phase, e.g. ``with metrics.phase('dynamodb'):``"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_phase(name, time.perf_counter() - start)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'requests': [
+                    {'method': method, 'endpoint': endpoint,
+                     'status': status, 'count': count}
+                    for (method, endpoint, status), count
+                    in sorted(self.requests.items(), key=str)],
+                'latency_seconds': {endpoint: histogram.to_dict() for
+                                    endpoint, histogram in self.latency.items()},
+                'response_bytes': {endpoint: histogram.to_dict() for
+                                   endpoint, histogram in self.size.items()},
+                'phase_seconds': {phase: histogram.to_dict() for
+                                  phase, histogram in self.phases.items()},
+                'retries': self.retries,
+                'refreshes': self.refreshes,
+                'rate_limit': dict(self.rate_limit),
+            }
+
+    def to_prometheus(self):
+        """The metrics in the Prometheus text exposition format"""
+        def labels(**kwargs):
+            return '{%s}' % ','.join(
+                '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                for key, value in kwargs.items())
+
+        def histogram_lines(name, label, histograms):
+            lines = ['# TYPE %s histogram' % name]
+            for value, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bucket, count in zip(
+                        [str(b) for b in histogram.buckets] + ['+Inf'],
+                        histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name, labels(**{label: value, 'le': bucket}), cumulative))
+                lines.append('%s_sum%s %r' % (name, labels(**{label: value}), histogram.sum))
+                lines.append('%s_count%s %d' % (name, labels(**{label: value}), histogram.count))
+            return lines
+
+        with self._lock:
+            lines = ['# TYPE fitbit_requests_total counter']
+            for (method, endpoint, status), count in sorted(self.requests.items(), key=str):
+                lines.append('fitbit_requests_total%s %d' % (
+                    labels(method=method, endpoint=endpoint, status=status), count))
+            lines += histogram_lines('fitbit_request_duration_seconds', 'endpoint', self.latency)
+            lines += histogram_lines('fitbit_response_size_bytes', 'endpoint', self.size)
+            lines += histogram_lines('fitbit_phase_duration_seconds', 'phase', self.phases)
+            lines += ['# TYPE fitbit_rate_limit_retries_total counter',
+                      'fitbit_rate_limit_retries_total %d' % self.retries,
+                      '# TYPE fitbit_token_refreshes_total counter',
+                      'fitbit_token_refreshes_total %d' % self.refreshes]
+            for key, value in sorted(self.rate_limit.items()):
+                lines += ['# TYPE fitbit_rate_limit_%s gauge' % key,
+                          'fitbit_rate_limit_%s %d' % (key, value)]
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """
+        Write the metrics to ``path``: a Prometheus textfile if it ends in
+        ``.prom``, JSON otherwise. The file is replaced atomically so a
+        textfile collector never reads half of it.
+        """
+        if path.endswith('.prom'):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_dict(), indent=2)
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def summary(self):
+        """A table of requests, latency and time per phase for the end of a run"""
+        with self._lock:
+            total = sum(self.requests.values())
+            errors = sum(count for (_, _, status), count in self.requests.items()
+                         if status >= 400)
+            lines = ['%d requests, %d errors, %d rate limit retries, %d token refreshes' % (
+                total, errors, self.retries, self.refreshes)]
+            if self.rate_limit:
+                lines.append('Lowest rate limit remaining: %s' % self.rate_limit.get('min_remaining'))
+            lines.append('%-60s %7s %9s %9s %10s' % ('endpoint', 'count', 'p50 (ms)', 'p99 (ms)', 'KB'))
+            for endpoint, histogram in sorted(self.latency.items()):
+                lines.append('%-60s %7d %9.1f %9.1f %10.1f' % (
+                    endpoint, histogram.count, histogram.quantile(0.5) * 1000,
+                    histogram.quantile(0.99) * 1000, self.size[endpoint].sum / 1024))
+            lines.append('%-60s %7s %9s %9s' % ('phase', 'count', 'total (s)', 'p50 (ms)'))
+            for phase, histogram in sorted(self.phases.items()):
+                lines.append('%-60s %7d %9.2f %9.1f' % (
+                    phase, histogram.count, histogram.sum, histogram.quantile(0.5) * 1000))
+        return '\n'.join(lines)
+
+
+def _entry_day(entry):
+    """The day a list entry of a response is for, or None"""
+    day = entry.get('dateTime') or entry.get('dateOfSleep') or entry.get('date')
+    return day[:10] if isinstance(day, str) else None
+
+
+def _days_in(body, start, end):
+    """``body`` with only the list entries dated from ``start`` to ``end``"""
+    trimmed = {}
+    for key, value in body.items():
+        if isinstance(value, list):
+            value = [entry for entry in value
+                     if not isinstance(entry, dict) or not _entry_day(entry)
+                     or start <= _entry_day(entry) <= end]
+        trimmed[key] = value
+    return trimmed
+
+
+def _only_days(body, days):
+    """``body`` with only the list entries dated on one of ``days``"""
+    trimmed = {}
+    for key, value in body.items():
+        if isinstance(value, list):
+            value = [entry for entry in value
+                     if not isinstance(entry, dict) or not _entry_day(entry)
+                     or _entry_day(entry) in days]
+        trimmed[key] = value
+    return trimmed
+
+
+def _days_between(start, end):
+    """Every day from ``start`` to ``end`` ('YYYY-MM-DD'), inclusive"""
+    day = datetime.datetime.strptime(start, '%Y-%m-%d').date()
+    last = datetime.datetime.strptime(end, '%Y-%m-%d').date()
+    days = []
+    while day <= last:
+        days.append(day.isoformat())
+        day += datetime.timedelta(days=1)
+    return days
+
+
+def _stitch(bodies):
+    """
+    Merge responses for parts of a date range into one, as Fitbit would have
+    returned it: earlier bodies win for duplicate days, entries sorted by day
+    """
+    merged = Fitbit._merge_responses(bodies)
+    for value in merged.values():
+        if isinstance(value, list) and all(
+                isinstance(entry, dict) and _entry_day(entry) for entry in value):
+            value.sort(key=_entry_day)
+    return merged
+
+
+class ArchiveMiss(LookupError):
+    """A replayed request that isn't in the ResponseArchive"""
+
+
+class ResponseArchive(object):
+    """
+    Append-only archive of raw Fitbit API responses, so derived datasets can
+    be rebuilt later without asking Fitbit again.
+
+    Every JSON response ``Fitbit.make_request`` returns, including the ones
+    ``Fitbit.cache`` answers, is appended to
+    ``<root>/<user>.jsonl.gz`` as one line with the endpoint template (see
+    ``RequestMetrics.endpoint_template``), the date range of the request, the
+    URL without the host, when it was fetched, and the body. Each append is
+    its own gzip member, so nothing is ever rewritten and a write cut short by
+    a crash only loses that line. Users are the client's ``rate_limit_key``,
+    e.g. a participant ID.
+
+    With ``replay`` the archive answers the requests instead of Fitbit, so
+    nothing goes over the network. A date request (``/date/A/B.json``) is
+    put together day by day from the newest recorded response of that
+    endpoint covering each day, other requests get the latest recorded
+    response to the same URL. A request with a day (or URL) that was never
+    recorded raises ArchiveMiss.
+
+    Disabled unless set on the client class, e.g.
+    ``Fitbit.archive = ResponseArchive('fitbit_archive')``.
+    """
+    _DATE = re.compile(r'/(\d{4}-\d{2}-\d{2})(?=[/.]|$)')
+    _PERIOD = re.compile(r'/(today|%s)(?=[/.]|$)' % '|'.join(
+        ['1d', '7d', '30d', '1w', '1m', '3m', '6m', '1y', 'max']))
+    # Anonymous clients, without a rate_limit_key
+    ANONYMOUS = '_'
+
+    def __init__(self, root, replay=False, max_cached_users=64):
+        self.root = root
+        self.replay = replay
+        self.max_cached_users = max_cached_users
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+
+    @staticmethod
+    def canonical_url(url):
+        """The URL without scheme and host, with its query parameters sorted"""
+        path, _, query = url.partition('?')
+        if '://' in path:
+            path = '/' + path.split('://', 1)[1].partition('/')[2]
+        if query:
+            path += '?' + urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+        return path
+
+    @classmethod
+    def date_range(cls, url):
+        """
+        ``(start, end)`` of a request: the first and last date in the path, or
+        the ``afterDate``/``beforeDate`` query parameters (either can be None)
+        """
+        path, _, query = url.partition('?')
+        dates = cls._DATE.findall(path)
+        if dates:
+            return dates[0], dates[-1]
+        params = dict(parse_qsl(query))
+        return params.get('afterDate'), params.get('beforeDate')
+
+    def path(self, user):
+        return os.path.join(self.root, '%s.jsonl.gz' % quote(str(user or self.ANONYMOUS), safe=''))
+
+    def record(self, user, url, body):
+        """Append one response body for ``user``"""
+        start, end = self.date_range(url)
+        line = json.dumps({
+            'user': user,
+            'endpoint': RequestMetrics.endpoint_template(url),
+            'start': start,
+            'end': end,
+            'url': self.canonical_url(url),
+            'fetched_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'body': body,
+        }, separators=(',', ':'))
+        with self._lock:
+            if not os.path.isdir(self.root):
+                os.makedirs(self.root)
+            with gzip.open(self.path(user), 'ab') as f:
+                f.write((line + '\n').encode('utf8'))
+            self._cache.pop(user, None)
+
+    def records(self, user):
+        """Every recorded response of ``user``, oldest first"""
+        records = []
+        try:
+            with gzip.open(self.path(user), 'rt') as f:
+                for line in f:
+                    records.append(json.loads(line))
+        except (IOError, OSError, EOFError, ValueError):
+            # No archive for this user yet, or a write cut short by a crash:
+            # keep the complete lines before it
+            pass
+        return records
+
+    def _index(self, user):
+        with self._lock:
+            index = self._cache.get(user)
+            if index is not None:
+                self._cache.move_to_end(user)
+                return index
+        records = self.records(user)
+        index = {'records': records,
+                 'urls': dict((record['url'], record) for record in records)}
+        with self._lock:
+            self._cache[user] = index
+            while len(self._cache) > self.max_cached_users:
+                self._cache.popitem(last=False)
+        return index
+
+    def last_day(self, user, endpoint):
+        """
+        The newest day ``user``'s recorded responses of ``endpoint`` (a
+        ``RequestMetrics.endpoint_template``) cover: the end of their date
+        range, or the day they were fetched (UTC) when they have no end, like
+        the activity log list. None if nothing was recorded.
+        """
+        days = [record['end'] or record['fetched_at'][:10]
+                for record in self._index(user)['records']
+                if record['endpoint'] == endpoint]
+        return max(days) if days else None
+
+    @classmethod
+    def day_range(cls, url):
+        """
+        ``(first day, last day)`` a date request (``/date/A/B.json`` or
+        ``/date/A.json``) covers, or None for any other request, including
+        ones for a period (``/date/A/7d.json``)
+        """
+        path = url.partition('?')[0]
+        dates = cls._DATE.findall(path)
+        if not dates or len(dates) > 2 or cls._PERIOD.search(path):
+            return None
+        return dates[0], dates[-1]
+
+    def lookup(self, user, url):
+        """The body to replay for ``url``, see the class docstring"""
+        index = self._index(user)
+        day_range = self.day_range(url)
+        if day_range is None:
+            record = index['urls'].get(self.canonical_url(url))
+            if record is None:
+                raise ArchiveMiss('%s %s' % (user, self.canonical_url(url)))
+            return record['body']
+
+        # Every day comes from the newest response that covers it
+        start, end = day_range
+        endpoint = RequestMetrics.endpoint_template(url)
+        missing = set(_days_between(start, end))
+        bodies = []
+        for record in reversed(index['records']):
+            if record['endpoint'] != endpoint or not record['start'] or not record['end']:
+                continue
+            days = set(day for day in missing if record['start'] <= day <= record['end'])
+            if days:
+                missing -= days
+                bodies.append(_only_days(record['body'], days))
+            if not missing:
+                return _stitch(bodies)
+        raise ArchiveMiss('%s %s: %d of its days were never fetched, e.g. %s' % (
+            user, self.canonical_url(url), len(missing), min(missing)))
+
+
+class ResponseCache(object):
+    """
+    Disk-backed cache of Fitbit API responses, in an SQLite database shared by
+    threads and processes, keyed by user (the client's ``rate_limit_key``)
+    and canonical URL.
+
+    Days more than ``closed_after_days`` in the past effectively never change,
+    so responses that only cover such days are kept for ``closed_ttl``
+    seconds; anything that covers a recent day, or has no dates in its URL, is
+    kept for ``open_ttl``. A date range request (``/date/A/B.json``) is served
+    from the cached days it can be, and only the rest of the range, the recent
+    days at its end, is requested: e.g. a study period extraction rerun the
+    next day only asks Fitbit for the last week. Its closed days are cached
+    on their own, so they're still there once the response expires.
+
+    Once the database is larger than ``max_bytes``, expired and then least
+    recently used responses are evicted. Clients without a
+    ``rate_limit_key`` aren't cached, since their URLs can't tell users apart.
+
+    Disabled unless set on the client class, e.g.
+    ``Fitbit.cache = ResponseCache('fitbit_response_cache.db')``.
+    """
+    def __init__(self, path, closed_after_days=7, closed_ttl=90 * 86400,
+            open_ttl=3600, max_bytes=512 * 1024 ** 2, clock=time.time):
+        self.path = path
+        self.closed_after_days = closed_after_days
+        self.closed_ttl = closed_ttl
+        self.open_ttl = open_ttl
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Last use of responses served since the last write, saved in batches
+        self._touched = {}
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (user TEXT, url TEXT, endpoint TEXT, "
+            "start_date TEXT, end_date TEXT, dated INTEGER, body TEXT, size INTEGER, "
+            "expires_at REAL, last_used REAL, PRIMARY KEY (user, url))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_range ON responses (user, endpoint, start_date)")
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _range(self, url):
+        """``(start, end)`` of a ``/date/A/B.json`` request, otherwise None"""
+        path = url.partition('?')[0]
+        dates = ResponseArchive._DATE.findall(path)
+        if len(dates) != 2 or ResponseArchive._PERIOD.search(path):
+            return None
+        return dates[0], dates[1]
+
+    def _closed_until(self):
+        """The last closed day"""
+        return (datetime.date.fromtimestamp(self._clock()) -
+                datetime.timedelta(days=self.closed_after_days + 1)).isoformat()
+
+    def get(self, user, url):
+        """The cached response to ``url`` for ``user``, or None"""
+        now = self._clock()
+        key = ResponseArchive.canonical_url(url)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body FROM responses WHERE user = ? AND url = ? AND expires_at > ?",
+                (user, key, now)).fetchone()
+            if row is None:
+                return None
+            self._touched[(user, key)] = now
+        return json.loads(row[0])
+
+    def put(self, user, url, body, split=True):
+        """
+        Cache a response. With ``split``, the closed days of a date range that
+        also covers recent days are cached separately for ``closed_ttl``.
+        """
+        if not isinstance(body, dict):
+            return
+        now = self._clock()
+        closed_until = self._closed_until()
+        rows = []
+        date_range = self._range(url)
+        if date_range is None:
+            rows.append((url, None, None, self.open_ttl, body))
+        else:
+            start, end = date_range
+            if end <= closed_until:
+                rows.append((url, start, end, self.closed_ttl, body))
+            else:
+                rows.append((url, start, end, self.open_ttl, body))
+                if split and start <= closed_until and self._dated(body):
+                    closed_url = url.replace('/%s/%s' % (start, end), '/%s/%s' % (start, closed_until), 1)
+                    rows.append((closed_url, start, closed_until, self.closed_ttl,
+                                 _days_in(body, start, closed_until)))
+        with self._lock:
+            self._flush_touched()
+            for row_url, start, end, ttl, row_body in rows:
+                text = json.dumps(row_body, separators=(',', ':'))
+                key = ResponseArchive.canonical_url(row_url)
+                old = self._db.execute("SELECT size FROM responses WHERE user = ? AND url = ?", (user, key)).fetchone()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (user, key, RequestMetrics.endpoint_template(row_url), start, end,
+                     int(self._dated(row_body)), text, len(text), now + ttl, now))
+                self._size += len(text) - (old[0] if old else 0)
+            if self._size > self.max_bytes:
+                self._evict(now)
+
+    def fetch(self, user, url, request):
+        """
+        The response to ``url``, from the cache where possible.
+        ``request(url)`` makes the actual request, for the part of a date range
+        the cache can't serve.
+        """
+        body = self.get(user, url)
+        if body is not None:
+            return body
+        date_range = self._range(url)
+        cached = []
+        if date_range is not None:
+            start, end = date_range
+            cached, covered_until = self._cached_days(user, url, start, end)
+            if covered_until == end:
+                body = _stitch(cached)
+                self.put(user, url, body, split=False)
+                return body
+            if covered_until is not None:
+                next_day = (datetime.datetime.strptime(covered_until, '%Y-%m-%d').date() +
+                            datetime.timedelta(days=1)).isoformat()
+                tail_url = url.replace('/%s/%s' % (start, end), '/%s/%s' % (next_day, end), 1)
+                body = request(tail_url)
+                self.put(user, tail_url, body)
+                if not isinstance(body, dict):
+                    return body
+                body = _stitch(cached + [body])
+                self.put(user, url, body, split=False)
+                return body
+        body = request(url)
+        self.put(user, url, body)
+        return body
+
+    def _cached_days(self, user, url, start, end):
+        """
+        Cached bodies covering ``start`` and the days right after it, trimmed
+        to the range, and the last day they cover (None if not even ``start``)
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT start_date, end_date, body FROM responses WHERE user = ? AND endpoint = ? "
+                "AND dated = 1 AND expires_at > ? AND start_date <= ? AND end_date >= ? ORDER BY start_date",
+                (user, RequestMetrics.endpoint_template(url), self._clock(), end, start)).fetchall()
+        bodies = []
+        covered_until = None
+        day = start
+        while rows and day <= end:
+            # Of the responses that include day, the one reaching furthest
+            best = None
+            for row in rows:
+                if row[0] <= day and (best is None or row[1] > best[1]):
+                    best = row
+            if best is None or best[1] < day:
+                break
+            covered_until = min(best[1], end)
+            bodies.append(_days_in(json.loads(best[2]), day, covered_until))
+            day = (datetime.datetime.strptime(covered_until, '%Y-%m-%d').date() +
+                   datetime.timedelta(days=1)).isoformat()
+        return bodies, covered_until
+
+    @staticmethod
+    def _dated(body):
+        """Whether every list entry of a response has a day, so it can be split by day"""
+        lists = [value for value in body.values() if isinstance(value, list)]
+        return bool(lists) and all(isinstance(entry, dict) and _entry_day(entry)
+                                   for value in lists for entry in value)
+
+    def _flush_touched(self):
+        if self._touched:
+            self._db.executemany("UPDATE responses SET last_used = ? WHERE user = ? AND url = ?",
+                                 [(used, user, url) for (user, url), used in self._touched.items()])
+            self._touched = {}
+
+    def _evict(self, now):
+        """Drop expired, then least recently used responses until 90% of max_bytes is left"""
+        target = self.max_bytes * 0.9
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        evicted = []
+        for rowid, size in self._db.execute(
+                "SELECT rowid, size FROM responses ORDER BY expires_at > ?, last_used", (now,)):
+            if self._size <= target:
+                break
+            evicted.append((rowid,))
+            self._size -= size
+        self._db.executemany("DELETE FROM responses WHERE rowid = ?", evicted)
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._touched = {}
+            self._size = 0
+
+    def close(self):
+        with self._lock:
+            self._flush_touched()
+            self._db.close()
 
 
 class FitbitOauth2Client(object):
@@ -27,6 +937,22 @@ class FitbitOauth2Client(object):
     access_token_url = request_token_url
     refresh_token_url = request_token_url
 
+    # Shared by all instances, see FitbitTransport. Set to None to give every
+    # client its own connection pool (the requests default).
+    transport = FitbitTransport()
+
+    # Shared per-user request budget, see RateLimiter. Set to None to send
+    # requests without any scheduling.
+    rate_limiter = RateLimiter()
+
+    # Shared by all instances, see TokenRefreshCoordinator. Set to None to let
+    # every refresh go straight to Fitbit.
+    refresh_coordinator = TokenRefreshCoordinator()
+
+    # Request instrumentation, see RequestMetrics. None (the default) records
+    # nothing.
+    metrics = None
+
     def __init__(self, client_id, client_secret, access_token=None,
             refresh_token=None, expires_at=None, refresh_cb=None,
             redirect_uri=None, *args, **kwargs):
@@ -37,9 +963,31 @@ class FitbitOauth2Client(object):
             - client_id, client_secret are in the app configuration page
             https://dev.fitbit.com/apps
             - access_token, refresh_token are obtained after the user grants permission
+            - rate_limit_key (keyword) identifies the user's request budget in
+              the rate limiter, e.g. a participant ID
+            - max_rate_limit_retries (keyword) is how many times a 429 is
+              retried after waiting for the reset (default 3)
+            - refresh_margin (keyword) refreshes the token this many seconds
+              before ``expires_at`` instead of waiting for a 401 (default 60)
+            - refresh_lease (keyword) coordinates refreshes across processes:
+              a callable ``(old_token, fetch)`` that either calls ``fetch()``
+              to refresh, or returns the token another process refreshed to
         """
 
         self.client_id, self.client_secret = client_id, client_secret
+        self.session = fitbit_compliance_fix(OAuth2Session(
+            client_id,
+            auto_refresh_url=self.refresh_token_url,
+            redirect_uri=redirect_uri,
+        ))
+        if self.transport is not None:
+            self.transport.mount(self.session)
+        self._set_token_state(access_token, refresh_token, expires_at,
+                              refresh_cb, **kwargs)
+
+    def _set_token_state(self, access_token=None, refresh_token=None,
+            expires_at=None, refresh_cb=None, **kwargs):
+        """Everything about the client that belongs to its user"""
         token = {}
         if access_token and refresh_token:
             token.update({
@@ -48,14 +996,47 @@ class FitbitOauth2Client(object):
             })
         if expires_at:
             token['expires_at'] = expires_at
-        self.session = fitbit_compliance_fix(OAuth2Session(
-            client_id,
-            auto_refresh_url=self.refresh_token_url,
-            token_updater=refresh_cb,
-            token=token,
-            redirect_uri=redirect_uri,
-        ))
+        self.session.token_updater = refresh_cb
+        self.session.token = token
         self.timeout = kwargs.get("timeout", None)
+        self.rate_limit_key = (kwargs.get("rate_limit_key") or
+                               token.get('access_token') or self.client_id)
+        # The user as given by the caller, for ResponseArchive and ResponseCache
+        self.user_key = kwargs.get("rate_limit_key")
+        self.max_rate_limit_retries = kwargs.get("max_rate_limit_retries", 3)
+        self.refresh_margin = kwargs.get("refresh_margin", 60)
+        self.refresh_lease = kwargs.get("refresh_lease", None)
+
+    def with_token(self, access_token=None, refresh_token=None,
+            expires_at=None, refresh_cb=None, **kwargs):
+        """
+        A client for another user (same keyword arguments as the constructor)
+        that shares this client's OAuth2 setup: the compliance hooks, mounted
+        connection pools and headers of its session. Only the token state is
+        its own, which is a lot cheaper than building a client from scratch.
+        """
+        client = object.__new__(type(self))
+        client.__dict__.update(self.__dict__)
+        session = client.session = object.__new__(type(self.session))
+        session.__dict__.update(self.session.__dict__)
+        # The oauthlib client holds the token, and cookies are per user
+        session._client = copy.copy(self.session._client)
+        session.cookies = requests.cookies.RequestsCookieJar()
+        client._set_token_state(access_token, refresh_token, expires_at,
+                                refresh_cb, **kwargs)
+        return client
+
+    @classmethod
+    def configure_transport(cls, **kwargs):
+        """
+        Replace the shared transport, e.g.
+        ``FitbitOauth2Client.configure_transport(pool_maxsize=16, keep_alive=True)``.
+        Clients created afterwards use the new pools.
+        """
+        if cls.transport is not None:
+            cls.transport.close()
+        cls.transport = FitbitTransport(**kwargs)
+        return cls.transport
 
     def _request(self, method, url, **kwargs):
         """
@@ -64,20 +1045,102 @@ class FitbitOauth2Client(object):
         if self.timeout is not None and 'timeout' not in kwargs:
             kwargs['timeout'] = self.timeout
 
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        retries = 0
+        refreshes = 0
         try:
+            # Refresh ahead of expiry rather than spending a request on a 401
+            if self.token_expires_soon():
+                self._timed_refresh(metrics)
+                refreshes += 1
+
+            while True:
+                response = self._send(method, url, **kwargs)
+
+                # If our current token has no expires_at, or something manages to slip
+                # through that check
+                if response.status_code == 401:
+                    d = json.loads(response.content.decode('utf8'))
+                    if d['errors'][0]['errorType'] == 'expired_token':
+                        self._timed_refresh(metrics)
+                        refreshes += 1
+                        response = self._send(method, url, **kwargs)
+
+                # Out of budget anyway: wait for the reset Fitbit gave us
+                # and try again rather than failing the request
+                if (response.status_code == 429 and self.rate_limiter is not None
+                        and retries < self.max_rate_limit_retries):
+                    retries += 1
+                    retry_after = response.headers.get('Retry-After')
+                    self.rate_limiter.penalize(
+                        self.rate_limit_key,
+                        int(retry_after) if retry_after else None
+                    )
+                    continue
+
+                if metrics is not None:
+                    metrics.record(method, url, response,
+                                   time.perf_counter() - start, retries,
+                                   refreshes)
+                return response
+        except requests.Timeout as e:
+            raise exceptions.Timeout(*e.args)
+
+    def _timed_refresh(self, metrics):
+        if metrics is None:
+            return self.refresh_token()
+        with metrics.phase('refresh'):
+            return self.refresh_token()
+
+    def _send(self, method, url, **kwargs):
+        """
+        Send one request through the session, spending and re-syncing the
+        rate limit budget around it.
+        """
+        limiter = self.rate_limiter
+        metrics = self.metrics
+        if metrics is not None:
+            return self._send_timed(metrics, limiter, method, url, **kwargs)
+        if limiter is None:
+            return self.session.request(method, url, **kwargs)
+        limiter.acquire(self.rate_limit_key)
+        response = self.session.request(method, url, **kwargs)
+        limiter.update(self.rate_limit_key, response.headers)
+        return response
+
+    def _send_timed(self, metrics, limiter, method, url, **kwargs):
+        """_send, recording the time spent waiting on budget and on Fitbit"""
+        if limiter is not None:
+            with metrics.phase('rate_limit_wait'):
+                limiter.acquire(self.rate_limit_key)
+        with metrics.phase('fitbit'):
             response = self.session.request(method, url, **kwargs)
+        if limiter is not None:
+            limiter.update(self.rate_limit_key, response.headers)
+        return response
 
-            # If our current token has no expires_at, or something manages to slip
-            # through that check
-            if response.status_code == 401:
-                d = json.loads(response.content.decode('utf8'))
-                if d['errors'][0]['errorType'] == 'expired_token':
-                    self.refresh_token()
-                    response = self.session.request(method, url, **kwargs)
+    def token_expires_soon(self, margin=None):
+        """
+        True when the token has an ``expires_at`` that falls within ``margin``
+        seconds (default ``refresh_margin``) and it can be refreshed.
+        """
+        expires_at = self.session.token.get('expires_at')
+        if not expires_at or not self.session.token_updater:
+            return False
+        if margin is None:
+            margin = self.refresh_margin
+        return time.time() + margin >= float(expires_at)
 
-            return response
-        except requests.Timeout as e:
-            raise exceptions.Timeout(*e.args)
+    def rate_limit_remaining(self):
+        """
+        Requests this client's user can still make before the budget resets,
+        or None when rate limiting is disabled.
+        """
+        if self.rate_limiter is None:
+            return None
+        return self.rate_limiter.remaining(self.rate_limit_key)
 
     def make_request(self, url, data=None, method=None, **kwargs):
         """
@@ -149,16 +1212,24 @@ class FitbitOauth2Client(object):
     def refresh_token(self):
         """Step 3: obtains a new access_token from the the refresh token
         obtained in step 2. Only do the refresh if there is `token_updater(),`
-        which saves the token.
+        which saves the token. Concurrent refreshes of the same token share
+        one request, see TokenRefreshCoordinator.
         """
         token = {}
         if self.session.token_updater:
-            token = self.session.refresh_token(
-                self.refresh_token_url,
-                auth=HTTPBasicAuth(self.client_id, self.client_secret)
-            )
-            self.session.token_updater(token)
+            if self.refresh_coordinator is None:
+                token = self._fetch_refreshed_token()
+            else:
+                token = self.refresh_coordinator.refresh(self)
+
+        return token
 
+    def _fetch_refreshed_token(self):
+        token = self.session.refresh_token(
+            self.refresh_token_url,
+            auth=HTTPBasicAuth(self.client_id, self.client_secret)
+        )
+        self.session.token_updater(token)
         return token
 
 
@@ -209,6 +1280,31 @@ class Fitbit(object):
         'frequent',
     ]
 
+    # Longest date range, in days, Fitbit serves in one request. Longer ranges
+    # are split into chunks by time_series_range and get_body_range.
+    MAX_RANGE_DAYS = {
+        'sleep': 100,
+        'activities/heart': 365,
+        'body/log/weight': 31,
+        'body/log/fat': 31,
+    }
+    DEFAULT_MAX_RANGE_DAYS = 1095
+
+    # The OAuth2 client built for every instance
+    client_class = FitbitOauth2Client
+
+    # Raw response archive, see ResponseArchive. None (the default) records
+    # nothing; with a replaying archive no request reaches Fitbit.
+    archive = None
+
+    # Persistent response cache, see ResponseCache. None (the default) sends
+    # every request to Fitbit.
+    cache = None
+
+    # OAuth2 clients for_token copies from, one per app configuration
+    _prototypes = {}
+    _prototypes_lock = threading.Lock()
+
     def __init__(self, client_id, client_secret, access_token=None,
             refresh_token=None, expires_at=None, refresh_cb=None,
             redirect_uri=None, system=US, **kwargs):
@@ -216,7 +1312,7 @@ class Fitbit(object):
         Fitbit(<id>, <secret>, access_token=<token>, refresh_token=<token>)
         """
         self.system = system
-        self.client = FitbitOauth2Client(
+        self.client = self.client_class(
             client_id,
             client_secret,
             access_token=access_token,
@@ -227,23 +1323,36 @@ class Fitbit(object):
             **kwargs
         )
 
-        # All of these use the same patterns, define the method for accessing
-        # creating and deleting records once, and use curry to make individual
-        # Methods for each
-        for resource in Fitbit.RESOURCE_LIST:
-            underscore_resource = resource.replace('/', '_')
-            setattr(self, underscore_resource,
-                    curry(self._COLLECTION_RESOURCE, resource))
-
-            if resource not in ['body', 'glucose']:
-                # Body and Glucose entries are not currently able to be deleted
-                setattr(self, 'delete_%s' % underscore_resource, curry(
-                    self._DELETE_COLLECTION_RESOURCE, resource))
+    @classmethod
+    def for_token(cls, client_id, client_secret, access_token=None,
+            refresh_token=None, expires_at=None, refresh_cb=None,
+            redirect_uri=None, system=US, **kwargs):
+        """
+        Same as the constructor, but much cheaper when building a client per
+        user, e.g. per participant: the OAuth2 client is copied from one built
+        once per app (see FitbitOauth2Client.with_token) and only gets its own
+        token state.
+        """
+        key = (cls.client_class, client_id, client_secret, redirect_uri,
+               cls.client_class.refresh_token_url, id(cls.client_class.transport))
+        prototype = cls._prototypes.get(key)
+        if prototype is None:
+            with cls._prototypes_lock:
+                prototype = cls._prototypes.get(key)
+                if prototype is None:
+                    prototype = cls._prototypes[key] = cls.client_class(
+                        client_id, client_secret, redirect_uri=redirect_uri)
+        fitbit = object.__new__(cls)
+        fitbit.system = system
+        fitbit.client = prototype.with_token(
+            access_token=access_token,
+            refresh_token=refresh_token,
+            expires_at=expires_at,
+            refresh_cb=refresh_cb,
+            **kwargs
+        )
+        return fitbit
 
-        for qualifier in Fitbit.QUALIFIERS:
-            setattr(self, '%s_activities' % qualifier, curry(self.activity_stats, qualifier=qualifier))
-            setattr(self, '%s_foods' % qualifier, curry(self._food_stats,
-                                                        qualifier=qualifier))
 
     def make_request(self, *args, **kwargs):
         # This should handle data level errors, improper requests, and bad
@@ -253,6 +1362,24 @@ class Fitbit(object):
         kwargs['headers'] = headers
 
         method = kwargs.get('method', 'POST' if 'data' in kwargs else 'GET')
+        archive = self.archive
+        if archive is not None and archive.replay and method == 'GET':
+            return archive.lookup(self.client.user_key, args[0] if args else kwargs['url'])
+        cache = self.cache
+        if cache is not None and method == 'GET' and self.client.user_key is not None:
+            args = list(args)
+            url = args.pop(0) if args else kwargs.pop('url')
+            rep = cache.fetch(self.client.user_key, url, lambda url: self._make_request(
+                method, url, *args, **kwargs))
+        else:
+            url = args[0] if args else kwargs.get('url')
+            rep = self._make_request(method, *args, **kwargs)
+        # Archive what the caller gets, cache hits and stitched ranges too
+        if archive is not None and method == 'GET' and rep is not True:
+            archive.record(self.client.user_key, url, rep)
+        return rep
+
+    def _make_request(self, method, *args, **kwargs):
         response = self.client.make_request(*args, **kwargs)
 
         if response.status_code == 202:
@@ -262,13 +1389,25 @@ class Fitbit(object):
                 return True
             else:
                 raise exceptions.DeleteError(response)
+        metrics = getattr(self.client, 'metrics', None)
+        if metrics is not None:
+            start = time.perf_counter()
         try:
             rep = json.loads(response.content.decode('utf8'))
         except ValueError:
             raise exceptions.BadResponse
+        if metrics is not None:
+            metrics.observe_phase('parse', time.perf_counter() - start)
 
         return rep
 
+    def rate_limit_remaining(self):
+        """
+        Requests the user can still make this hour, or None when rate limiting
+        is disabled. See RateLimiter.
+        """
+        return self.client.rate_limit_remaining()
+
     def user_profile_get(self, user_id=None):
         """
         Get a user profile. You can get other user's profile information
@@ -316,7 +1455,7 @@ class Fitbit(object):
         Retrieving and logging of each type of collection data.
 
         Arguments:
-            resource, defined automatically via curry
+            resource, bound by the methods _define_resource_methods adds
             [date] defaults to today
             [user_id] defaults to current logged in user
             [data] optional, include for creating a record, exclude for access
@@ -352,7 +1491,7 @@ class Fitbit(object):
         deleting each type of collection data
 
         Arguments:
-            resource, defined automatically via curry
+            resource, bound by the methods _define_resource_methods adds
             log_id, required, log entry to delete
 
         This builds the following methods::
@@ -555,6 +1694,96 @@ class Fitbit(object):
             )
         return self.make_request(url)
 
+    def time_series_range(self, resource, base_date, end_date, user_id=None,
+                          max_workers=4):
+        """
+        time_series for a date range of any length. The range is split into
+        chunks no longer than MAX_RANGE_DAYS allows for the resource, the
+        chunks are fetched concurrently (still under the rate limiter) and the
+        responses are merged into one, with duplicate entries dropped.
+        """
+        return self._fetch_range(
+            lambda start, end: self.time_series(
+                resource, user_id=user_id, base_date=start, end_date=end),
+            resource, base_date, end_date, max_workers
+        )
+
+    def get_body_range(self, type_, base_date, end_date, user_id=None,
+                       max_workers=4):
+        """
+        _get_body for a date range of any length, see time_series_range.
+        type_ is 'weight' or 'fat'.
+        """
+        return self._fetch_range(
+            lambda start, end: self._get_body(
+                type_, base_date=start, user_id=user_id, end_date=end),
+            'body/log/%s' % type_, base_date, end_date, max_workers
+        )
+
+    def _fetch_range(self, fetch, resource, base_date, end_date, max_workers):
+        chunks = self._date_chunks(
+            self._get_date(base_date),
+            self._get_date(end_date),
+            self.MAX_RANGE_DAYS.get(resource, self.DEFAULT_MAX_RANGE_DAYS)
+        )
+        if len(chunks) == 1:
+            return fetch(*chunks[0])
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            responses = list(executor.map(lambda chunk: fetch(*chunk), chunks))
+        return self._merge_responses(responses)
+
+    def _get_date(self, date):
+        if isinstance(date, datetime.datetime):
+            return date.date()
+        if isinstance(date, datetime.date):
+            return date
+        if date == 'today':
+            return datetime.date.today()
+        return datetime.datetime.strptime(date, '%Y-%m-%d').date()
+
+    @staticmethod
+    def _date_chunks(start, end, max_days):
+        """Split [start, end] into inclusive (start, end) ranges of at most max_days"""
+        if end < start:
+            raise ValueError("end_date must not be before base_date")
+        chunks = []
+        while start <= end:
+            chunk_end = min(start + datetime.timedelta(days=max_days - 1), end)
+            chunks.append((start, chunk_end))
+            start = chunk_end + datetime.timedelta(days=1)
+        return chunks
+
+    @staticmethod
+    def _merge_responses(responses):
+        """
+        Merge chunked responses: list values are concatenated in chunk order
+        with duplicate entries (same logId, or same date and time) removed,
+        anything else keeps the value from the first chunk.
+        """
+        merged = {}
+        seen = {}
+        for response in responses:
+            for key, value in response.items():
+                if not isinstance(value, list):
+                    merged.setdefault(key, value)
+                    continue
+                entries = merged.setdefault(key, [])
+                keys = seen.setdefault(key, set())
+                for entry in value:
+                    if isinstance(entry, dict):
+                        identity = entry.get('logId') or (
+                            entry.get('dateTime') or entry.get('dateOfSleep')
+                            or entry.get('date'), entry.get('time'))
+                        if identity == (None, None):
+                            identity = json.dumps(entry, sort_keys=True)
+                    else:
+                        identity = json.dumps(entry, sort_keys=True)
+                    if identity in keys:
+                        continue
+                    keys.add(identity)
+                    entries.append(entry)
+        return merged
+
     def intraday_time_series(self, resource, base_date='today', detail_level='1min', start_time=None, end_time=None):
         """
         The intraday time series extends the functionality of the regular time series, but returning data at a
@@ -648,9 +1877,58 @@ class Fitbit(object):
         
         return self.make_request(url)
 
+    def iter_activity_PACE_loglist(self, user_id=None, afterDate=None,
+                                   beforeDate=None, limit=100, prefetch=True):
+        """
+        Generator over every activity log entry after ``afterDate``, oldest
+        first. Follows ``pagination.next`` so users with more than ``limit``
+        activities don't lose any, and stops as soon as an entry starts on or
+        after ``beforeDate``. With ``prefetch`` the next page is requested in
+        the background while the caller works through the current one.
+
+        ``afterDate`` is required (a date or 'YYYY-MM-DD'), Fitbit only pages
+        through the log in ascending order from a start date.
+
+        * https://dev.fitbit.com/build/reference/web-api/activity/get-activity-log-list/
+        """
+        if not afterDate:
+            raise ValueError("afterDate is required")
+        url = "{0}/{1}/user/{2}/activities/list.json?{query}".format(
+            *self._get_common_args(user_id),
+            query=urlencode({
+                'afterDate': self._get_date_string(afterDate),
+                'sort': 'asc',
+                'offset': 0,
+                'limit': limit,
+            })
+        )
+        before = self._get_date_string(beforeDate) if beforeDate else None
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        pending = executor.submit(self.make_request, url)
+        try:
+            while pending is not None:
+                page = pending.result()
+                next_url = (page.get('pagination') or {}).get('next')
+                pending = None
+                if next_url and prefetch:
+                    pending = executor.submit(self.make_request, next_url)
+
+                for activity in page.get('activities', []):
+                    if before and activity['startTime'][:10] >= before:
+                        return
+                    yield activity
+
+                if next_url and not prefetch:
+                    pending = executor.submit(self.make_request, next_url)
+        finally:
+            if pending is not None:
+                pending.cancel()
+            executor.shutdown(wait=False)
+
     def _food_stats(self, user_id=None, qualifier=''):
         """
-        This builds the convenience methods on initialization::
+        This implements the following methods::
 
             recent_foods(user_id=None, qualifier='')
             favorite_foods(user_id=None, qualifier='')
@@ -1040,3 +2318,259 @@ class Fitbit(object):
             collection='/{0}'.format(collection) if collection else ''
         )
         return self.make_request(url)
+
+
+def _define_resource_methods(cls):
+    """
+    All of the collection and qualifier methods use the same patterns: define
+    the method for accessing, creating and deleting records once, and add a
+    method for each resource to the class (instead of to every instance)
+    """
+    for resource in cls.RESOURCE_LIST:
+        underscore_resource = resource.replace('/', '_')
+        setattr(cls, underscore_resource,
+                functools.partialmethod(cls._COLLECTION_RESOURCE, resource))
+
+        if resource not in ['body', 'glucose']:
+            # Body and Glucose entries are not currently able to be deleted
+            setattr(cls, 'delete_%s' % underscore_resource, functools.partialmethod(
+                cls._DELETE_COLLECTION_RESOURCE, resource))
+
+    for qualifier in cls.QUALIFIERS:
+        setattr(cls, '%s_activities' % qualifier,
+                functools.partialmethod(cls.activity_stats, qualifier=qualifier))
+        setattr(cls, '%s_foods' % qualifier,
+                functools.partialmethod(cls._food_stats, qualifier=qualifier))
+
+
+_define_resource_methods(Fitbit)
+
+
+class _LoopBoundOauth2Client(FitbitOauth2Client):
+    """
+    The FitbitOauth2Client an AsyncFitbitOauth2Client drives from its worker
+    threads. Token refreshes are handed back to the event loop so they are
+    serialized by the async client's lock and reach the awaitable refresh_cb.
+    """
+    # Set by the owning AsyncFitbitOauth2Client
+    _owner = None
+
+    def __init__(self, *args, **kwargs):
+        # refresh_cb belongs to the async owner, the session only forwards to it
+        if kwargs.get('refresh_cb'):
+            kwargs['refresh_cb'] = self._forward_token
+        super(_LoopBoundOauth2Client, self).__init__(*args, **kwargs)
+        self._sent = threading.local()
+
+    def _forward_token(self, token):
+        self._owner._token_updater(token)
+
+    def _send(self, method, url, **kwargs):
+        # Remember which token this thread's request carried, so a refresh
+        # after a 401 can tell whether someone else already replaced it
+        self._sent.access_token = self.session.token.get('access_token')
+        return super(_LoopBoundOauth2Client, self)._send(method, url, **kwargs)
+
+    def refresh_token(self):
+        stale = getattr(self._sent, 'access_token', None)
+        return asyncio.run_coroutine_threadsafe(
+            self._owner.refresh_token(stale), self._owner._loop).result()
+
+
+class AsyncFitbitOauth2Client(object):
+    """
+    asyncio counterpart to FitbitOauth2Client. Takes the same arguments, except
+    that ``refresh_cb`` may be a coroutine function (plain callables still
+    work).
+
+    Requests go through the shared FitbitTransport and RateLimiter on a
+    bounded thread pool (see ``configure_executor``), so one event loop can
+    fan out over hundreds of users while at most ``max_workers`` requests are
+    in flight. Token refreshes are single-flight per client: callers that hit
+    an expired token while a refresh is running wait for it and reuse the new
+    token.
+    """
+    executor = None
+    max_workers = 16
+    _executor_lock = threading.Lock()
+
+    def __init__(self, client_id, client_secret, access_token=None,
+            refresh_token=None, expires_at=None, refresh_cb=None,
+            redirect_uri=None, *args, **kwargs):
+        self.refresh_cb = refresh_cb
+        self._loop = None
+        self._refresh_lock = None
+        self.sync = kwargs.pop('sync_client', None) or _LoopBoundOauth2Client(
+            client_id,
+            client_secret,
+            access_token=access_token,
+            refresh_token=refresh_token,
+            expires_at=expires_at,
+            refresh_cb=refresh_cb,
+            redirect_uri=redirect_uri,
+            *args,
+            **kwargs
+        )
+        self.sync._owner = self
+
+    @classmethod
+    def configure_executor(cls, max_workers):
+        """Set how many requests may be in flight at once across all clients"""
+        with cls._executor_lock:
+            if cls.executor is not None:
+                cls.executor.shutdown(wait=False)
+                cls.executor = None
+            cls.max_workers = max_workers
+
+    @classmethod
+    def _get_executor(cls):
+        with cls._executor_lock:
+            if cls.executor is None:
+                cls.executor = ThreadPoolExecutor(
+                    max_workers=cls.max_workers,
+                    thread_name_prefix='fitbit-async'
+                )
+            return cls.executor
+
+    @property
+    def session(self):
+        return self.sync.session
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._refresh_lock = asyncio.Lock()
+        return loop
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking call that talks to Fitbit on the request pool"""
+        loop = self._bind()
+        return await loop.run_in_executor(
+            self._get_executor(), functools.partial(func, *args, **kwargs))
+
+    async def make_request(self, url, data=None, method=None, **kwargs):
+        return await self.run(self.sync.make_request, url, data, method, **kwargs)
+
+    def authorize_token_url(self, scope=None, redirect_uri=None, **kwargs):
+        return self.sync.authorize_token_url(scope, redirect_uri, **kwargs)
+
+    async def fetch_access_token(self, code, redirect_uri=None):
+        return await self.run(self.sync.fetch_access_token, code, redirect_uri)
+
+    async def refresh_token(self, stale_access_token=None):
+        """
+        Obtain a new access_token from the refresh token and await
+        ``refresh_cb`` with it. Concurrent callers share one refresh: pass the
+        access token that was rejected as ``stale_access_token`` and the
+        refresh is skipped if it has already been replaced.
+        """
+        self._bind()
+        stale = stale_access_token or self.session.token.get('access_token')
+        async with self._refresh_lock:
+            if self.session.token.get('access_token') != stale:
+                # Another task refreshed while we were waiting
+                return self.session.token
+            # Not on the request pool: its threads may be blocked waiting for
+            # this very refresh. refresh_cb is awaited back on the loop through
+            # the session's token updater.
+            return await asyncio.to_thread(
+                FitbitOauth2Client.refresh_token, self.sync)
+
+    async def _call_refresh_cb(self, token):
+        result = self.refresh_cb(token)
+        if inspect.isawaitable(result):
+            await result
+
+    def _token_updater(self, token):
+        # requests-oauthlib refreshed on its own inside a worker thread
+        asyncio.run_coroutine_threadsafe(
+            self._call_refresh_cb(token), self._loop).result()
+
+    def rate_limit_remaining(self):
+        return self.sync.rate_limit_remaining()
+
+
+class _AsyncBackedFitbit(Fitbit):
+    client_class = _LoopBoundOauth2Client
+
+
+class AsyncFitbit(object):
+    """
+    asyncio counterpart to Fitbit with the same method surface; every API
+    method is a coroutine::
+
+        async def fetch(participant):
+            client = AsyncFitbit(client_id, client_secret,
+                                 access_token=..., refresh_token=...,
+                                 refresh_cb=save_tokens)  # async def save_tokens(token)
+            return await client.time_series('activities/steps',
+                                            base_date=start, end_date=end)
+
+        results = await asyncio.gather(*(fetch(p) for p in participants),
+                                       return_exceptions=True)
+
+    Generator methods such as ``iter_activity_PACE_loglist`` are async
+    iterators instead, whose pages are also fetched off the event loop::
+
+        async for activity in client.iter_activity_PACE_loglist(afterDate=start):
+            ...
+
+    Concurrency across all clients is bounded by
+    ``AsyncFitbitOauth2Client.configure_executor(max_workers)``.
+    """
+    US = Fitbit.US
+    METRIC = Fitbit.METRIC
+
+    def __init__(self, client_id, client_secret, access_token=None,
+            refresh_token=None, expires_at=None, refresh_cb=None,
+            redirect_uri=None, system=US, **kwargs):
+        self._fitbit = _AsyncBackedFitbit(
+            client_id,
+            client_secret,
+            access_token=access_token,
+            refresh_token=refresh_token,
+            expires_at=expires_at,
+            refresh_cb=refresh_cb,
+            redirect_uri=redirect_uri,
+            system=system,
+            **kwargs
+        )
+        self.client = AsyncFitbitOauth2Client(
+            client_id,
+            client_secret,
+            refresh_cb=refresh_cb,
+            sync_client=self._fitbit.client
+        )
+
+    def __getattr__(self, name):
+        attr = getattr(self._fitbit, name)
+        if not callable(attr):
+            return attr
+        if inspect.isgeneratorfunction(attr):
+            return self._iterator(attr)
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self.client.run(attr, *args, **kwargs)
+        return method
+
+    def _iterator(self, generator_function):
+        """
+        Async iterator over a generator method: every step of the generator
+        (and the requests it makes) runs on the request pool, never on the
+        event loop
+        """
+        @functools.wraps(generator_function)
+        async def iterate(*args, **kwargs):
+            generator = generator_function(*args, **kwargs)
+            exhausted = object()
+            try:
+                while True:
+                    item = await self.client.run(next, generator, exhausted)
+                    if item is exhausted:
+                        return
+                    yield item
+            finally:
+                await self.client.run(generator.close)
+        return iterate